@@ -81,6 +81,11 @@ eventManControllers.controller('EventsListCtrl', ['$scope', 'Event', 'EventTicke
         var query_params = {};
         if (!$state.is('tickets')) {
             query_params['_summary'] = true
+            // only the fields shown in the list of events.
+            query_params['_fields'] = ['title', 'tagline', 'summary', 'where', 'begin_date', 'begin_time',
+                'end_date', 'end_time', 'number_of_tickets', 'ticket_sales_begin_date', 'ticket_sales_begin_time',
+                'ticket_sales_end_date', 'ticket_sales_end_time', 'tickets_sold', 'total_attendees',
+                'no_tickets_for_sale'].join(',');
         }
         $scope.events = Event.all(query_params, function(events) {
             if (events && $state.is('tickets')) {
@@ -493,17 +498,16 @@ eventManControllers.controller('EventDetailsCtrl', ['$scope', '$state', 'Event',
 );
 
 
-eventManControllers.controller('EventTicketsCtrl', ['$scope', '$state', 'Event', 'EventTicket', 'Setting', '$log', '$translate', '$rootScope', 'EventUpdates', '$uibModal', '$filter', 'toaster',
-    function ($scope, $state, Event, EventTicket, Setting, $log, $translate, $rootScope, EventUpdates, $uibModal, $filter, toaster) {
+eventManControllers.controller('EventTicketsCtrl', ['$scope', '$state', 'Event', 'EventTicket', 'Setting', '$log', '$translate', '$rootScope', 'EventUpdates', '$uibModal', '$filter', 'toaster', '$timeout',
+    function ($scope, $state, Event, EventTicket, Setting, $log, $translate, $rootScope, EventUpdates, $uibModal, $filter, toaster, $timeout) {
         $scope.ticketsOrder = ["name", "surname"];
         $scope.countAttendees = 0;
+        $scope.countRegistered = 0;
         $scope.query = '';
         $scope.event = {};
-        $scope.event.tickets = [];
         $scope.shownItems = [];
         $scope.ticket = {}; // current ticket, for the event.ticket.* states
         $scope.tickets = []; // list of all tickets, for the 'tickets' state
-        $scope.filteredTickets = [];
         $scope.formSchema = {};
         $scope.formData = {};
         $scope.guiOptions = {dangerousActionsEnabled: false};
@@ -517,43 +521,104 @@ eventManControllers.controller('EventTicketsCtrl', ['$scope', '$state', 'Event',
         $scope.filteredLength = 0;
         $scope.maxPaginationSize = 10;
         $scope.maxAllPersons = 10;
+        // number of the last request of a page of tickets: the responses to the older ones are ignored.
+        $scope.ticketsRequest = 0;
+
+        /* Build the arguments used to search the tickets on the server (see the search module);
+         * the tickets are filtered, sorted and paginated by the server. */
+        $scope.ticketsSearchParams = function(paginate) {
+            var filter = $scope.query || '';
+            if (!$scope.registeredFilterOptions.all) {
+                filter += ' cancelled:false';
+            }
+            var sort = [];
+            angular.forEach($scope.ticketsOrder, function(key, idx) {
+                // fields whose names contain spaces are written with underscores.
+                sort.push(key.replace(/ /g, '_'));
+            });
+            var params = {id: $state.params.id, _filter: filter.trim(), _sort: sort.join(',')};
+            if (paginate) {
+                params._skip = ($scope.currentPage - 1) * $scope.itemsPerPage;
+                params._limit = $scope.itemsPerPage;
+            }
+            return params;
+        };
 
+        /* Load the page of tickets that is shown. */
         $scope.filterTickets = function() {
-            var tickets = $scope.event.tickets || [];
-            tickets = $filter('splittedFilter')(tickets, $scope.query);
-            tickets = $filter('registeredFilter')(tickets, $scope.registeredFilterOptions);
-            tickets = $filter('orderBy')(tickets, $scope.ticketsOrder);
-            $scope.filteredTickets = angular.copy(tickets);
-            $scope.filteredLength = $scope.filteredTickets.length;
-            tickets = $filter('pagination')(tickets, $scope.currentPage, $scope.itemsPerPage);
-            $scope.shownItems = tickets;
-            $scope.updateCSV();
+            if (!($state.params.id && $state.is('event.tickets'))) {
+                return;
+            }
+            var request = ++$scope.ticketsRequest;
+            EventTicket.search($scope.ticketsSearchParams(true), function(data) {
+                if (request != $scope.ticketsRequest) {
+                    return;
+                }
+                $scope.shownItems = data.tickets || [];
+                $scope.filteredLength = data.total || 0;
+            });
         };
 
-        $scope.$watch('query', function() {
-            if (!$scope.query) {
+        /* Load the page of tickets again, after some tickets were added or removed;
+         * many changes in a short time cause a single request. */
+        $scope.reloadTickets = function() {
+            if ($scope.reloadTicketsTimeout) {
+                $timeout.cancel($scope.reloadTicketsTimeout);
+            }
+            $scope.reloadTicketsTimeout = $timeout(function() {
+                $scope.reloadTicketsTimeout = null;
+                $scope.filterTickets();
+            }, 300);
+        };
+
+        /* Set the counters of the tickets of the event, if they are not older than the ones we have. */
+        $scope.setCounters = function(counters, seq) {
+            if (!counters || (seq && $scope.countersSeq && seq < $scope.countersSeq)) {
+                return;
+            }
+            if (seq) {
+                $scope.countersSeq = seq;
+            }
+            $scope.countRegistered = counters.tickets_sold || 0;
+            $scope.countAttendees = counters.total_attendees || 0;
+        };
+
+        /* Load the counters of the tickets (and the number of the last change) of the event again. */
+        $scope.reloadEvent = function(callback) {
+            Event.get({id: $state.params.id, _summary: true}, function(evt) {
+                $scope.countersSeq = null;
+                $scope.setCounters(evt, evt.changes_seq);
+                if (callback) {
+                    callback(evt);
+                }
+            });
+        };
+
+        $scope.$watch('query', function(new_value, old_value) {
+            if (new_value !== old_value) {
                 $scope.currentPage = 1;
             }
             $scope.filterTickets();
         });
 
-        $scope.$watchCollection('registeredFilterOptions', function() {
-            $scope.filterTickets();
+        $scope.$watchCollection('registeredFilterOptions', function(new_value, old_value) {
+            if (new_value !== old_value) {
+                $scope.currentPage = 1;
+                $scope.filterTickets();
+            }
         });
 
-        $scope.$watch('currentPage + itemsPerPage', function() {
-            $scope.filterTickets();
+        $scope.$watch('currentPage + itemsPerPage', function(new_value, old_value) {
+            if (new_value !== old_value) {
+                $scope.filterTickets();
+            }
         });
 
         if ($state.params.id) {
-            $scope.event = Event.get({id: $state.params.id}, function(data) {
-                $scope.$watchCollection(function() {
-                        return $scope.event.tickets;
-                    }, function(new_collection, old_collection) {
-                        $scope.calcAttendees();
-                        $scope.filterTickets();
-                    }
-                );
+            // the tickets are loaded a page at a time.
+            $scope.event = Event.get({id: $state.params.id, _summary: true}, function(data) {
+                $scope.changesSeq = data.changes_seq || 0;
+                $scope.setCounters(data, data.changes_seq);
 
                 if (!(data && data.formSchema)) {
                     return;
@@ -582,56 +647,29 @@ eventManControllers.controller('EventTicketsCtrl', ['$scope', '$state', 'Event',
                 // Handle WebSocket connection used to update the list of tickets.
                 $scope.EventUpdates = EventUpdates;
                 $scope.EventUpdates.open();
-                $scope.$watchCollection(function() {
-                        return $scope.EventUpdates.data;
-                    }, function(new_collection, old_collection) {
-                        if (!($scope.EventUpdates.data && $scope.EventUpdates.data.update)) {
-                            $log.debug('no data received from the WebSocket');
-                            return;
-                        }
-                        var data = $scope.EventUpdates.data.update;
-                        $log.debug('received ' + data.action + ' action from websocket source ' + data.uuid + ' . Full data:');
-                        $log.debug(data);
-                        if ($rootScope.app_uuid == data.uuid) {
-                            $log.debug('do not process our own message');
-                            return false;
-                        }
-                        if (data.error && data.message && $scope.info.user.username == data.username) {
-                            if (data.searchFor) {
-                                $scope.query = angular.copy(data.searchFor);
-                            }
-                            toaster.pop({type: 'error', title: 'Error', body: data.message, timeout: 0, showCloseButton: true});
+                // Messages can be sent one by one or in batches: every message is queued.
+                $scope.$watch(function() {
+                        return $scope.EventUpdates.data.updates.length;
+                    }, function(new_length, old_length) {
+                        if (!new_length) {
                             return;
                         }
-                        if (!$scope.event.tickets) {
-                            $scope.event.tickets = [];
-                        }
-                        var ticket_id = data._id || (data.ticket && data.ticket._id);
-                        var ticket_idx = $scope.event.tickets.findIndex(function(el, idx, array) {
-                            return ticket_id && (ticket_id == el._id);
+                        angular.forEach($scope.EventUpdates.data.updates.splice(0), function(data, data_idx) {
+                            $scope.processUpdate(data);
                         });
-                        if (ticket_idx != -1) {
-                            $log.debug('_id ' + data._id + ' found');
-                        } else {
-                            $log.debug('_id ' + data._id + ' not found');
-                        }
-
-                        if (data.action == 'update' && ticket_idx != -1 && $scope.event.tickets[ticket_idx] != data.ticket) {
-                            // if we're updating the 'attended' key and the action came from us (same user, possibly on
-                            // a different station), also show a message.
-                            if (data.ticket.attended != $scope.event.tickets[ticket_idx].attended &&
-                                    $scope.info.user.username == data.username) {
-                                $scope.showAttendedMessage(data.ticket, data.ticket.attended);
-                            }
-                            $scope.event.tickets.splice(ticket_idx, 1, data.ticket);
-                        } else if (data.action == 'add' && ticket_idx == -1) {
-                            $scope._localAddTicket(data.ticket);
-                        } else if (data.action == 'delete' && ticket_idx != -1) {
-                            $scope._localRemoveTicket({_id: data._id});
-                        }
                     }
                 );
 
+                $scope.$on('event:updates:reconnected', function() {
+                    $scope.catchUpTickets();
+                });
+
+                // our own changes are not sent back by the WebSocket: their numbers come with the responses.
+                $scope.$on('event:ticket:change-seq', function(evt, seq, counters) {
+                    $scope.addKnownChange(seq);
+                    $scope.setCounters(counters, seq);
+                });
+
                 /* event listners; needed because otherwise, adding a ticket with the Quick add form,
                  * we'd be changing the $scope outside of the AngularJS's $digest. */
 
@@ -643,17 +681,7 @@ eventManControllers.controller('EventTicketsCtrl', ['$scope', '$state', 'Event',
                 });
 
                 $scope.$on('event:ticket:update', function(evt, ticket) {
-                    if (!$scope.event.tickets) {
-                        $scope.event.tickets = [];
-                    }
-                    var ticket_idx = $scope.event.tickets.findIndex(function(el, idx, array) {
-                            return ticket._id == el._id;
-                    });
-                    if (ticket_idx == -1) {
-                        $log.debug('ticket not present: not updated');
-                        return false;
-                    }
-                    $scope.event.tickets.splice(ticket_idx, 1, ticket);
+                    $scope._localUpdateTicket(ticket);
                 });
 
                 $scope.$on('event:ticket:set-attr', function(evt, ticket, key, value, callback, hideMessage) {
@@ -665,18 +693,127 @@ eventManControllers.controller('EventTicketsCtrl', ['$scope', '$state', 'Event',
             $scope.tickets = EventTicket.all();
         }
 
-        $scope.calcAttendees = function() {
-            if (!($scope.event && $scope.event.tickets)) {
-                $scope.countAttendees = 0;
+        /* Process a message received from the WebSocket. */
+        $scope.processUpdate = function(data) {
+            $log.debug('received ' + data.action + ' action from websocket source ' + data.uuid + ' . Full data:');
+            $log.debug(data);
+            if (data.action == 'resync') {
+                // the server dropped some messages.
+                $scope.catchUpTickets();
                 return;
             }
-            var attendees = 0;
-            angular.forEach($scope.event.tickets, function(value, key) {
-                if (value.attended && !value.cancelled) {
-                    attendees += 1;
+            if (data.seq && !$scope.addKnownChange(data.seq)) {
+                // some changes are missing, unless they are our own and the responses are still on their way.
+                $timeout(function() {
+                    if (!$scope.addKnownChange()) {
+                        $scope.catchUpTickets();
+                    }
+                }, 2000);
+            }
+            $scope.setCounters(data.counters, data.seq);
+            if ($rootScope.app_uuid == data.uuid) {
+                $log.debug('do not process our own message');
+                return false;
+            }
+            if (data.error && data.message && $scope.info.user.username == data.username) {
+                if (data.searchFor) {
+                    $scope.query = angular.copy(data.searchFor);
+                }
+                toaster.pop({type: 'error', title: 'Error', body: data.message, timeout: 0, showCloseButton: true});
+                return;
+            }
+            var ticket_id = data._id || (data.ticket && data.ticket._id);
+            var ticket_idx = $scope.shownItems.findIndex(function(el, idx, array) {
+                return ticket_id && (ticket_id == el._id);
+            });
+            if (ticket_idx != -1) {
+                $log.debug('_id ' + data._id + ' found');
+            } else {
+                $log.debug('_id ' + data._id + ' not found');
+            }
+
+            if (data.action == 'update' && ticket_idx != -1 && $scope.shownItems[ticket_idx] != data.ticket) {
+                // if we're updating the 'attended' key and the action came from us (same user, possibly on
+                // a different station), also show a message.
+                if (data.ticket.attended != $scope.shownItems[ticket_idx].attended &&
+                        $scope.info.user.username == data.username) {
+                    $scope.showAttendedMessage(data.ticket, data.ticket.attended);
+                }
+                $scope.shownItems.splice(ticket_idx, 1, data.ticket);
+            } else if (data.action == 'add') {
+                $scope._localAddTicket(data.ticket);
+            } else if (data.action == 'delete') {
+                $scope._localRemoveTicket({_id: data._id});
+            } else if (data.action == 'import' && data.done) {
+                // tickets imported in bulk are not sent one by one: reload them.
+                $scope.reloadEvent(function(evt) {
+                    $scope.changesSeq = evt.changes_seq || 0;
+                    $scope.addKnownChange();
+                });
+                $scope.reloadTickets();
+            }
+        };
+
+        /* Record the number of a change to the tickets (received from the WebSocket or in the response
+         * to one of our requests), advancing changesSeq over the changes known without gaps.
+         * Return false if some changes before the known ones are still missing. */
+        $scope.knownChanges = {};
+        $scope.addKnownChange = function(seq) {
+            if ($scope.changesSeq === undefined) {
+                return true;
+            }
+            if (seq && seq > $scope.changesSeq) {
+                $scope.knownChanges[seq] = true;
+            }
+            while ($scope.knownChanges[$scope.changesSeq + 1]) {
+                $scope.changesSeq += 1;
+            }
+            var missing = false;
+            angular.forEach(Object.keys($scope.knownChanges), function(known, known_idx) {
+                if (known <= $scope.changesSeq) {
+                    delete $scope.knownChanges[known];
+                } else {
+                    missing = true;
                 }
             });
-            $scope.countAttendees = attendees;
+            return !missing;
+        };
+
+        /* Apply the changes to the tickets made after the last one we know of to the page that
+         * is shown; if some of them are lost, load the page again. */
+        $scope.catchUpTickets = function() {
+            if ($scope.changesSeq === undefined || $scope.catchingUp) {
+                return;
+            }
+            $scope.catchingUp = true;
+            EventTicket.changes({id: $state.params.id, since: $scope.changesSeq}, function(data) {
+                $scope.catchingUp = false;
+                if (data.reset) {
+                    $scope.reloadEvent(function(evt) {
+                        $scope.changesSeq = evt.changes_seq || 0;
+                        $scope.addKnownChange();
+                    });
+                    $scope.reloadTickets();
+                    return;
+                }
+                angular.forEach(data.changes || [], function(change, change_idx) {
+                    if (change.action == 'delete') {
+                        $scope._localRemoveTicket({_id: change.ticket._id});
+                    } else if (change.action == 'update') {
+                        $scope._localUpdateTicket(change.ticket);
+                    } else {
+                        $scope._localAddTicket(change.ticket);
+                    }
+                });
+                $scope.changesSeq = Math.max($scope.changesSeq, data.seq);
+                $scope.addKnownChange();
+                if ((data.changes || []).length) {
+                    // the changes don't carry the counters.
+                    $scope.reloadEvent();
+                }
+            }, function() {
+                $scope.catchingUp = false;
+            });
         };
 
         /* Stuff to do when a ticket is added, modified or removed locally. */
@@ -685,19 +822,8 @@ eventManControllers.controller('EventTicketsCtrl', ['$scope', '$state', 'Event',
             if (!$state.is('event.tickets')) {
                 return true;
             }
-            var ret = true;
-            if (!$scope.event.tickets) {
-                $scope.event.tickets = [];
-            }
-            var ticket_idx = $scope.event.tickets.findIndex(function(el, idx, array) {
-                return ticket._id == el._id;
-            });
-            if (ticket_idx != -1) {
-                $log.warn('ticket already present: not added');
-                ret = false;
-            } else {
-                $scope.event.tickets.push(ticket);
-            }
+            // the new ticket may belong to the page that is shown, or move the others to the next one.
+            $scope.reloadTickets();
 
             // Try to remove this person from the allPersons list using ID of the original entry or email.
             var field = null;
@@ -717,45 +843,38 @@ eventManControllers.controller('EventTicketsCtrl', ['$scope', '$state', 'Event',
                     $scope.allPersons.splice(all_person_idx, 1);
                 }
             }
-            return ret;
+            return true;
         };
 
         $scope._localUpdateTicket = function(ticket) {
             if (!$state.is('event.tickets')) {
                 return;
             }
-            if (!$scope.event.tickets) {
-                $scope.event.tickets = [];
-            }
-            var ticket_idx = $scope.event.tickets.findIndex(function(el, idx, array) {
+            var ticket_idx = $scope.shownItems.findIndex(function(el, idx, array) {
                 return ticket._id == el._id;
             });
             if (ticket_idx == -1) {
-                $log.warn('ticket not present: not updated');
+                $log.debug('ticket not shown: not updated');
                 return false;
             }
-            $scope.event.tickets.splice(ticket_idx, 1, ticket);
+            $scope.shownItems.splice(ticket_idx, 1, ticket);
         };
 
         $scope._localRemoveTicket = function(ticket) {
-            if (!(ticket && ticket._id && $scope.event.tickets)) {
+            if (!(ticket && ticket._id && $state.is('event.tickets'))) {
                 return;
             }
-            var ticket_idx = $scope.event.tickets.findIndex(function(el, idx, array) {
+            var ticket_idx = $scope.shownItems.findIndex(function(el, idx, array) {
                 return ticket._id == el._id;
             });
+            // the next tickets move up by one place.
+            $scope.reloadTickets();
             if (ticket_idx == -1) {
-                $log.warn('unable to find and delete ticket _id ' + ticket._id);
+                $log.debug('ticket _id ' + ticket._id + ' not shown');
                 return;
             }
-            var removed_person = $scope.event.tickets.splice(ticket_idx, 1);
+            var person = $scope.shownItems.splice(ticket_idx, 1)[0];
             // to be used to populate allPersons, if needed.
-            var person = null;
-            if (removed_person.length) {
-                person = removed_person[0];
-            } else {
-                return;
-            }
             if (!$scope.allPersons) {
                 $scope.allPersons = [];
             }
@@ -798,16 +917,7 @@ eventManControllers.controller('EventTicketsCtrl', ['$scope', '$state', 'Event',
                 if (!$state.is('event.tickets')) {
                     return;
                 }
-                var ticket_idx = $scope.event.tickets.findIndex(function(el, idx, array) {
-                    return data._id == el._id;
-                });
-                if (ticket_idx == -1) {
-                    $log.warn('unable to find ticket _id ' + data._id);
-                    return;
-                }
-                if ($scope.event.tickets[ticket_idx] != data.ticket) {
-                    $scope.event.tickets.splice(ticket_idx, 1, data.ticket);
-                }
+                $scope._localUpdateTicket(data.ticket);
 
                 if (key === 'attended' && !hideMessage) {
                     $scope.showAttendedMessage(data.ticket, value);
@@ -968,15 +1078,27 @@ eventManControllers.controller('EventTicketsCtrl', ['$scope', '$state', 'Event',
             $scope.filterTickets();
         };
 
-        $scope.updateCSV = function() {
-            if (!$scope.filteredTickets.length) {
-                return;
-            }
-            try {
-                var csv = json2csv({data: $scope.filteredTickets});
-                var blob = new Blob([csv], {type: 'text/csv'});
-                $scope.downloadURL = (window.URL || window.webkitURL).createObjectURL(blob);
-            } catch(err) {}
+        /* Export every ticket matching the filter (not only the page that is shown) to a CSV file. */
+        $scope.exportCSV = function() {
+            EventTicket.search($scope.ticketsSearchParams(false), function(data) {
+                if (!(data.tickets && data.tickets.length)) {
+                    return;
+                }
+                try {
+                    var csv = json2csv({data: data.tickets});
+                    var blob = new Blob([csv], {type: 'text/csv'});
+                    var url = (window.URL || window.webkitURL).createObjectURL(blob);
+                    var link = document.createElement('a');
+                    link.href = url;
+                    link.download = 'eventman.csv';
+                    document.body.appendChild(link);
+                    link.click();
+                    document.body.removeChild(link);
+                    (window.URL || window.webkitURL).revokeObjectURL(url);
+                } catch(err) {
+                    $log.warn('unable to export the tickets: ' + err);
+                }
+            });
         };
 
         $scope.resetInput = function() {
@@ -1038,13 +1160,17 @@ eventManControllers.controller('UsersCtrl', ['$scope', '$rootScope', '$state', '
             $scope.filterUsers();
         });
 
+        // The tickets created by the user are searched and paginated by the server.
         $scope.userFilterTickets = function() {
-            var tickets = $scope.user.tickets || [];
-            tickets = $filter('splittedFilter')(tickets, $scope.userQuery);
-            $scope.userFilteredTickets = angular.copy(tickets);
-            $scope.userFilteredLength = $scope.userFilteredTickets.length;
-            tickets = $filter('pagination')(tickets, $scope.userCurrentPage, $scope.userItemsPerPage);
-            $scope.userShownItems = tickets;
+            if (!($state.is('user.edit') && $state.params.id)) {
+                return;
+            }
+            User.tickets({id: $state.params.id, query: $scope.userQuery,
+                    _skip: ($scope.userCurrentPage - 1) * $scope.userItemsPerPage,
+                    _limit: $scope.userItemsPerPage}, function(data) {
+                $scope.userFilteredLength = data.total || 0;
+                $scope.userShownItems = data.tickets || [];
+            });
         };
 
         $scope.$watch('userQuery', function() {
@@ -1076,10 +1202,9 @@ eventManControllers.controller('UsersCtrl', ['$scope', '$rootScope', '$state', '
         $scope.updateUsersList();
 
         if ($state.is('user.edit') && $state.params.id) {
-            $scope.user = User.get({id: $state.params.id}, function() {
+            $scope.user = User.get({id: $state.params.id, _summary: true}, function() {
                 $scope.updateUserInfo = $scope.user;
                 $scope.updateUserInfo.isAdmin = $rootScope.hasPermission('admin|all', $scope.updateUserInfo);
-                $scope.userFilterTickets();
             });
         }
 
@@ -81,6 +81,14 @@ eventManServices.factory('Event', ['$resource', '$rootScope',
 
 eventManServices.factory('EventTicket', ['$resource', '$rootScope',
     function($resource, $rootScope) {
+        // the number of a change made by this client is not sent back by the WebSocket:
+        // notify the controllers keeping track of the changes.
+        var notifyChange = function(data) {
+            if (data && data.seq) {
+                $rootScope.$broadcast('event:ticket:change-seq', data.seq, data.counters);
+            }
+        };
+
         return $resource('events/:id/tickets', {event_id: '@event_id', ticket_id: '@_id'}, {
             all: {
                 method: 'GET',
@@ -93,6 +101,19 @@ eventManServices.factory('EventTicket', ['$resource', '$rootScope',
                 }
             },
 
+            changes: {
+                method: 'GET',
+                url: 'events/:id/tickets',
+                interceptor: {responseError: $rootScope.errorHandler}
+            },
+
+            // a page of the tickets matching a filter: {tickets: [...], total: N}
+            search: {
+                method: 'GET',
+                url: 'events/:id/tickets',
+                interceptor: {responseError: $rootScope.errorHandler}
+            },
+
             get: {
                 method: 'GET',
                 url: 'events/:id/tickets/:ticket_id',
@@ -117,6 +138,7 @@ eventManServices.factory('EventTicket', ['$resource', '$rootScope',
                     if (data.error) {
                         return data;
                     }
+                    notifyChange(data);
                     return data.ticket;
                 }
             },
@@ -128,10 +150,11 @@ eventManServices.factory('EventTicket', ['$resource', '$rootScope',
                 url: 'events/:event_id/tickets/:ticket_id',
                 params: {uuid: $rootScope.app_uuid},
                 transformResponse: function(data, headers) {
-                    if (data.error) {
-                        return data;
+                    data = angular.fromJson(data);
+                    if (!data.error) {
+                        notifyChange(data);
                     }
-                    return angular.fromJson(data);
+                    return data;
                 }
             },
 
@@ -142,7 +165,9 @@ eventManServices.factory('EventTicket', ['$resource', '$rootScope',
                 url: 'events/:event_id/tickets/:ticket_id',
                 params: {uuid: $rootScope.app_uuid},
                 transformResponse: function(data, headers) {
-                    return angular.fromJson(data);
+                    data = angular.fromJson(data);
+                    notifyChange(data);
+                    return data;
                 }
             }
         });
@@ -214,6 +239,15 @@ eventManServices.factory('EbAPI', ['$resource', '$rootScope',
 eventManServices.factory('User', ['$resource', '$rootScope',
     function($resource, $rootScope) {
         return $resource('users/:id', {id: '@_id'}, {
+            tickets: {
+                method: 'GET',
+                url: 'users/:id/tickets',
+                interceptor: {responseError: $rootScope.errorHandler},
+                transformResponse: function(data, headers) {
+                    return angular.fromJson(data);
+                }
+            },
+
             all: {
                 method: 'GET',
                 interceptor: {responseError: $rootScope.errorHandler},
@@ -265,7 +299,8 @@ eventManServices.factory('User', ['$resource', '$rootScope',
 eventManApp.factory('EventUpdates', ['$websocket', '$location', '$log', '$rootScope',
     function($websocket, $location, $log, $rootScope) {
         var dataStream = null;
-        var data = {};
+        var data = {updates: []};
+        var opened = 0;
 
         var methods = {
             data: data,
@@ -279,11 +314,23 @@ eventManApp.factory('EventUpdates', ['$websocket', '$location', '$log', '$rootSc
                           '/ws/' + $location.path() + '/updates?uuid=' + $rootScope.app_uuid;
                 $log.debug('open WebSocket connection to ' + url);
                 //dataStream && dataStream.close();
-                dataStream = $websocket(url);
+                opened = 0;
+                dataStream = $websocket(url, null, {reconnectIfNotNormalClose: true});
+
+                dataStream.onOpen(function() {
+                    opened++;
+                    if (opened > 1) {
+                        // messages sent while we were disconnected are lost.
+                        $log.debug('WebSocket connection reopened');
+                        $rootScope.$broadcast('event:updates:reconnected');
+                    }
+                });
 
                 dataStream.onMessage(function(message) {
                     $log.debug('EventUpdates message received');
-                    data.update = angular.fromJson(message.data);
+                    // a frame can contain a single message or a batch of messages.
+                    var update = angular.fromJson(message.data);
+                    Array.prototype.push.apply(data.updates, update.batch || [update]);
                 });
             }
         };
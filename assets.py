@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""EventMan(ager) assets
+
+Build the files of the webapp to be served with long-term caching: every file
+referenced by index.html is copied with the hash of its content in the name,
+along with its gzip (and, if the brotli module is available, brotli) compressed
+variants; index.html is rewritten to reference the new names.
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import re
+import gzip
+import json
+import hashlib
+import posixpath
+
+has_brotli = False
+try:
+    import brotli
+    has_brotli = True
+except ImportError:
+    pass
+
+# URL prefix of the fingerprinted files
+ASSETS_URL = '/assets/'
+MANIFEST = 'manifest.json'
+# extensions of the files worth compressing
+COMPRESSIBLE = ('.js', '.css', '.html', '.json', '.svg', '.txt', '.map')
+
+re_reference = re.compile(r'''(?P<attr>\b(?:src|href)=)(?P<quote>["'])(?P<url>/[^"'?#]+)(?P=quote)''')
+re_css_url = re.compile(r'''url\(\s*(?P<quote>["']?)(?P<url>[^"')]+)(?P=quote)\s*\)''')
+
+
+def _file_path(root, url):
+    """Return the file served at a URL by the server, or None for URLs of other handlers."""
+    root = os.path.abspath(root)
+    if url.startswith('/static/'):
+        path = os.path.join(root, 'static', url[len('/static/'):])
+    else:
+        path = os.path.join(root, 'angular_app', url.lstrip('/'))
+    path = os.path.abspath(path)
+    if not path.startswith(root + os.sep) or not os.path.isfile(path):
+        return None
+    return path
+
+
+def _absolute_css_urls(content, url):
+    """Make absolute the relative URLs of a CSS file (e.g. of the fonts), that would otherwise be
+    resolved against the URL of the fingerprinted file."""
+    base = posixpath.dirname(url)
+
+    def _replace(match):
+        ref = match.group('url').strip()
+        if ref.startswith(('/', 'data:', 'http:', 'https:', '#')) or '//' in ref:
+            return match.group(0)
+        return 'url(%s%s%s)' % (match.group('quote'), posixpath.normpath(posixpath.join(base, ref)),
+                                match.group('quote'))
+    return re_css_url.sub(_replace, content.decode('utf-8')).encode('utf-8')
+
+
+def _write(path, content, compress=True):
+    """Write a file and its compressed variants."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fd:
+        fd.write(content)
+    if not compress or not path.endswith(COMPRESSIBLE):
+        return
+    with open(path + '.gz', 'wb') as fd:
+        fd.write(gzip.compress(content, compresslevel=9, mtime=0))
+    if has_brotli:
+        with open(path + '.br', 'wb') as fd:
+            fd.write(brotli.compress(content, quality=11))
+
+
+def build(root, output, compress=True):
+    """Build the fingerprinted files referenced by index.html.
+
+    :param root: the directory of the server, containing the angular_app and static directories
+    :type root: str
+    :param output: the directory where the files are written
+    :type output: str
+    :param compress: also write the compressed variants of the files
+    :type compress: bool
+
+    :returns: the manifest, mapping the original URLs to the fingerprinted ones
+    :rtype: dict
+    """
+    with open(os.path.join(root, 'angular_app', 'index.html'), 'rb') as fd:
+        index = fd.read().decode('utf-8')
+    manifest = {}
+    for match in re_reference.finditer(index):
+        url = match.group('url')
+        if url in manifest:
+            continue
+        path = _file_path(root, url)
+        if path is None:
+            continue
+        with open(path, 'rb') as fd:
+            content = fd.read()
+        if url.endswith('.css'):
+            content = _absolute_css_urls(content, url)
+        digest = hashlib.sha1(content).hexdigest()[:12]
+        name, ext = posixpath.splitext(url.lstrip('/'))
+        hashed = '%s.%s%s' % (name, digest, ext)
+        _write(os.path.join(output, 'assets', *hashed.split('/')), content, compress=compress)
+        manifest[url] = ASSETS_URL + hashed
+    index = re_reference.sub(lambda m: '%s%s%s%s' % (m.group('attr'), m.group('quote'),
+                                                     manifest.get(m.group('url'), m.group('url')),
+                                                     m.group('quote')), index)
+    _write(os.path.join(output, 'index.html'), index.encode('utf-8'), compress=False)
+    with open(os.path.join(output, MANIFEST), 'w') as fd:
+        json.dump(manifest, fd, indent=2, sort_keys=True)
+    return manifest
+
+
+def accepted_encodings(header):
+    """Return the set of the content codings accepted by a client.
+
+    :param header: the value of the Accept-Encoding header
+    :type header: str
+
+    :rtype: set
+    """
+    accepted = set()
+    for item in (header or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q=') and params[2:] in ('0', '0.0', '0.00', '0.000'):
+            continue
+        if coding:
+            accepted.add(coding.lower())
+    return accepted
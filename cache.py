@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""EventMan(ager) cache
+
+In-memory cache of the serialized output of the most requested documents, valid
+as long as the version of the document doesn't change.
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import time
+import uuid
+import collections
+
+# channel used to notify the other processes that a document was modified
+DOCUMENTS_CHANNEL = 'documents-cache'
+
+
+class DocumentsCache(object):
+    """Serialized output of the most recently requested documents.
+
+    The same document can have more variants of its output (e.g.: for users with
+    different permissions), each one with its ETag.  Entries are dropped when the
+    document is modified by this process or by another one: every process must call
+    invalidate after a change, and notify the other processes through a PubSub.
+
+    A reader must call generation before reading a document from the database: the
+    output is not stored if the document was modified in the meantime."""
+    def __init__(self, max_documents=256, ttl=0):
+        """Initialize the instance.
+
+        :param max_documents: maximum number of documents kept in memory
+        :type max_documents: int
+        :param ttl: seconds after which an entry expires (0 means never)
+        :type ttl: float
+        """
+        self.max_documents = max_documents
+        self.ttl = ttl
+        self.origin = '%s-%s' % (os.getpid(), uuid.uuid4().hex)
+        # key: {'version': int, 'expires': float, 'variants': {variant: (etag, body)}}
+        self._entries = collections.OrderedDict()
+        # generation of the last invalidation of the most recently modified documents.
+        self._clock = 0
+        self._invalidated = collections.OrderedDict()
+        self._oldest_generation = 0
+
+    def generation(self, key):
+        """Return the current generation, to be passed to store."""
+        return self._clock
+
+    def get(self, key, variant):
+        """Return the cached output of a document.
+
+        :param key: the key of the document, like 'events/<_id>'
+        :type key: str
+        :param variant: the variant of the output
+        :type variant: str
+
+        :returns: tuple of (etag, body), or None
+        :rtype: tuple
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry['expires'] and entry['expires'] < time.time():
+            del self._entries[key]
+            return None
+        cached = entry['variants'].get(variant)
+        if cached is None:
+            return None
+        self._entries.move_to_end(key)
+        return cached
+
+    def store(self, key, generation, version, variant, etag, body):
+        """Store the output of a document.
+
+        :param key: the key of the document
+        :type key: str
+        :param generation: the value returned by generation, before the document was read
+        :type generation: int
+        :param version: the version of the document
+        :type version: int
+        :param variant: the variant of the output
+        :type variant: str
+        :param etag: the ETag of this output
+        :type etag: str
+        :param body: the serialized output
+        :type body: bytes
+
+        :returns: True if the output was stored
+        :rtype: bool
+        """
+        if self._invalidated.get(key, self._oldest_generation) > generation:
+            return False
+        entry = self._entries.pop(key, None)
+        if entry is None or entry['version'] != version:
+            entry = {'version': version, 'variants': {},
+                     'expires': time.time() + self.ttl if self.ttl else 0}
+        entry['variants'][variant] = (etag, body)
+        self._entries[key] = entry
+        while len(self._entries) > self.max_documents:
+            self._entries.popitem(last=False)
+        return True
+
+    def invalidate(self, key):
+        """Drop the cached output of a document."""
+        self._clock += 1
+        self._entries.pop(key, None)
+        self._invalidated.pop(key, None)
+        self._invalidated[key] = self._clock
+        while len(self._invalidated) > self.max_documents * 4:
+            _, self._oldest_generation = self._invalidated.popitem(last=False)
+
+    def deliver(self, channel, message, uuid=None):
+        """Drop the output of a document modified by another process; to be subscribed to a PubSub."""
+        if channel == DOCUMENTS_CHANNEL and uuid != self.origin:
+            self.invalidate(message)
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+# eventman-trigger: persistent
 """print_label.py - print a label with the name, the company and SEQ_HEX (in a barcode) of an attendee
 
 Copyright 2015-2013 Emiliano Mattioli <oloturia AT gmail.com>
@@ -10,6 +11,7 @@ Licensed under the Apache License 2.0
 
 import os
 import sys
+import json
 import cups
 import tempfile
 from PIL import Image, ImageFont, ImageDraw
@@ -27,17 +29,28 @@ PRINTER_NAME = None
 #PRINTER_NAME = 'DYMO_LabelWriter_450'
 
 
+_fonts = {}
+_connection = None
+
+
 def _get_resource(filename):
     return os.path.join(os.path.dirname(sys.argv[0]), filename)
 
 
+def _get_font(filename, size):
+    # loading a TrueType font is slow: keep them around, when running as a persistent trigger.
+    if (filename, size) not in _fonts:
+        _fonts[(filename, size)] = ImageFont.truetype(_get_resource(filename), size)
+    return _fonts[(filename, size)]
+
+
 def build_label(w, h, barcode_text, line1, line2, font_text=FONT_TEXT, font_barcode=FONT_BARCODE):
     barcode_text = "*" + barcode_text + "*"
     line1 = str(line1, 'utf-8').encode(FONT_TEXT_ENCODING, 'ignore')
     line2 = str(line2, 'utf-8').encode(FONT_TEXT_ENCODING, 'ignore')
-    fontbar = ImageFont.truetype(_get_resource(font_barcode), 2000)
-    fontname = ImageFont.truetype(_get_resource(font_text), 1100)
-    fontjob = ImageFont.truetype(_get_resource(font_text), 780)
+    fontbar = _get_font(font_barcode, 2000)
+    fontname = _get_font(font_text, 1100)
+    fontjob = _get_font(font_text, 780)
     image = Image.new('RGB', (w, h), (255, 255, 255))
     draw = ImageDraw.Draw(image)
     wbar, hbar = draw.textsize(barcode_text, font=fontbar)
@@ -56,22 +69,55 @@ def build_label(w, h, barcode_text, line1, line2, font_text=FONT_TEXT, font_barc
 
 
 def print_label(label_file, name):
-    conn = cups.Connection()
+    global _connection
+    if _connection is None:
+        _connection = cups.Connection()
+    conn = _connection
     printer = PRINTER_NAME or conn.getDefault()
     conn.printFile(printer, label_file.name, name, {})
 
 
-def run():
-    # Always consume stdin.
-    sys.stdin.read()
-    name = ' '.join([os.environ.get('NAME') or '', os.environ.get('SURNAME') or ''])
-    company = os.environ.get('COMPANY') or ''
+def print_ticket(env):
+    name = ' '.join([env.get('NAME') or '', env.get('SURNAME') or ''])
+    company = env.get('COMPANY') or ''
     # Print the decimal value SEQ as an hex of at least 6 digits.
-    seq = os.environ.get('SEQ_HEX', '0')
+    seq = env.get('SEQ_HEX', '0')
     label_file = build_label(LABEL_WIDTH, LABEL_HEIGHT, seq, name, company)
     print_label(label_file, name)
 
 
+def run_persistent():
+    # one event per line; answer with a line once the label was printed.
+    global _connection
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            print_ticket(json.loads(line).get('env') or {})
+            result = {'ok': True}
+        except Exception as e:
+            # the printer may have been restarted.
+            _connection = None
+            sys.stderr.write('print_label.  Exception raised: %s\n' % e)
+            result = {'ok': False, 'error': str(e)}
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.stdout.flush()
+
+
+def run():
+    if os.environ.get('EVENTMAN_TRIGGER_MODE') == 'persistent':
+        run_persistent()
+        return
+    # Always consume stdin.
+    data = sys.stdin.read()
+    if os.environ.get('EVENTMAN_TRIGGER_MODE') == 'batch':
+        # a list of events, each one with its own environment.
+        for item in json.loads(data):
+            print_ticket(item.get('env') or {})
+    else:
+        print_ticket(os.environ)
+
+
 if __name__ == '__main__':
     try:
         run()
@@ -21,17 +21,20 @@ limitations under the License.
 
 import os
 import re
-import glob
-import json
+import gzip
 import time
 import string
 import random
+import hashlib
+import mimetypes
 import logging
 import datetime
+import concurrent.futures
 import dateutil.tz
 import dateutil.parser
 
 import tornado.httpserver
+import tornado.netutil
 import tornado.ioloop
 import tornado.options
 from tornado.options import define, options
@@ -41,19 +44,169 @@ from tornado import gen, escape, process
 
 import utils
 import monco
+import assets
+import pubsub
+import cache
+import lookup
+import sequences
+import search
+import serializer
+import triggers
 import collections
 
 ENCODING = 'utf-8'
-PROCESS_TIMEOUT = 60
 
 API_VERSION = '1.0'
 
 re_env_key = re.compile('[^a-zA-Z_]+')
 re_slashes = re.compile(r'//+')
+re_boundary = re.compile(r'boundary="?(?P<boundary>[^";]+)"?', re.I)
 
-# Keep track of WebSocket connections.
+re_ws_channel = re.compile(r'^/ws/event/(?P<event_id>[\w\d_-]+)/tickets/updates/?$')
+
+# Keep track of WebSocket connections: {event_id: {client_uuid: handler}}
 _ws_clients = {}
 
+# Thread used to parse the uploaded CSV files, shared by every upload.
+_import_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+# pubsub channel used to remove users from the cache of every process.
+USERS_CACHE_CHANNEL = 'users-cache'
+
+
+def ws_clean_url(url):
+    """Normalize the path of a WebSocket, removing duplicated slashes and the query string."""
+    url = re_slashes.sub('/', url)
+    ridx = url.rfind('?')
+    if ridx != -1:
+        url = url[:ridx]
+    return url
+
+
+def ws_channel_clients(channel):
+    """Return the WebSocket clients of this process connected to a channel, by uuid.
+
+    :param channel: the (clean) path of the WebSocket, like /ws/event/:event_id/tickets/updates
+    :type channel: str
+
+    :rtype: dict
+    """
+    match = re_ws_channel.match(channel or '')
+    if not match:
+        return {}
+    return _ws_clients.get(match.group('event_id')) or {}
+
+
+def _ws_frame(messages):
+    """Return a single frame with some messages: a message is sent as is, more messages as {"batch": [...]}."""
+    if not messages:
+        return None
+    if len(messages) == 1:
+        return messages[0]
+    return '{"batch": [%s]}' % ', '.join(messages)
+
+
+def ws_send(channel, messages):
+    """Send some messages, with a single frame, to every WebSocket client of this process connected to a channel.
+
+    :param channel: the (clean) path of the WebSocket
+    :type channel: str
+    :param messages: list of tuples (message, uuid of the sender); a client doesn't receive its own messages
+    :type messages: list
+    """
+    count = 0
+    _to_delete = set()
+    senders = set(uuid for message, uuid in messages if uuid)
+    common_frame = None
+    clients = ws_channel_clients(channel)
+    for client_uuid, client in clients.items():
+        if client_uuid and client_uuid in senders:
+            frame = _ws_frame([message for message, uuid in messages if uuid != client_uuid])
+        else:
+            if common_frame is None:
+                common_frame = _ws_frame([message for message, uuid in messages])
+            frame = common_frame
+        if frame is None:
+            continue
+        try:
+            if not client.send(frame):
+                _to_delete.add(client_uuid)
+                continue
+        except:
+            _to_delete.add(client_uuid)
+            continue
+        count += 1
+    for client_uuid in _to_delete:
+        clients.pop(client_uuid, None)
+    logging.debug('ws_send: sent %d messages to %d clients of %s' % (len(messages), count, channel))
+
+
+class WebSocketBatcher(object):
+    """Collect the messages for the WebSocket clients of a channel over a short time window,
+    and send them together, with a single frame per client."""
+    def __init__(self, delay=0.03, max_size=50):
+        """Initialize the instance.
+
+        :param delay: seconds to wait for more messages (0 means every message is sent immediately)
+        :type delay: float
+        :param max_size: maximum number of messages sent in a frame
+        :type max_size: int
+        """
+        self.delay = delay
+        self.max_size = max(max_size, 1)
+        self._pending = {}
+        # timeouts of the channels with queued messages
+        self._timeouts = {}
+
+    def deliver(self, channel, message, uuid=None):
+        """Queue a message for the clients connected to a channel.
+
+        :param channel: the (clean) path of the WebSocket
+        :type channel: str
+        :param message: message to send
+        :type message: str
+        :param uuid: the client with this uuid (the sender) is skipped
+        :type uuid: str
+        """
+        if not ws_channel_clients(channel):
+            return
+        if not self.delay:
+            ws_send(channel, [(message, uuid)])
+            return
+        pending = self._pending.setdefault(channel, [])
+        pending.append((message, uuid))
+        if len(pending) >= self.max_size:
+            self.flush(channel)
+        elif len(pending) == 1:
+            self._timeouts[channel] = tornado.ioloop.IOLoop.current().call_later(self.delay, self.flush, channel)
+
+    def flush(self, channel):
+        """Send the queued messages of a channel."""
+        timeout = self._timeouts.pop(channel, None)
+        if timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(timeout)
+        messages = self._pending.pop(channel, None)
+        if messages:
+            ws_send(channel, messages)
+
+
+# Batch the messages for the WebSocket clients (configured in run, according to the options).
+ws_batcher = WebSocketBatcher(delay=0)
+
+
+def ws_deliver(channel, message, uuid=None):
+    """Send a message to every WebSocket client of this process connected to a channel;
+    to be subscribed to a PubSub.
+
+    :param channel: the (clean) path of the WebSocket
+    :type channel: str
+    :param message: message to send
+    :type message: str
+    :param uuid: the client with this uuid (the sender) is skipped
+    :type uuid: str
+    """
+    ws_batcher.deliver(channel, message, uuid)
+
 
 def authenticated(method):
     """Decorator to handle forced authentication."""
@@ -101,12 +254,21 @@ class BaseHandler(tornado.web.RequestHandler):
         'users|create': True
     }
 
-    # Cache currently connected users.
-    _users_cache = {}
+    # Cache currently connected users (replaced in run, according to the options).
+    _users_cache = utils.TTLCache()
 
-    # A property to access the first value of each argument.
-    arguments = property(lambda self: dict([(k, v[0].decode('utf-8'))
-        for k, v in self.request.arguments.items()]))
+    # Values resolved once per request: arguments, user information and checked permissions.
+    _parsed_arguments = None
+    _user_info = None
+    _checked_permissions = None
+
+    @property
+    def arguments(self):
+        """A copy of the first value of each argument."""
+        if self._parsed_arguments is None:
+            self._parsed_arguments = dict([(k, v[0].decode('utf-8'))
+                for k, v in self.request.arguments.items()])
+        return dict(self._parsed_arguments)
 
     # A property to access both the UUID and the clean arguments.
     @property
@@ -145,6 +307,24 @@ class BaseHandler(tornado.web.RequestHandler):
             message = 'internal error'
         self.build_error(message, status=status_code)
 
+    def write(self, chunk):
+        """Write some output; dictionaries are serialized in JSON by the serializer module."""
+        if isinstance(chunk, dict):
+            chunk = self.serialize(chunk)
+            self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        super(BaseHandler, self).write(chunk)
+
+    def serialize(self, data):
+        """Serialize a dictionary in JSON, as written in the output.
+
+        :param data: the data to serialize
+        :type data: dict
+
+        :rtype: bytes
+        """
+        # like Tornado, escape "</" to safely embed the output in a HTML page.
+        return serializer.dumpb(data).replace(b'</', b'<\\/')
+
     def is_api(self):
         """Return True if the path is from an API call."""
         return self.request.path.startswith('/v%s' % API_VERSION)
@@ -163,36 +343,81 @@ class BaseHandler(tornado.web.RequestHandler):
 
     def initialize(self, **kwargs):
         """Add every passed (key, value) as attributes of the instance."""
+        self.init_params = kwargs
         for key, value in kwargs.items():
             setattr(self, key, value)
 
-    @property
-    def current_user(self):
-        """Retrieve current user name from the secure cookie."""
+    def get_current_user(self):
+        """Retrieve current user name from the secure cookie; called once per request by
+        the current_user property."""
         current_user = self.get_secure_cookie("user")
         if isinstance(current_user, bytes):
             current_user = current_user.decode('utf-8')
         return current_user
 
-    @property
-    def current_user_info(self):
-        """Information about the current user, including their permissions."""
-        current_user = self.current_user
-        if current_user in self._users_cache:
-            return self._users_cache[current_user]
+    @gen.coroutine
+    def prepare(self):
+        # the information about the user is read without blocking the IOLoop, before
+        # it's needed by current_user_info.
+        yield self.load_user_info()
+
+    def _build_user_info(self, current_user, user):
         permissions = set([k for (k, v) in self.permissions.items() if v is True])
         user_info = {'permissions': permissions}
         if current_user:
             user_info['_id'] = current_user
-            user = self.db.getOne('users', {'_id': current_user})
             if user:
                 user_info = user
                 permissions.update(set(user.get('permissions') or []))
                 user_info['permissions'] = permissions
                 user_info['isRegistered'] = True
-        self._users_cache[current_user] = user_info
         return user_info
 
+    @gen.coroutine
+    def load_user_info(self):
+        """Load the information about the current user (see current_user_info) from the
+        cache or from the database.
+
+        :returns: the information about the user
+        :rtype: dict"""
+        if self._user_info is not None:
+            return self._user_info
+        current_user = self.current_user
+        user_info = self._users_cache.get(current_user)
+        if user_info is None:
+            user = (yield self.adb.getOne('users', {'_id': current_user})) if current_user else None
+            user_info = self._build_user_info(current_user, user)
+            self._users_cache[current_user] = user_info
+        self._user_info = user_info
+        return user_info
+
+    @property
+    def current_user_info(self):
+        """Information about the current user, including their permissions; it's loaded
+        by prepare (see load_user_info)."""
+        if self._user_info is not None:
+            return self._user_info
+        # prepare was not called (e.g.: the handler was created by another one).
+        current_user = self.current_user
+        user_info = self._users_cache.get(current_user)
+        if user_info is None:
+            user = self.db.getOne('users', {'_id': current_user}) if current_user else None
+            user_info = self._users_cache[current_user] = self._build_user_info(current_user, user)
+        self._user_info = user_info
+        return user_info
+
+    def sub_handler(self, handler_class):
+        """Return a handler of another class for the current request, sharing the
+        information about the current user.
+
+        :param handler_class: the class of the handler
+        :type handler_class: type
+
+        :rtype: :class:`~tornado.web.RequestHandler`"""
+        handler = handler_class(self.application, self.request, **self.init_params)
+        handler._user_info = self._user_info
+        return handler
+
     def add_access_info(self, doc):
         """Add created/updated by/at to a document (modified in place and returned).
 
@@ -219,6 +444,14 @@ class BaseHandler(tornado.web.RequestHandler):
         :returns: True if the user is allowed to perform the action or False
         :rtype: bool
         """
+        if self._checked_permissions is None:
+            self._checked_permissions = {}
+        allowed = self._checked_permissions.get(permission)
+        if allowed is None:
+            allowed = self._checked_permissions[permission] = self._has_permission(permission)
+        return allowed
+
+    def _has_permission(self, permission):
         user_info = self.current_user_info or {}
         user_permissions = user_info.get('permissions') or []
         global_permission = '%s|all' % permission.split('|')[0]
@@ -231,6 +464,7 @@ class BaseHandler(tornado.web.RequestHandler):
             return collection_permission(permission)
         return False
 
+    @gen.coroutine
     def user_authorized(self, username, password):
         """Check if a combination of username/password is valid.
 
@@ -242,7 +476,7 @@ class BaseHandler(tornado.web.RequestHandler):
         :returns: tuple like (bool_user_is_authorized, dict_user_info)
         :rtype: dict"""
         query = [{'username': username}, {'email': username}]
-        res = self.db.query('users', query)
+        res = yield self.adb.query('users', query)
         if not res:
             return (False, {})
         user = res[0]
@@ -268,22 +502,106 @@ class BaseHandler(tornado.web.RequestHandler):
         self.set_status(status)
         self.write({'error': True, 'message': message})
 
+    def invalidate_user(self, user_id):
+        """Remove a user from the cache of users of every server process.
+
+        :param user_id: the _id of the user
+        :type user_id: str"""
+        self._users_cache.pop(user_id, None)
+        if user_id == self.current_user:
+            self._user_info = None
+            self._checked_permissions = None
+        if user_id and getattr(self, 'pubsub', None) is not None:
+            self.pubsub.publish(USERS_CACHE_CHANNEL, user_id)
+
     def logout(self):
         """Remove the secure cookie used fro authentication."""
-        if self.current_user in self._users_cache:
-            del self._users_cache[self.current_user]
+        self.invalidate_user(self.current_user)
         self.clear_cookie("user")
 
 
+def users_cache_deliver(channel, message, uuid=None):
+    """Remove a user from the cache of this process, when requested by any process."""
+    if channel == USERS_CACHE_CHANNEL:
+        BaseHandler._users_cache.pop(message, None)
+
+
 class RootHandler(BaseHandler):
     """Handler for the / path."""
     angular_app_path = os.path.join(os.path.dirname(__file__), "angular_app")
+    # directory of the files built by assets.build; if set, its index.html is served
+    assets_path = None
+    # index.html, kept in memory: (body, gzipped body, ETag)
+    _index = None
+
+    def _load_index(self):
+        path = os.path.join(self.assets_path or self.angular_app_path, 'index.html')
+        with open(path, 'rb') as fd:
+            body = fd.read()
+        etag = hashlib.sha1(body).hexdigest()[:16]
+        return body, gzip.compress(body, mtime=0), etag
 
     @gen.coroutine
     def get(self, *args, **kwargs):
-        # serve the ./angular_app/index.html file
-        with open(self.angular_app_path + "/index.html", 'r') as fd:
-            self.write(fd.read())
+        # serve the ./angular_app/index.html file; in debug mode, it's read again at every request.
+        index = RootHandler._index
+        if index is None or self.settings.get('debug'):
+            index = RootHandler._index = self._load_index()
+        body, gzipped, etag = index
+        use_gzip = 'gzip' in assets.accepted_encodings(self.request.headers.get('Accept-Encoding'))
+        self.set_header('Content-Type', 'text/html; charset=UTF-8')
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('Vary', 'Accept-Encoding')
+        self.set_header('Etag', '"%s%s"' % (etag, '-gz' if use_gzip else ''))
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        if use_gzip:
+            self.set_header('Content-Encoding', 'gzip')
+            body = gzipped
+        self.write(body)
+
+
+class AssetsHandler(tornado.web.StaticFileHandler):
+    """Serve the fingerprinted files built by assets.build: their content never changes, so they
+    are cached for a year by the clients, and the compressed variant accepted by the client is sent."""
+    # content codings, in order of preference, and the suffix of their files
+    encodings = (('br', '.br'), ('gzip', '.gz'))
+    # seconds the files are cached by the clients (one year)
+    CACHE_MAX_AGE = 365 * 24 * 3600
+
+    def initialize(self, path, default_filename=None):
+        super(AssetsHandler, self).initialize(path, default_filename)
+        self._encoding = None
+        self._original_path = None
+
+    @gen.coroutine
+    def get(self, path, include_body=True):
+        self._original_path = path
+        accepted = assets.accepted_encodings(self.request.headers.get('Accept-Encoding'))
+        for encoding, suffix in self.encodings:
+            if encoding in accepted and os.path.isfile(os.path.join(self.root, path + suffix)):
+                self._encoding = encoding
+                path += suffix
+                break
+        yield super(AssetsHandler, self).get(path, include_body=include_body)
+
+    def get_content_type(self):
+        mime_type, encoding = mimetypes.guess_type(self._original_path or self.absolute_path)
+        if mime_type is None:
+            return 'application/octet-stream'
+        if mime_type.startswith('text/') or mime_type == 'application/javascript':
+            return '%s; charset=UTF-8' % mime_type
+        return mime_type
+
+    def get_cache_time(self, path, modified, mime_type):
+        return self.CACHE_MAX_AGE
+
+    def set_extra_headers(self, path):
+        self.set_header('Cache-Control', 'public, max-age=%d, immutable' % self.CACHE_MAX_AGE)
+        self.set_header('Vary', 'Accept-Encoding')
+        if self._encoding:
+            self.set_header('Content-Encoding', self._encoding)
 
 
 class CollectionHandler(BaseHandler):
@@ -297,25 +615,45 @@ class CollectionHandler(BaseHandler):
     # set of documents used to store incremental sequences
     counters_collection = 'counters'
 
+    # set of documents used to store tickets, if they are not embedded into the events
+    tickets_collection = 'tickets'
+    separate_tickets = False
+
+    # in-memory indexes used to search the tickets by some fields (see lookup.TicketsLookup)
+    tickets_lookup = None
+
+    # values of the sequences reserved in blocks (see sequences.SequenceAllocator)
+    seq_allocator = None
+
+    # serialized output of the most requested documents (see cache.DocumentsCache);
+    # used only by the subclasses that set cache_documents
+    documents_cache = None
+    cache_documents = False
+
     _id_chars = string.ascii_lowercase + string.digits
 
-    def get_next_seq(self, seq):
+    @gen.coroutine
+    def get_next_seq(self, seq, increment=1):
         """Increment and return the new value of a ever-incrementing counter.
 
         :param seq: unique name of the sequence
         :type seq: str
+        :param increment: number of values to reserve; the last one is returned
+        :type increment: int
 
         :returns: the next value of the sequence
         :rtype: int
         """
-        if not self.db.query(self.counters_collection, {'seq_name': seq}):
-            self.db.add(self.counters_collection, {'seq_name': seq, 'seq': 0})
-        merged, doc = self.db.update(self.counters_collection,
-                {'seq_name': seq},
-                {'seq': 1},
-                operation='increment')
-        return doc.get('seq', 0)
+        if self.seq_allocator is not None:
+            return (yield self.seq_allocator.next(seq, increment))
+        return (yield sequences.reserve(self.adb, seq, increment, self.counters_collection))
+
+    def _build_id(self, seq_value, random_alpha=32):
+        t = str(time.time()).replace('.', '_')
+        rand = ''.join([random.choice(self._id_chars) for x in range(random_alpha)])
+        return '-'.join((t, str(seq_value), rand))
 
+    @gen.coroutine
     def gen_id(self, seq='ids', random_alpha=32):
         """Generate a unique, non-guessable ID.
 
@@ -326,10 +664,25 @@ class CollectionHandler(BaseHandler):
 
         :returns: unique ID
         :rtype: str"""
-        t = str(time.time()).replace('.', '_')
-        seq = str(self.get_next_seq(seq))
-        rand = ''.join([random.choice(self._id_chars) for x in range(random_alpha)])
-        return '-'.join((t, seq, rand))
+        return self._build_id((yield self.get_next_seq(seq)), random_alpha)
+
+    @gen.coroutine
+    def gen_ids(self, count, seq='ids', random_alpha=32):
+        """Generate many unique, non-guessable IDs, reserving a block of values of the sequence.
+
+        :param count: number of IDs
+        :type count: int
+        :param seq: the scope of the ever-incrementing sequence
+        :type seq: str
+        :param random_alpha: number of random lowercase alphanumeric chars
+        :type random_alpha: int
+
+        :returns: list of unique IDs
+        :rtype: list"""
+        if count <= 0:
+            return []
+        last = yield self.get_next_seq(seq, increment=count)
+        return [self._build_id(value, random_alpha) for value in range(last - count + 1, last + 1)]
 
     def _filter_results(self, results, params):
         """Filter a list using keys and values from a dictionary.
@@ -343,7 +696,7 @@ class CollectionHandler(BaseHandler):
         :rtype: list"""
         if not params:
             return results
-        params = monco.convert(params)
+        params = monco.convert(params, self.tickets_collection)
         filtered = []
         for result in results:
             add = True
@@ -367,6 +720,56 @@ class CollectionHandler(BaseHandler):
                     del data[key]
         return data
 
+    def _requested_fields(self, arguments=None):
+        """Return the list of fields requested with the _fields argument, like: ?_fields=title,begin_date
+
+        :param arguments: the arguments of the request
+        :type arguments: dict
+
+        :returns: list of field names, or None if all the fields are requested
+        :rtype: list"""
+        if arguments is None:
+            arguments = self.arguments
+        fields = [f.strip() for f in (arguments.get('_fields') or '').split(',')]
+        fields = [f for f in fields if f and not f.startswith('$')]
+        return fields or None
+
+    def _query_options(self, arguments=None):
+        """Build the projection, sorting and pagination options of a query from the
+        _fields, _sort, _skip and _limit arguments, like: ?_sort=-begin_date,title&_skip=20&_limit=10
+
+        :param arguments: the arguments of the request
+        :type arguments: dict
+
+        :returns: keyword arguments for the query method of the database connector
+        :rtype: dict"""
+        if arguments is None:
+            arguments = self.arguments
+        options = {}
+        fields = self._requested_fields(arguments)
+        if fields:
+            options['fields'] = fields
+        sort = []
+        for key in (arguments.get('_sort') or '').split(','):
+            key = key.strip()
+            if not key or key.startswith('$'):
+                continue
+            if key.startswith('-'):
+                sort.append((key[1:], -1))
+            else:
+                sort.append((key.lstrip('+'), 1))
+        if sort:
+            options['sort'] = sort
+        for option in ('skip', 'limit'):
+            value = arguments.get('_%s' % option)
+            if not value:
+                continue
+            value = int(value)
+            if value < 0:
+                raise ValueError('_%s must not be negative' % option)
+            options[option] = value
+        return options
+
     def _dict2env(self, data):
         """Convert a dictionary into a form suitable to be passed as environment variables.
 
@@ -378,7 +781,7 @@ class CollectionHandler(BaseHandler):
                 continue
             try:
                 key = re_env_key.sub('', key)
-                key = key.upper().encode('ascii', 'ignore')
+                key = key.upper().encode('ascii', 'ignore').decode('ascii')
                 if not key:
                     continue
                 if not isinstance(value, str):
@@ -388,8 +791,9 @@ class CollectionHandler(BaseHandler):
                 continue
         return ret
 
+    @gen.coroutine
     def apply_filter(self, data, filter_name):
-        """Apply a filter to the data.
+        """Apply a filter to the data; a filter can be a coroutine.
 
         :param data: the data to filter
         :returns: the modified (possibly also in place) data
@@ -397,6 +801,8 @@ class CollectionHandler(BaseHandler):
         filter_method = getattr(self, 'filter_%s' % filter_name, None)
         if filter_method is not None:
             data = filter_method(data)
+            if gen.is_future(data):
+                data = yield data
         return data
 
     @gen.coroutine
@@ -409,8 +815,8 @@ class CollectionHandler(BaseHandler):
                 return self.build_error(status=401, message='insufficient permissions: %s' % permission)
             handler = getattr(self, 'handle_get_%s' % resource, None)
             if handler and isinstance(handler, collections.Callable):
-                output = handler(id_, resource_id, **kwargs) or {}
-                output = self.apply_filter(output, 'get_%s' % resource)
+                output = (yield handler(id_, resource_id, **kwargs)) or {}
+                output = yield self.apply_filter(output, 'get_%s' % resource)
                 self.write(output)
                 return
             return self.build_error(status=404, message='unable to access resource: %s' % resource)
@@ -419,8 +825,11 @@ class CollectionHandler(BaseHandler):
             permission = '%s|read' % self.document
             if acl and not self.has_permission(permission):
                 return self.build_error(status=401, message='insufficient permissions: %s' % permission)
-            output = self.db.get(self.collection, id_)
-            output = self.apply_filter(output, 'get')
+            if self.cache_documents and self.documents_cache is not None:
+                yield self._get_cached(id_)
+                return
+            output = yield self.adb.get(self.collection, id_)
+            output = yield self.apply_filter(output, 'get')
             self.write(output)
         else:
             # return an object containing the list of all objects in the collection;
@@ -431,10 +840,64 @@ class CollectionHandler(BaseHandler):
             if acl and not self.has_permission(permission):
                 return self.build_error(status=401, message='insufficient permissions: %s' % permission)
             db_query = {k: v for k, v in self.arguments.items() if not k.startswith('_')}
-            output = {self.collection: self.db.query(self.collection, db_query)}
-            output = self.apply_filter(output, 'get_all')
+            try:
+                query_options = self._query_options()
+            except ValueError as e:
+                return self.build_error(status=400, message='invalid query options: %s' % e)
+            query_options = yield self.apply_filter(query_options, 'query_options_get_all')
+            output = {self.collection: (yield self.adb.query(self.collection, db_query, **query_options))}
+            output = yield self.apply_filter(output, 'get_all')
             self.write(output)
 
+    def cache_variant(self):
+        """Return a string identifying the output of a document for the current request
+        (e.g.: it depends on the permissions of the user), or None if it can't be cached."""
+        return ''
+
+    def cache_state(self, output):
+        """Return a string identifying other information the output of a document depends on;
+        it's added to the ETag."""
+        return ''
+
+    @gen.coroutine
+    def _get_cached(self, id_):
+        """Write a single document.  The serialized output is cached for the current version of
+        the document, and its ETag is used to answer 304 (Not Modified) if the client already has it."""
+        key = '%s/%s' % (self.collection, id_)
+        variant = self.cache_variant()
+        cached = self.documents_cache.get(key, variant) if variant is not None else None
+        if cached is None:
+            generation = self.documents_cache.generation(key)
+            output = yield self.adb.get(self.collection, id_)
+            version = (output or {}).get(monco.VERSION_FIELD, 0)
+            output = yield self.apply_filter(output, 'get')
+            if not output or variant is None:
+                self.write(output)
+                return
+            cached = ('"%s-%s%s"' % (version, variant, self.cache_state(output)), self.serialize(output))
+            self.documents_cache.store(key, generation, version, variant, *cached)
+        etag, body = cached
+        # clients must always check if they have the current version.
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(body)
+
+    def _document_changed(self, id_):
+        """Drop the cached output of a document from every process, after it was modified.
+
+        :param id_: the _id of the document
+        :type id_: str"""
+        if self.documents_cache is None or id_ is None:
+            return
+        key = '%s/%s' % (self.collection, id_)
+        self.documents_cache.invalidate(key)
+        if getattr(self, 'pubsub', None) is not None:
+            self.pubsub.publish(cache.DOCUMENTS_CHANNEL, key, uuid=self.documents_cache.origin)
+
     @gen.coroutine
     @authenticated
     def post(self, id_=None, resource=None, resource_id=None, _rawData=None, **kwargs):
@@ -456,13 +919,16 @@ class CollectionHandler(BaseHandler):
             # Handle access to sub-resources.
             handler = getattr(self, 'handle_%s_%s' % (method, resource), None)
             if handler and isinstance(handler, collections.Callable):
-                data = self.apply_filter(data, 'input_%s_%s' % (method, resource))
-                output = handler(id_, resource_id, data, **kwargs)
-                output = self.apply_filter(output, 'get_%s' % resource)
+                data = yield self.apply_filter(data, 'input_%s_%s' % (method, resource))
+                try:
+                    output = yield handler(id_, resource_id, data, **kwargs)
+                finally:
+                    self._document_changed(id_)
+                output = yield self.apply_filter(output, 'get_%s' % resource)
                 env['RESOURCE'] = resource
                 if resource_id:
                     env['%s_ID' % resource] = resource_id
-                self.run_triggers('%s_%s_%s' % ('create' if resource_id is None else 'update', self.document, resource),
+                yield self.run_triggers('%s_%s_%s' % ('create' if resource_id is None else 'update', self.document, resource),
                                   stdin_data=output, env=env)
                 self.write(output)
                 return
@@ -471,18 +937,19 @@ class CollectionHandler(BaseHandler):
             permission = '%s|%s' % (self.document, crud_method)
             if not self.has_permission(permission):
                 return self.build_error(status=401, message='insufficient permissions: %s' % permission)
-            data = self.apply_filter(data, 'input_%s' % method)
-            merged, newData = self.db.update(self.collection, id_, data)
-            newData = self.apply_filter(newData, method)
-            self.run_triggers('update_%s' % self.document, stdin_data=newData, env=env)
+            data = yield self.apply_filter(data, 'input_%s' % method)
+            merged, newData = yield self.adb.update(self.collection, id_, data)
+            self._document_changed(id_)
+            newData = yield self.apply_filter(newData, method)
+            yield self.run_triggers('update_%s' % self.document, stdin_data=newData, env=env)
         else:
             permission = '%s|%s' % (self.collection, crud_method)
             if not self.has_permission(permission):
                 return self.build_error(status=401, message='insufficient permissions: %s' % permission)
-            data = self.apply_filter(data, 'input_%s_all' % method)
-            newData = self.db.add(self.collection, data, _id=self.gen_id())
-            newData = self.apply_filter(newData, '%s_all' % method)
-            self.run_triggers('create_%s' % self.document, stdin_data=newData, env=env)
+            data = yield self.apply_filter(data, 'input_%s_all' % method)
+            newData = yield self.adb.add(self.collection, data, _id=(yield self.gen_id()))
+            newData = yield self.apply_filter(newData, '%s_all' % method)
+            yield self.run_triggers('create_%s' % self.document, stdin_data=newData, env=env)
         self.write(newData)
 
     # PUT (update an existing document) is handled by the POST (create a new document) method;
@@ -502,11 +969,14 @@ class CollectionHandler(BaseHandler):
                 return self.build_error(status=401, message='insufficient permissions: %s' % permission)
             method = getattr(self, 'handle_delete_%s' % resource, None)
             if method and isinstance(method, collections.Callable):
-                output = method(id_, resource_id, **kwargs)
+                try:
+                    output = yield method(id_, resource_id, **kwargs)
+                finally:
+                    self._document_changed(id_)
                 env['RESOURCE'] = resource
                 if resource_id:
                     env['%s_ID' % resource] = resource_id
-                self.run_triggers('delete_%s_%s' % (self.document, resource), stdin_data=env, env=env)
+                yield self.run_triggers('delete_%s_%s' % (self.document, resource), stdin_data=env, env=env)
                 self.write(output)
                 return
             return self.build_error(status=404, message='unable to access resource: %s' % resource)
@@ -514,59 +984,38 @@ class CollectionHandler(BaseHandler):
             permission = '%s|delete' % self.document
             if not self.has_permission(permission):
                 return self.build_error(status=401, message='insufficient permissions: %s' % permission)
-            howMany = self.db.delete(self.collection, id_)
+            howMany = yield self.adb.delete(self.collection, id_)
+            self._document_changed(id_)
             env['DELETED_ITEMS'] = howMany
-            self.run_triggers('delete_%s' % self.document, stdin_data=env, env=env)
+            yield self.run_triggers('delete_%s' % self.document, stdin_data=env, env=env)
         else:
             self.write({'success': False})
         self.write({'success': True})
 
-    def on_timeout(self, cmd, pipe):
-        """Kill a process that is taking too long to complete."""
-        logging.debug('the trigger %s is taking too long: killing it' % ' '.join(cmd))
-        try:
-            pipe.proc.kill()
-        except:
-            pass
-
-    def on_exit(self, returncode, cmd, pipe):
-        """Callback executed when a subprocess execution is over."""
-        self.ioloop.remove_timeout(self.timeout)
-        logging.debug('trigger: %s returncode: %d' % (' '.join(cmd), returncode))
-
-    @gen.coroutine
-    def run_subprocess(self, cmd, stdin_data=None, env=None):
-        """Execute the given action.
-
-        :param cmd: the command to be run with its command line arguments
-        :type cmd: list
+    @staticmethod
+    def _trim_trigger_data(stdin_data):
+        """Remove the list of tickets from the events sent to the triggers: it can be
+        huge, and it's stored with every queued job."""
+        if not isinstance(stdin_data, dict):
+            return stdin_data
+        stdin_data = dict((k, v) for k, v in stdin_data.items() if k != 'tickets' or not isinstance(v, list))
+        if isinstance(stdin_data.get('event'), dict):
+            stdin_data['event'] = dict((k, v) for k, v in stdin_data['event'].items() if k != 'tickets')
+        return stdin_data
+
+    def has_triggers(self, action):
+        """Return True if some scripts are registered for an action.
+
+        :param action: action name
+        :type action: str
 
-        :param stdin_data: data to be sent over stdin
-        :type stdin_data: str
-        :param env: environment of the process
-        :type env: dict
-        """
-        self.ioloop = tornado.ioloop.IOLoop.instance()
-        processed_env = self._dict2env(env)
-        p = process.Subprocess(cmd, close_fds=True, stdin=process.Subprocess.STREAM,
-                stdout=process.Subprocess.STREAM, stderr=process.Subprocess.STREAM, env=processed_env)
-        p.set_exit_callback(lambda returncode: self.on_exit(returncode, cmd, p))
-        self.timeout = self.ioloop.add_timeout(datetime.timedelta(seconds=PROCESS_TIMEOUT),
-                lambda: self.on_timeout(cmd, p))
-        yield gen.Task(p.stdin.write, stdin_data.encode(ENCODING) or b'')
-        p.stdin.close()
-        out, err = yield [gen.Task(p.stdout.read_until_close),
-                gen.Task(p.stderr.read_until_close)]
-        logging.debug('trigger: %s' % ' '.join(cmd))
-        if out:
-            logging.debug('trigger stdout: %s' % out.decode(ENCODING))
-        if err:
-            logging.debug('trigger strerr: %s' % err.decode(ENCODING))
-        raise gen.Return((out, err))
+        :rtype: bool"""
+        triggers = getattr(self, 'triggers', None)
+        return triggers is not None and bool(triggers.registry.scripts(action))
 
     @gen.coroutine
     def run_triggers(self, action, stdin_data=None, env=None):
-        """Asynchronously execute triggers for the given action.
+        """Queue the execution of the triggers for the given action.
 
         :param action: action name; scripts in directory ./data/triggers/{action}.d will be run
         :type action: str
@@ -575,30 +1024,16 @@ class CollectionHandler(BaseHandler):
         :param env: environment of the process
         :type stdin_data: dict
         """
-        if not hasattr(self, 'data_dir'):
+        if getattr(self, 'triggers', None) is None:
             return
         logging.debug('running triggers for action "%s"' % action)
-        stdin_data = stdin_data or {}
+        stdin_data = self._trim_trigger_data(stdin_data or {})
         try:
-            stdin_data = json.dumps(stdin_data)
+            stdin_data = serializer.dumps(stdin_data)
         except:
             stdin_data = '{}'
-        for script in glob.glob(os.path.join(self.data_dir, 'triggers', '%s.d' % action, '*')):
-            if not (os.path.isfile(script) and os.access(script, os.X_OK)):
-                continue
-            out, err = yield gen.Task(self.run_subprocess, [script], stdin_data, env)
-
-    def build_ws_url(self, path, proto='ws', host=None):
-        """Return a WebSocket url from a path."""
-        try:
-            args = '?uuid=%s' % self.get_argument('uuid')
-        except:
-            args = ''
-        if not hasattr(self, 'listen_port'):
-            return None
-        return 'ws://127.0.0.1:%s/ws/%s%s' % (self.listen_port + 1, path, args)
+        yield self.triggers.submit(action, stdin_data=stdin_data, env=self._dict2env(env or {}))
 
-    @gen.coroutine
     def send_ws_message(self, path, message):
         """Send a WebSocket message to all the connected clients.
 
@@ -607,15 +1042,12 @@ class CollectionHandler(BaseHandler):
         :param message: message to send
         :type message: str
         """
+        if getattr(self, 'pubsub', None) is None:
+            return
         try:
-            url = self.build_ws_url(path)
-            if not url:
-                return
-            ws = yield tornado.websocket.websocket_connect(url)
-            ws.write_message(message)
-            ws.close()
+            self.pubsub.publish(ws_clean_url('/ws/%s' % path), message, uuid=self.arguments.get('uuid'))
         except Exception as e:
-            self.logger.error('Error yielding WebSocket message: %s', e)
+            self.logger.error('Error publishing WebSocket message: %s', e)
 
 
 class EventsHandler(CollectionHandler):
@@ -623,39 +1055,230 @@ class EventsHandler(CollectionHandler):
     document = 'event'
     collection = 'events'
 
-    def _mangle_event(self, event):
-        # Some in-place changes to an event
-        if 'tickets' in event:
-            valid_tickets = [t for t in event['tickets'] if not t.get('cancelled')]
-            event['tickets_sold'] = len(valid_tickets)
-            event['total_attendees'] = len([t for t in valid_tickets if t.get('attended')])
-            event['no_tickets_for_sale'] = False
-            try:
-                self._check_sales_datetime(event)
-                self._check_number_of_tickets(event)
-            except InputException:
-                event['no_tickets_for_sale'] = True
+    # counters of the tickets, updated every time a ticket is added, modified or removed
+    counters_fields = ('tickets_sold', 'total_attendees')
+    # fields computed by _mangle_event, and the fields they are computed from
+    computed_fields = counters_fields + ('no_tickets_for_sale',)
+    computed_from_fields = counters_fields + ('number_of_tickets', 'ticket_sales_begin_date',
+                            'ticket_sales_begin_time', 'ticket_sales_end_date', 'ticket_sales_end_time')
+    # attempts to update a ticket whose counted fields are changed in the meantime by someone else
+    update_retries = 5
+
+    # the output of GET /events/:id is cached, and conditional requests are supported
+    cache_documents = True
+
+    # the changes to the tickets are numbered by the changes_seq field of the event, and
+    # stored in this collection (see GET /events/:id/tickets?since=:seq)
+    changes_collection = 'changes'
+    # number of changes kept for every event
+    changes_kept = 10000
+    # seconds after which a change missing from the collection is considered lost
+    changes_gap_timeout = 30
+
+    # persons of the other events of the same group, by event; the entries are valid as long as
+    # the versions of the events of the group don't change.
+    _group_persons_cache = utils.TTLCache(max_size=64, ttl=3600)
+
+    @gen.coroutine
+    def _count_tickets(self, event):
+        """Return the number of valid (not cancelled) tickets and attendees of an event."""
+        if all(key in event for key in self.counters_fields):
+            return event['tickets_sold'], event['total_attendees']
+        # the counters of this event were never computed.
+        if self.separate_tickets:
+            valid_query = {'event_id': event.get('_id'), 'cancelled': {'$ne': True}}
+            tickets_sold, total_attendees = yield [self.adb.count(self.tickets_collection, valid_query),
+                    self.adb.count(self.tickets_collection, dict(valid_query, attended=True))]
+            return tickets_sold, total_attendees
+        counters = utils.ticketCounters(event.get('tickets') or [])
+        return counters['tickets_sold'], counters['total_attendees']
+
+    @gen.coroutine
+    def _update_counters(self, id_, old_ticket=None, new_ticket=None):
+        """Update the counters of an event, after a change to a ticket stored in the tickets collection.
+
+        The event is updated even if the counters didn't change, to increment its version and
+        the sequence of changes.
+
+        :returns: the updated event (only the fields of _event_summary_fields)
+        :rtype: dict"""
+        increment = utils.ticketCountersDelta(old_ticket, new_ticket)
+        increment['changes_seq'] = 1
+        merged, event = yield self.adb.update('events', {'_id': id_}, {}, create=False, increment=increment,
+                                              fields=self._event_summary_fields())
+        return event
+
+    def _event_summary_fields(self):
+        """Return the projection of the fields of an event needed to handle a change to
+        one of its tickets.
+
+        :rtype: dict"""
+        return dict((f, 1) for f in ('title', 'group_id', 'changes_seq', monco.VERSION_FIELD) +
+                    self.computed_from_fields)
+
+    def _event_counters(self, event):
+        """Return the counters of the tickets of an event, sent with the changes to its tickets.
+
+        :param event: the event (or some of its fields) after the change
+        :type event: dict
+
+        :rtype: dict"""
+        return dict((f, event[f]) for f in self.counters_fields if f in (event or {}))
+
+    @gen.coroutine
+    def _trigger_event(self, id_, event, *actions):
+        """Return the event sent to the triggers of a change to one of its tickets: the whole
+        event without its tickets, with the values of the fields of `event` (updated by the change).
+
+        :param id_: the _id of the event
+        :type id_: str
+        :param event: the event (or some of its fields) after the change
+        :type event: dict
+        :param actions: names of the actions
+
+        :returns: the event, or None if no script is registered for the actions
+        :rtype: dict"""
+        if not any(self.has_triggers(action) for action in actions):
+            return None
+        events = yield self.adb.query('events', {'_id': id_}, fields={'tickets': 0})
+        trigger_event = events[0] if events else {}
+        trigger_event.update((k, v) for k, v in (event or {}).items() if k != 'tickets')
+        return trigger_event
+
+    @gen.coroutine
+    def _update_ticket(self, id_, old_ticket, data):
+        """Update a ticket and the counters of its event.
+
+        The counters are incremented considering the old values of the ticket, so the update
+        is applied only if they were not changed in the meantime (e.g.: by another desk);
+        otherwise the ticket is read again, and the update retried.
+
+        :param id_: the _id of the event
+        :type id_: str
+        :param old_ticket: the ticket before the update
+        :type old_ticket: dict
+        :param data: the data to update
+        :type data: dict
+
+        :returns: whether the ticket was updated, the ticket before and after the update and
+                  the event (empty dictionaries if the ticket was not found)
+        :rtype: tuple"""
+        ticket_id = old_ticket.get('_id')
+        for attempt in range(self.update_retries):
+            condition = utils.ticketCountersQuery(old_ticket)
+            if self.separate_tickets:
+                condition.update({'_id': ticket_id, 'event_id': id_})
+                merged, new_ticket = yield self.adb.update(self.tickets_collection, condition, data, create=False)
+                if new_ticket:
+                    event = yield self._update_counters(id_, old_ticket, new_ticket)
+                    return merged, old_ticket, new_ticket, event
+                old_ticket = yield self.adb.getOne(self.tickets_collection, {'_id': ticket_id, 'event_id': id_})
+            else:
+                increment = utils.ticketCountersDelta(old_ticket, dict(old_ticket, **data))
+                increment['changes_seq'] = 1
+                condition['_id'] = ticket_id
+                # only the updated ticket and a few fields of the event are returned.
+                fields = self._event_summary_fields()
+                fields['tickets'] = {'$elemMatch': {'_id': ticket_id}}
+                merged, event = yield self.adb.update('events', {'_id': id_, 'tickets': {'$elemMatch': condition}},
+                        data, updateList='tickets', create=False, increment=increment, fields=fields)
+                if event:
+                    return merged, old_ticket, self._get_ticket_data({'_id': ticket_id}, event.get('tickets') or []), event
+                events = yield self.adb.query('events', {'_id': id_, 'tickets._id': ticket_id},
+                                              fields={'tickets.$': 1})
+                old_ticket = ((events[0].get('tickets') or [None])[0] if events else None)
+            if not old_ticket:
+                break
+        return False, old_ticket or {}, {}, {}
+
+    @gen.coroutine
+    def _event_tickets(self, id_, event=None, query=None):
+        """Return the list of tickets of an event, optionally filtered by a query."""
+        if self.separate_tickets:
+            ticket_query = dict(query or {})
+            ticket_query['event_id'] = id_
+            tickets = yield self.adb.query(self.tickets_collection, ticket_query)
+            return tickets
+        if event is None:
+            event = yield self.adb.get('events', id_)
+        return self._filter_results(event.get('tickets') or [], query)
+
+    @gen.coroutine
+    def _mangle_event(self, event, fields=None):
+        # Some in-place changes to an event; if only some fields were requested,
+        # skip the work needed for the others.
+        has_tickets = 'tickets' in event or (self.separate_tickets and '_id' in event)
+        if fields is None or set(fields).intersection(self.computed_fields):
+            if has_tickets or '_id' in event:
+                event['tickets_sold'], event['total_attendees'] = yield self._count_tickets(event)
+                event['no_tickets_for_sale'] = False
+                try:
+                    self._check_sales_datetime(event)
+                    yield self._check_number_of_tickets(event, tickets_sold=event['tickets_sold'])
+                except InputException:
+                    event['no_tickets_for_sale'] = True
+        if has_tickets or fields is not None:
             if not self.has_permission('event|write'):
                 event['group_id'] = ''
+        if has_tickets and (fields is None or 'tickets' in fields):
             if '_summary' in self.arguments or not self.has_permission('tickets-all|read'):
                 event['tickets'] = []
+            elif self.separate_tickets:
+                event['tickets'] = yield self._event_tickets(event['_id'])
         return event
 
+    def cache_variant(self):
+        # the output of _mangle_event depends on these permissions and arguments.
+        return ''.join(['a' if self.has_permission('admin|all') else '',
+                        'w' if self.has_permission('event|write') else 'r',
+                        's' if '_summary' in self.arguments or not self.has_permission('tickets-all|read') else 't'])
+
+    def cache_state(self, output):
+        # no_tickets_for_sale also depends on the current time: cached entries expire
+        # after --documents_cache_ttl seconds.
+        return 'c' if output.get('no_tickets_for_sale') else 'o'
+
     def filter_get(self, output):
         return self._mangle_event(output)
 
+    def filter_query_options_get_all(self, options):
+        # Also load the fields needed to compute the requested ones.
+        fields = options.get('fields')
+        if not fields or not set(fields).intersection(self.computed_fields):
+            return options
+        fields = [f for f in fields if f not in self.computed_fields]
+        fields.extend(f for f in self.computed_from_fields if f not in fields)
+        options['fields'] = fields
+        return options
+
+    @gen.coroutine
     def filter_get_all(self, output):
+        fields = self._requested_fields()
+        yield [self._mangle_event(event, fields=fields) for event in output.get('events') or []]
         for event in output.get('events') or []:
-            self._mangle_event(event)
+            if fields is not None:
+                for key in list(event.keys()):
+                    if key != '_id' and key not in fields:
+                        del event[key]
         return output
 
+    @gen.coroutine
     def filter_input_post(self, data):
         # Auto-generate the group_id, if missing.
         if 'group_id' not in data:
-            data['group_id'] = self.gen_id()
+            data['group_id'] = yield self.gen_id()
+        # Computed fields, counters and sequences of changes are maintained by the server.
+        for key in self.computed_fields + ('changes_seq',):
+            if key in data:
+                del data[key]
+        return data
+
+    @gen.coroutine
+    def filter_input_post_all(self, data):
+        data = yield self.filter_input_post(data)
+        data.update(utils.ticketCounters(data.get('tickets') or []))
         return data
 
-    filter_input_post_all = filter_input_post
     filter_input_put = filter_input_post
 
     def filter_input_post_tickets(self, data):
@@ -668,22 +1291,88 @@ class EventsHandler(CollectionHandler):
 
     filter_input_put_tickets = filter_input_post_tickets
 
+    @gen.coroutine
+    @authenticated
+    def delete(self, id_=None, resource=None, resource_id=None, **kwargs):
+        yield super(EventsHandler, self).delete(id_, resource, resource_id, **kwargs)
+        # Also remove the tickets of a deleted event.
+        if self.separate_tickets and id_ is not None and not resource and self.get_status() < 400:
+            yield self.adb.delete(self.tickets_collection, {'event_id': id_})
+        if id_ is not None and not resource and self.get_status() < 400:
+            yield self.adb.delete(self.changes_collection, {'event_id': id_})
+        if id_ is not None and not resource and self.tickets_lookup is not None:
+            self.tickets_lookup.invalidate(id_)
+        if id_ is not None and not resource and self.seq_allocator is not None:
+            self.seq_allocator.discard('event_%s_tickets' % id_)
+
+    @gen.coroutine
+    def _group_persons(self, id_, events_ids):
+        """Return the persons registered to some events but not to the given one; every person
+        is identified by its email, and appears only once (with the most recently updated ticket).
+
+        :param id_: the _id of the event
+        :type id_: str
+        :param events_ids: the _id of the other events of the group
+        :type events_ids: list
+
+        :returns: the tickets of the persons, sorted by email
+        :rtype: list"""
+        if self.separate_tickets:
+            these_tickets = yield self.adb.query(self.tickets_collection,
+                                                 {'event_id': id_, 'cancelled': {'$ne': True}}, fields=['email'])
+            pipeline = [{'$match': {'event_id': {'$in': events_ids}, 'email': {'$nin': ['', None]}}},
+                        {'$sort': collections.OrderedDict([('updated_at', -1), ('_id', 1)])},
+                        {'$group': {'_id': '$email', 'person': {'$first': '$$ROOT'}}}]
+            collection = self.tickets_collection
+        else:
+            these_events = yield self.adb.query('events', {'_id': id_}, fields=['tickets.email', 'tickets.cancelled'])
+            these_tickets = [t for t in (these_events[0].get('tickets') or []) if not t.get('cancelled')]
+            pipeline = [{'$match': {'_id': {'$in': events_ids}}},
+                        {'$project': {'tickets': 1}},
+                        {'$unwind': '$tickets'},
+                        {'$match': {'tickets.email': {'$nin': ['', None]}}},
+                        {'$sort': collections.OrderedDict([('tickets.updated_at', -1), ('tickets._id', 1)])},
+                        {'$group': {'_id': '$tickets.email', 'person': {'$first': '$tickets'}}}]
+            collection = 'events'
+        pipeline.append({'$sort': {'_id': 1}})
+        these_emails = set(t.get('email') for t in these_tickets)
+        grouped = yield self.adb.aggregate(collection, pipeline)
+        return [g['person'] for g in grouped if g['_id'] not in these_emails]
+
+    @gen.coroutine
     def handle_get_group_persons(self, id_, resource_id=None):
-        persons = []
-        this_query = {'_id': id_}
-        this_event = self.db.query('events', this_query)[0]
-        group_id = this_event.get('group_id')
+        """Return the persons registered to the other events of the same group, and not to this one.
+
+        The list can be filtered with ?prefix=, matching the beginning of the email, name or
+        surname of the persons, and paginated with ?_skip= and ?_limit=."""
+        this_events = yield self.adb.query('events', {'_id': id_}, fields=['group_id'])
+        group_id = this_events[0].get('group_id') if this_events else None
         if group_id is None:
-            return {'persons': persons}
-        this_persons = [p for p in (this_event.get('tickets') or []) if not p.get('cancelled')]
-        this_emails = [_f for _f in [p.get('email') for p in this_persons] if _f]
-        all_query = {'group_id': group_id}
-        events = self.db.query('events', all_query)
-        for event in events:
-            if id_ is not None and  str(event.get('_id')) == id_:
-                continue
-            persons += [p for p in (event.get('tickets') or []) if p.get('email') and p.get('email') not in this_emails]
-        return {'persons': persons}
+            return {'persons': [], 'total': 0}
+        events = yield self.adb.query('events', {'group_id': group_id}, fields=[monco.VERSION_FIELD],
+                                      sort=[('_id', 1)])
+        # every change to an event (or to its tickets) increments its version.
+        versions = tuple((str(e['_id']), e.get(monco.VERSION_FIELD, 0)) for e in events)
+        cached = self._group_persons_cache.get(id_)
+        if cached is not None and cached[0] == versions:
+            persons = cached[1]
+        else:
+            events_ids = [e['_id'] for e in events if str(e['_id']) != id_]
+            persons = (yield self._group_persons(id_, events_ids)) if events_ids else []
+            self._group_persons_cache[id_] = (versions, persons)
+        prefix = (self.arguments.get('prefix') or '').strip().lower()
+        if prefix:
+            persons = [p for p in persons
+                       if any(str(p.get(f) or '').lower().startswith(prefix) for f in ('email', 'name', 'surname'))]
+        total = len(persons)
+        try:
+            options = self._query_options()
+        except ValueError as e:
+            raise InputException('invalid query options: %s' % e)
+        skip = options.get('skip', 0)
+        if skip or options.get('limit'):
+            persons = persons[skip:skip + options['limit'] if options.get('limit') else None]
+        return {'persons': persons, 'total': total}
 
     def _get_ticket_data(self, ticket_id_or_query, tickets, only_one=True):
         """Filter a list of tickets returning the first item with a given _id
@@ -706,29 +1395,224 @@ class EventsHandler(CollectionHandler):
             return {}
         return matches
 
+    @gen.coroutine
+    def _lookup_ticket(self, id_, query):
+        """Search a ticket of an event using the in-memory indexes of the lookup fields.
+
+        :param id_: the _id of the event
+        :type id_: str
+        :param query: the query, like {'seq_hex': '00002A'}
+        :type query: dict
+
+        :returns: the event and a list with the single matching ticket, or (None, None) if the indexes
+                  can't be used or the ticket was not found
+        :rtype: tuple"""
+        if self.tickets_lookup is None or not self.tickets_lookup.can_lookup(query):
+            return None, None
+        if not self.tickets_lookup.is_indexed(id_):
+            fields = ['_id'] + list(self.tickets_lookup.fields)
+            if self.separate_tickets:
+                tickets = yield self.adb.query(self.tickets_collection, {'event_id': id_}, fields=fields)
+            else:
+                events = yield self.adb.query('events', {'_id': id_}, fields=['tickets.%s' % f for f in fields])
+                if not events:
+                    return None, None
+                tickets = events[0].get('tickets') or []
+            self.tickets_lookup.build(id_, tickets)
+        ticket_ids = self.tickets_lookup.find(id_, query)
+        if not ticket_ids or len(ticket_ids) > 1:
+            return None, None
+        if self.separate_tickets:
+            event = yield self.adb.get('events', id_)
+            ticket = (yield self.adb.getOne(self.tickets_collection, {'_id': ticket_ids[0], 'event_id': id_}))
+            tickets = [ticket] if event and ticket else []
+        else:
+            # only load the fields of the event that are needed, and the matching ticket.
+            fields = self._event_summary_fields()
+            fields['tickets.$'] = 1
+            events = yield self.adb.query('events', {'_id': id_, 'tickets._id': ticket_ids[0]}, fields=fields)
+            event = events[0] if events else {}
+            tickets = event.get('tickets') or []
+        # the indexes may be outdated: check the ticket again.
+        tickets = self._get_ticket_data(query, tickets, only_one=False)
+        if len(tickets) != 1:
+            return None, None
+        return event, tickets
+
+    def _update_lookup(self, id_, old_ticket=None, new_ticket=None):
+        """Update the in-memory indexes, after a change to a ticket; the other processes
+        are notified if the indexed values were changed.
+
+        :param id_: the _id of the event
+        :type id_: str
+        :param old_ticket: the ticket before the change (None if it was just added)
+        :type old_ticket: dict
+        :param new_ticket: the ticket after the change (None if it was removed)
+        :type new_ticket: dict"""
+        if self.tickets_lookup is None:
+            return
+        if self.tickets_lookup.update(id_, old_ticket, new_ticket) and getattr(self, 'pubsub', None) is not None:
+            self.pubsub.publish(lookup.LOOKUP_CHANNEL, str(id_), uuid=self.tickets_lookup.origin)
+
+    @gen.coroutine
+    def _log_changes(self, id_, event, action, tickets):
+        """Store the changes to some tickets of an event.
+
+        :param id_: the _id of the event
+        :type id_: str
+        :param event: the event, as updated by the change (its changes_seq is the number of the last change)
+        :type event: dict
+        :param action: add, update, delete or reset (every ticket was removed)
+        :type action: str
+        :param tickets: the tickets after the change (only the _id, for deleted tickets)
+        :type tickets: list
+
+        :returns: the number of the last change, or None
+        :rtype: int
+        """
+        last_seq = (event or {}).get('changes_seq')
+        if not last_seq or not tickets:
+            return None
+        first_seq = last_seq - len(tickets) + 1
+        now = datetime.datetime.utcnow()
+        changes = [{'event_id': id_, 'seq': seq, 'action': action, 'ticket': ticket, 'created_at': now}
+                   for seq, ticket in zip(range(first_seq, last_seq + 1), tickets)]
+        yield self.adb.addMany(self.changes_collection, changes)
+        # once in a while, remove the oldest changes.
+        if (first_seq - 1) // 100 != last_seq // 100 and last_seq > self.changes_kept:
+            yield self.adb.delete(self.changes_collection,
+                                  {'event_id': id_, 'seq': {'$lte': last_seq - self.changes_kept}})
+        return last_seq
+
+    @gen.coroutine
+    def _tickets_changes(self, id_, since):
+        """Return the changes to the tickets of an event, after a given change.
+
+        Changes are returned in order and without gaps: the ones stored after a missing change
+        are returned when it's found.  If some changes were lost or already removed, reset is True:
+        the whole list of tickets must be loaded again.
+
+        :param id_: the _id of the event
+        :type id_: str
+        :param since: the number of the last known change
+        :type since: str
+
+        :returns: a dictionary with the changes, the number of the last one (seq) and the reset flag
+        :rtype: dict
+        """
+        try:
+            since = int(since)
+        except ValueError:
+            raise InputException('invalid since parameter: %s' % since)
+        events = yield self.adb.query('events', {'_id': id_}, fields=['changes_seq'])
+        if not events:
+            raise InputException('event not found', status=404)
+        last_seq = events[0].get('changes_seq') or 0
+        if since > last_seq or since < last_seq - self.changes_kept:
+            return {'changes': [], 'seq': last_seq, 'reset': True}
+        if since == last_seq:
+            return {'changes': [], 'seq': last_seq, 'reset': False}
+        stored = yield self.adb.query(self.changes_collection, {'event_id': id_, 'seq': {'$gt': since}},
+                                      sort=[('seq', 1)])
+        changes = []
+        for change in stored:
+            if change.get('seq') != since + len(changes) + 1:
+                # a missing change: lost, if the following ones were stored a while ago.
+                created_at = change.get('created_at')
+                if isinstance(created_at, datetime.datetime) and \
+                        datetime.datetime.utcnow() - created_at > datetime.timedelta(seconds=self.changes_gap_timeout):
+                    return {'changes': [], 'seq': last_seq, 'reset': True}
+                break
+            changes.append({'seq': change['seq'], 'action': change.get('action'), 'ticket': change.get('ticket') or {}})
+        if any(change['action'] == 'reset' for change in changes):
+            return {'changes': [], 'seq': changes[-1]['seq'], 'reset': True}
+        return {'changes': changes, 'seq': since + len(changes), 'reset': False}
+
+    @gen.coroutine
     def handle_get_tickets(self, id_, resource_id=None):
         # Return every ticket registered at this event, or the information
         # about a specific ticket.
+        if resource_id is None and 'since' in self.arguments:
+            # only the changes after the given one.
+            return (yield self._tickets_changes(id_, self.arguments['since']))
+        if resource_id is None and any(key in self.arguments for key in ('_filter', '_sort', '_skip', '_limit')):
+            return (yield self._search_tickets(id_))
+        # the other arguments are fields of the tickets that must match; options (like _summary),
+        # operators and the uuid of the client are not.
+        ticket_query = dict((k, v) for k, v in self.arguments.items()
+                            if not k.startswith(('_', '$')) and k != 'uuid')
+        if self.separate_tickets:
+            if resource_id:
+                ticket = yield self.adb.getOne(self.tickets_collection, {'_id': resource_id, 'event_id': id_})
+                return {'ticket': ticket}
+            tickets = yield self._event_tickets(id_, query=ticket_query)
+            return {'tickets': tickets}
         query = {'_id': id_}
-        event = self.db.query('events', query)[0]
+        event = (yield self.adb.query('events', query))[0]
         if resource_id:
             return {'ticket': self._get_ticket_data(resource_id, event.get('tickets') or [])}
-        tickets = self._filter_results(event.get('tickets') or [], self.arguments)
+        tickets = self._filter_results(event.get('tickets') or [], ticket_query)
         return {'tickets': tickets}
 
-    def _check_number_of_tickets(self, event):
+    @gen.coroutine
+    def _search_tickets(self, id_):
+        """Return a page of the tickets of an event matching the _filter argument (see the search module),
+        sorted by the _sort argument and paginated with _skip and _limit, like:
+        ?_filter=attended:false company:ACME*&_sort=surname,name&_skip=20&_limit=10
+
+        :param id_: the _id of the event
+        :type id_: str
+
+        :returns: the tickets and the number of matching tickets, like {"tickets": [...], "total": 42}
+        :rtype: dict"""
+        try:
+            query = search.parse(self.arguments.get('_filter'))
+            options = self._query_options()
+            sort = [(search.check_field(key), direction) for key, direction in options.get('sort') or []]
+        except ValueError as e:
+            raise InputException('invalid filter: %s' % e)
+        # a unique key makes the pages stable.
+        sort.append(('_id', 1))
+        skip = options.get('skip', 0)
+        limit = options.get('limit', 0)
+        if self.separate_tickets:
+            query = {'$and': [query, {'event_id': id_}]} if query else {'event_id': id_}
+            total = yield self.adb.count(self.tickets_collection, query)
+            tickets = yield self.adb.query(self.tickets_collection, query, sort=sort, skip=skip, limit=limit)
+            return {'tickets': tickets, 'total': total}
+        page = [{'$sort': collections.OrderedDict(sort)}, {'$skip': skip}]
+        if limit:
+            page.append({'$limit': limit})
+        pipeline = [{'$match': {'_id': id_}},
+                    {'$project': {'tickets': 1}},
+                    {'$unwind': '$tickets'},
+                    {'$replaceRoot': {'newRoot': '$tickets'}},
+                    {'$match': query},
+                    {'$facet': {'total': [{'$count': 'count'}], 'tickets': page}}]
+        result = yield self.adb.aggregate('events', pipeline)
+        result = result[0] if result else {}
+        total = result['total'][0]['count'] if result.get('total') else 0
+        return {'tickets': result.get('tickets') or [], 'total': total}
+
+    @gen.coroutine
+    def _available_tickets(self, event, tickets_sold=None):
+        """Return the number of tickets that can still be sold, or None if there's no limit."""
         if self.has_permission('admin|all'):
-            return
+            return None
         number_of_tickets = event.get('number_of_tickets')
         if number_of_tickets is None:
-            return
+            return None
         try:
             number_of_tickets = int(number_of_tickets)
         except ValueError:
-            return
-        tickets = event.get('tickets') or []
-        tickets = [t for t in tickets if not t.get('cancelled')]
-        if len(tickets) >= event['number_of_tickets']:
+            return None
+        if tickets_sold is None:
+            tickets_sold = (yield self._count_tickets(event))[0]
+        return max(number_of_tickets - tickets_sold, 0)
+
+    @gen.coroutine
+    def _check_number_of_tickets(self, event, tickets_sold=None):
+        if (yield self._available_tickets(event, tickets_sold=tickets_sold)) == 0:
             raise InputException('no more tickets available')
 
     def _check_sales_datetime(self, event):
@@ -776,36 +1660,104 @@ class EventsHandler(CollectionHandler):
         if now > end_datetime:
             raise InputException('ticket sales has ended')
 
+    @gen.coroutine
     def handle_post_tickets(self, id_, resource_id, data, _skipTriggers=False):
-        event = self.db.query('events', {'_id': id_})[0]
+        event = (yield self.adb.query('events', {'_id': id_}))[0]
         self._check_sales_datetime(event)
-        self._check_number_of_tickets(event)
+        yield self._check_number_of_tickets(event)
         uuid, arguments = self.uuid_arguments
         self._clean_dict(data)
-        data['seq'] = self.get_next_seq('event_%s_tickets' % id_)
+        data['seq'] = yield self.get_next_seq('event_%s_tickets' % id_)
         data['seq_hex'] = '%06X' % data['seq']
-        data['_id'] = ticket_id = self.gen_id()
+        data['_id'] = ticket_id = yield self.gen_id()
         self.add_access_info(data)
         ret = {'action': 'add', 'ticket': data, 'uuid': uuid}
-        merged, doc = self.db.update('events',
-                {'_id': id_},
-                {'tickets': data},
-                operation='appendUnique',
-                create=False)
-        if doc and not _skipTriggers:
-            self.send_ws_message('event/%s/tickets/updates' % id_, json.dumps(ret))
+        if self.separate_tickets:
+            data['event_id'] = id_
+            ticket = yield self.adb.add(self.tickets_collection, data)
+            merged, doc = False, {}
+            if ticket:
+                doc = (yield self._update_counters(id_, None, ticket)) or event
+        else:
+            merged, doc = yield self.adb.update('events',
+                    {'_id': id_},
+                    {'tickets': data},
+                    operation='appendUnique',
+                    create=False,
+                    increment=dict(utils.ticketCountersDelta(None, data), changes_seq=1))
             ticket = self._get_ticket_data(ticket_id, doc.get('tickets') or [])
+        if doc and ticket:
+            self._update_lookup(id_, None, ticket)
+            ret['seq'] = yield self._log_changes(id_, doc, 'add', [ticket])
+            ret['counters'] = self._event_counters(doc)
+        if doc and not _skipTriggers:
+            self.send_ws_message('event/%s/tickets/updates' % id_, serializer.dumps(ret))
             env = dict(ticket)
             env.update({'PERSON_ID': ticket_id, 'TICKED_ID': ticket_id, 'EVENT_ID': id_,
                 'EVENT_TITLE': doc.get('title', ''), 'WEB_USER': self.current_user_info.get('username', ''),
                 'WEB_REMOTE_IP': self.request.remote_ip})
             stdin_data = {'new': ticket,
-                'event': doc,
+                'event': (yield self._trigger_event(id_, doc, 'create_ticket_in_event')),
                 'merged': merged
             }
-            self.run_triggers('create_ticket_in_event', stdin_data=stdin_data, env=env)
+            yield self.run_triggers('create_ticket_in_event', stdin_data=stdin_data, env=env)
         return ret
 
+    @gen.coroutine
+    def import_tickets(self, id_, tickets, batch_size=500):
+        """Add many tickets to an event, with a few bulk operations.
+
+        Sales dates and number of tickets are checked once, and the tickets exceeding the
+        number of available tickets are not added (they are counted as overbooked); triggers
+        are not run and WebSocket clients are not notified.
+
+        :param id_: the _id of the event
+        :type id_: str
+        :param tickets: the tickets to add (modified in place)
+        :type tickets: list
+        :param batch_size: maximum number of tickets written with a single operation
+        :type batch_size: int
+
+        :returns: the number of added tickets, and of the tickets left out because the event is full
+        :rtype: tuple"""
+        events = yield self.adb.query('events', {'_id': id_}, fields={'tickets': 0})
+        if not events:
+            return 0, 0
+        event = events[0]
+        self._check_sales_datetime(event)
+        available = yield self._available_tickets(event)
+        overbooked = 0
+        if available is not None and len(tickets) > available:
+            overbooked = len(tickets) - available
+            tickets = tickets[:available]
+        if not tickets:
+            return 0, overbooked
+        last_seq = yield self.get_next_seq('event_%s_tickets' % id_, increment=len(tickets))
+        ids = yield self.gen_ids(len(tickets))
+        for seq, ticket_id, ticket in zip(range(last_seq - len(tickets) + 1, last_seq + 1), ids, tickets):
+            self._clean_dict(ticket)
+            ticket['seq'] = seq
+            ticket['seq_hex'] = '%06X' % seq
+            ticket['_id'] = ticket_id
+            if self.separate_tickets:
+                ticket['event_id'] = id_
+            self.add_access_info(ticket)
+        for i in range(0, len(tickets), batch_size):
+            batch = tickets[i:i + batch_size]
+            increment = utils.ticketCounters(batch)
+            increment['changes_seq'] = len(batch)
+            if self.separate_tickets:
+                yield self.adb.addMany(self.tickets_collection, batch)
+                merged, event = yield self.adb.update('events', {'_id': id_}, {}, create=False, increment=increment)
+            else:
+                merged, event = yield self.adb.update('events', {'_id': id_}, {'tickets': {'$each': batch}},
+                                                      operation='append', create=False, increment=increment)
+            self._document_changed(id_)
+            yield self._log_changes(id_, event, 'add', batch)
+        self._update_lookup(id_)
+        return len(tickets), overbooked
+
+    @gen.coroutine
     def handle_put_tickets(self, id_, ticket_id, data):
         # Update an existing entry for a ticket registered at this event.
         self._clean_dict(data)
@@ -818,6 +1770,8 @@ class EventsHandler(CollectionHandler):
         if '_searchFor' in arguments:
             _searchFor = arguments['_searchFor']
             del arguments['_searchFor']
+        if self.separate_tickets:
+            data.pop('event_id', None)
         query = dict([('tickets.%s' % k, v) for k, v in arguments.items()])
         query['_id'] = id_
         if ticket_id is not None:
@@ -826,25 +1780,36 @@ class EventsHandler(CollectionHandler):
         else:
             ticket_query = arguments
         old_ticket_data = {}
-        current_event = self.db.query(self.collection, query)
-        if current_event:
-            current_event = current_event[0]
-        else:
-            current_event = {}
+        current_event, matching_tickets = None, None
+        if ticket_id is None:
+            current_event, matching_tickets = yield self._lookup_ticket(id_, ticket_query)
+            if matching_tickets:
+                # from now on, identify the ticket found in the indexes by its _id.
+                query = {'_id': id_, 'tickets._id': matching_tickets[0].get('_id')}
+                ticket_query = {'_id': matching_tickets[0].get('_id')}
+        if matching_tickets is None and self.separate_tickets:
+            current_event = yield self.adb.get(self.collection, id_)
+            matching_tickets = (yield self._event_tickets(id_, query=ticket_query)) if current_event else []
+        elif matching_tickets is None:
+            current_event = yield self.adb.query(self.collection, query)
+            if current_event:
+                current_event = current_event[0]
+            else:
+                current_event = {}
+            tickets = current_event.get('tickets') or []
+            matching_tickets = self._get_ticket_data(ticket_query, tickets, only_one=False)
         self._check_sales_datetime(current_event)
-        tickets = current_event.get('tickets') or []
-        matching_tickets = self._get_ticket_data(ticket_query, tickets, only_one=False)
         nr_matches = len(matching_tickets)
         if nr_matches > 1:
             ret = {'error': True, 'message': 'more than one ticket matched. %s' % _errorMessage, 'query': query,
                    'searchFor': _searchFor, 'uuid': uuid, 'username': self.current_user_info.get('username', '')}
-            self.send_ws_message('event/%s/tickets/updates' % id_, json.dumps(ret))
+            self.send_ws_message('event/%s/tickets/updates' % id_, serializer.dumps(ret))
             self.set_status(400)
             return ret
         elif nr_matches == 0:
             ret = {'error': True, 'message': 'no ticket matched. %s' % _errorMessage, 'query': query,
                    'searchFor': _searchFor, 'uuid': uuid, 'username': self.current_user_info.get('username', '')}
-            self.send_ws_message('event/%s/tickets/updates' % id_, json.dumps(ret))
+            self.send_ws_message('event/%s/tickets/updates' % id_, serializer.dumps(ret))
             self.set_status(400)
             return ret
         else:
@@ -852,13 +1817,16 @@ class EventsHandler(CollectionHandler):
 
         # We have changed the "cancelled" status of a ticket to False; check if we still have a ticket available
         if 'number_of_tickets' in current_event and old_ticket_data.get('cancelled') and not data.get('cancelled'):
-            self._check_number_of_tickets(current_event)
+            yield self._check_number_of_tickets(current_event)
 
         self.add_access_info(data)
-        merged, doc = self.db.update('events', query,
-                data, updateList='tickets', create=False)
-        new_ticket_data = self._get_ticket_data(ticket_query,
-                doc.get('tickets') or [])
+        merged, old_ticket_data, new_ticket_data, doc = yield self._update_ticket(id_, old_ticket_data, data)
+        if self.separate_tickets:
+            doc = doc or current_event
+        changes_seq = None
+        if new_ticket_data:
+            self._update_lookup(id_, old_ticket_data, new_ticket_data)
+            changes_seq = yield self._log_changes(id_, doc, 'update', [new_ticket_data])
         env = dict(new_ticket_data)
         # always takes the ticket_id from the new ticket
         ticket_id = str(new_ticket_data.get('_id'))
@@ -867,46 +1835,78 @@ class EventsHandler(CollectionHandler):
             'WEB_REMOTE_IP': self.request.remote_ip})
         stdin_data = {'old': old_ticket_data,
             'new': new_ticket_data,
-            'event': doc,
+            'event': (yield self._trigger_event(id_, doc, 'update_ticket_in_event', 'attends')),
             'merged': merged
         }
-        self.run_triggers('update_ticket_in_event', stdin_data=stdin_data, env=env)
+        yield self.run_triggers('update_ticket_in_event', stdin_data=stdin_data, env=env)
         if old_ticket_data and old_ticket_data.get('attended') != new_ticket_data.get('attended'):
             if new_ticket_data.get('attended'):
-                self.run_triggers('attends', stdin_data=stdin_data, env=env)
+                yield self.run_triggers('attends', stdin_data=stdin_data, env=env)
 
-        ret = {'action': 'update', '_id': ticket_id, 'ticket': new_ticket_data,
-               'uuid': uuid, 'username': self.current_user_info.get('username', '')}
+        ret = {'action': 'update', '_id': ticket_id, 'ticket': new_ticket_data, 'seq': changes_seq,
+               'counters': self._event_counters(doc), 'uuid': uuid,
+               'username': self.current_user_info.get('username', '')}
         if old_ticket_data != new_ticket_data:
-            self.send_ws_message('event/%s/tickets/updates' % id_, json.dumps(ret))
+            self.send_ws_message('event/%s/tickets/updates' % id_, serializer.dumps(ret))
         return ret
 
+    @gen.coroutine
     def handle_delete_tickets(self, id_, ticket_id):
         # Remove a ticket (or all tickets) from the list of tickets registered at this event.
         uuid, arguments = self.uuid_arguments
-        doc = self.db.query('events', {'_id': id_})
+        doc = yield self.adb.query('events', {'_id': id_})
         ret = {'action': 'delete', '_id': ticket_id, 'uuid': uuid}
-        if doc:
-            ticket = self._get_ticket_data(ticket_id, doc[0].get('tickets') or [])
-            ticket_query = {}
-            if ticket:
+        if doc and self.separate_tickets:
+            ticket_query = {'event_id': id_}
+            ticket = {}
+            if ticket_id is not None:
                 ticket_query['_id'] = ticket_id
-            merged, rdoc = self.db.update('events',
-                    {'_id': id_},
-                    {'tickets': ticket_query},
-                    operation='delete',
-                    create=False)
+                ticket = yield self.adb.getOne(self.tickets_collection, ticket_query)
+            if ticket or ticket_id is None:
+                yield self.adb.delete(self.tickets_collection, ticket_query)
+            merged, rdoc = bool(ticket), doc[0]
+            if ticket:
+                rdoc = (yield self._update_counters(id_, ticket, None)) or rdoc
+        elif doc:
+            ticket = {}
+            if ticket_id is not None:
+                ticket = self._get_ticket_data(ticket_id, doc[0].get('tickets') or [])
+            merged, rdoc = False, doc[0]
+            if ticket_id is None:
+                merged, rdoc = yield self.adb.update('events', {'_id': id_}, {'tickets': {}}, operation='delete',
+                                                     create=False, increment={'changes_seq': 1})
+            elif ticket:
+                # nothing is removed if the ticket was deleted in the meantime.
+                merged, rdoc = yield self.adb.update('events',
+                        {'_id': id_, 'tickets._id': ticket_id},
+                        {'tickets': {'_id': ticket_id}},
+                        operation='delete',
+                        create=False,
+                        increment=dict(utils.ticketCountersDelta(ticket, None), changes_seq=1))
+                if not rdoc:
+                    merged, ticket, rdoc = False, {}, doc[0]
+        if doc and ticket_id is None:
+            # every ticket was removed.
+            merged, rdoc = yield self.adb.update('events', {'_id': id_}, utils.ticketCounters([]), create=False,
+                                                 increment={'changes_seq': 1} if self.separate_tickets else None)
+            self._update_lookup(id_)
+            yield self._log_changes(id_, rdoc, 'reset', [{}])
+        elif doc and ticket:
+            self._update_lookup(id_, ticket, None)
+            ret['seq'] = yield self._log_changes(id_, rdoc, 'delete', [{'_id': ticket.get('_id')}])
+            ret['counters'] = self._event_counters(rdoc)
+        if doc:
             if ticket:
-                self.send_ws_message('event/%s/tickets/updates' % id_, json.dumps(ret))
+                self.send_ws_message('event/%s/tickets/updates' % id_, serializer.dumps(ret))
                 env = dict(ticket)
                 env.update({'PERSON_ID': ticket_id, 'TICKED_ID': ticket_id, 'EVENT_ID': id_,
                     'EVENT_TITLE': rdoc.get('title', ''), 'WEB_USER': self.current_user_info.get('username', ''),
                     'WEB_REMOTE_IP': self.request.remote_ip})
                 stdin_data = {'old': ticket,
-                    'event': rdoc,
+                    'event': (yield self._trigger_event(id_, rdoc, 'delete_ticket_in_event')),
                     'merged': merged
                 }
-                self.run_triggers('delete_ticket_in_event', stdin_data=stdin_data, env=env)
+                yield self.run_triggers('delete_ticket_in_event', stdin_data=stdin_data, env=env)
         return ret
 
 
@@ -915,24 +1915,103 @@ class UsersHandler(CollectionHandler):
     document = 'user'
     collection = 'users'
 
+    def _user_tickets_query(self, user_id, prefix=''):
+        """Return the query matching the tickets created by a user; if the query argument is
+        present, every word must be found in the name, surname or email of the ticket.
+
+        :param user_id: the _id of the user
+        :type user_id: str
+        :param prefix: prefix of the keys, like 'tickets.' for the tickets stored in the events
+        :type prefix: str
+
+        :rtype: dict"""
+        query = {prefix + 'created_by': user_id}
+        words = (self.arguments.get('query') or '').split()
+        if words:
+            query['$and'] = [{'$or': [{prefix + field: {'$regex': re.compile(re.escape(word), re.I)}}
+                                      for field in ('name', 'surname', 'email')]} for word in words]
+        return query
+
+    def _user_tickets_pipeline(self, user_id):
+        """Return the first stages of the aggregation pipeline that extracts the tickets created
+        by a user from the events; every resulting document has the _id and title of the event,
+        and a ticket in the tickets key."""
+        return [{'$match': {'tickets.created_by': user_id}},
+                {'$project': {'title': 1, 'tickets': 1}},
+                {'$unwind': '$tickets'},
+                {'$match': self._user_tickets_query(user_id, prefix='tickets.')}]
+
+    def _user_ticket(self, item):
+        """Return the ticket of an item produced by the pipeline of _user_tickets_pipeline."""
+        ticket = item['tickets']
+        ticket['event_id'] = str(item.get('_id'))
+        ticket['event_title'] = item.get('title') or ''
+        return ticket
+
+    @gen.coroutine
     def filter_get(self, data):
         if 'password' in data:
             del data['password']
-        if '_id' in data:
+        if '_id' in data and '_summary' not in self.arguments:
             # Also add a 'tickets' list with all the tickets created by this user
-            tickets = []
-            events = self.db.query('events', {'tickets.created_by': data['_id']})
-            for event in events:
-                event_title = event.get('title') or ''
-                event_id = str(event.get('_id'))
-                evt_tickets = self._filter_results(event.get('tickets') or [], {'created_by': data['_id']})
-                for evt_ticket in evt_tickets:
-                    evt_ticket['event_title'] = event_title
-                    evt_ticket['event_id'] = event_id
-                tickets.extend(evt_tickets)
+            # (see GET /users/:id/tickets for a paginated list).
+            if self.separate_tickets:
+                tickets = yield self.adb.query(self.tickets_collection, self._user_tickets_query(data['_id']))
+                event_ids = self._events_ids(tickets)
+                self._add_events_titles(tickets, (yield self.adb.query('events', {'_id': {'$in': event_ids}},
+                                                                       fields=['title'])) if event_ids else [])
+            else:
+                items = yield self.adb.aggregate('events', self._user_tickets_pipeline(data['_id']))
+                tickets = [self._user_ticket(item) for item in items]
             data['tickets'] = tickets
         return data
 
+    def _events_ids(self, tickets):
+        """Return the _id of the events of some tickets stored in the tickets collection."""
+        return list(set(t.get('event_id') for t in tickets))
+
+    def _add_events_titles(self, tickets, events):
+        """Add the event_id (as a string) and event_title keys to some tickets stored in the tickets collection.
+
+        :param tickets: the tickets
+        :type tickets: list
+        :param events: the events of the tickets (at least their _id and title)
+        :type events: list
+        """
+        titles = dict((str(event.get('_id')), event.get('title') or '') for event in events)
+        for ticket in tickets:
+            ticket['event_id'] = str(ticket.get('event_id'))
+            ticket['event_title'] = titles.get(ticket['event_id'], '')
+
+    @gen.coroutine
+    def handle_get_tickets(self, id_, resource_id=None):
+        """Return the tickets created by a user, with the title of their events, as {"tickets": [...], "total": N};
+        they can be paginated with ?_skip= and ?_limit=, and searched with ?query="""
+        try:
+            options = self._query_options()
+        except ValueError as e:
+            raise InputException('invalid query options: %s' % e)
+        skip = options.get('skip', 0)
+        limit = options.get('limit', 0)
+        if self.separate_tickets:
+            query = self._user_tickets_query(id_)
+            total = yield self.adb.count(self.tickets_collection, query)
+            tickets = yield self.adb.query(self.tickets_collection, query, sort=[('_id', 1)], skip=skip, limit=limit)
+            event_ids = self._events_ids(tickets)
+            events = (yield self.adb.query('events', {'_id': {'$in': event_ids}}, fields=['title'])) if event_ids else []
+            self._add_events_titles(tickets, events)
+            return {'tickets': tickets, 'total': total}
+        page = [{'$skip': skip}]
+        if limit:
+            page.append({'$limit': limit})
+        pipeline = self._user_tickets_pipeline(id_)
+        # a single pass computes the total and extracts the requested page.
+        pipeline.append({'$facet': {'total': [{'$count': 'count'}], 'tickets': page}})
+        result = yield self.adb.aggregate('events', pipeline)
+        result = result[0] if result else {}
+        total = result['total'][0]['count'] if result.get('total') else 0
+        return {'tickets': [self._user_ticket(item) for item in result.get('tickets') or []], 'total': total}
+
     def filter_get_all(self, data):
         if 'users' not in data:
             return data
@@ -947,20 +2026,22 @@ class UsersHandler(CollectionHandler):
         if id_ is not None:
             if (self.has_permission('user|read') or self.current_user == id_):
                 acl = False
-        super(UsersHandler, self).get(id_, resource, resource_id, acl=acl, **kwargs)
+        yield super(UsersHandler, self).get(id_, resource, resource_id, acl=acl, **kwargs)
 
+    @gen.coroutine
     def filter_input_post_all(self, data):
         username = (data.get('username') or '').strip()
         password = (data.get('password') or '').strip()
         email = (data.get('email') or '').strip()
         if not (username and password):
             raise InputException('missing username or password')
-        res = self.db.query('users', {'username': username})
+        res = yield self.adb.query('users', {'username': username})
         if res:
             raise InputException('username already exists')
         return {'username': username, 'password': utils.hash_password(password),
-                'email': email, '_id': self.gen_id()}
+                'email': email, '_id': (yield self.gen_id())}
 
+    @gen.coroutine
     def filter_input_put(self, data):
         old_pwd = data.get('old_password')
         new_pwd = data.get('new_password')
@@ -968,7 +2049,7 @@ class UsersHandler(CollectionHandler):
             del data['old_password']
         if new_pwd is not None:
             del data['new_password']
-            authorized, user = self.user_authorized(data['username'], old_pwd)
+            authorized, user = yield self.user_authorized(data['username'], old_pwd)
             if not (self.has_permission('user|update') or (authorized and
                                                            self.current_user_info.get('username') == data['username'])):
                 raise InputException('not authorized to change password')
@@ -1000,7 +2081,16 @@ class UsersHandler(CollectionHandler):
             return self.build_error(status=404, message='unable to access the resource')
         if not (self.has_permission('user|update') or self.current_user == id_):
             return self.build_error(status=401, message='insufficient permissions: user|update or current user')
-        super(UsersHandler, self).put(id_, resource, resource_id, **kwargs)
+        yield super(UsersHandler, self).put(id_, resource, resource_id, **kwargs)
+        # permissions and other information about the user may be changed.
+        self.invalidate_user(id_)
+
+    @gen.coroutine
+    @authenticated
+    def delete(self, id_=None, resource=None, resource_id=None, **kwargs):
+        yield super(UsersHandler, self).delete(id_, resource, resource_id, **kwargs)
+        if id_ is not None:
+            self.invalidate_user(id_)
 
 
 class EbAPIImportHandler(BaseHandler):
@@ -1008,7 +2098,7 @@ class EbAPIImportHandler(BaseHandler):
     @gen.coroutine
     @authenticated
     def post(self, *args, **kwargs):
-        reply = dict(total=0, valid=0, merged=0, new_in_event=0)
+        reply = dict(total=0, valid=0, merged=0, new_in_event=0, overbooked=0)
         data = escape.json_decode(self.request.body or '{}')
         oauthToken = data.get('oauthToken')
         eventID = data.get('eventID')
@@ -1024,30 +2114,33 @@ class EbAPIImportHandler(BaseHandler):
             return self.build_error('Error using Eventbrite API: %s' % e)
         if 'event' not in eb_info or 'attendees' not in eb_info:
             return self.build_error('Missing information from Eventbrite API')
-        event_handler = EventsHandler(self.application, self.request)
-        event_handler.db = self.db
-        event_handler.logger = self.logger
-        event_handler.authentication = self.authentication
+        event_handler = self.sub_handler(EventsHandler)
         if create:
-            event_handler.post(_rawData=eb_info['event'])
-            event_in_db = self.db.query('events', {'eb_event_id': eb_info['event']['eb_event_id']})
+            yield event_handler.post(_rawData=eb_info['event'])
+            event_in_db = yield self.adb.query('events', {'eb_event_id': eb_info['event']['eb_event_id']})
             if not event_in_db:
                 return self.build_error('Unable to create a new event')
             targetEventID = event_in_db[0]['_id']
+        tickets = []
         for ticket in eb_info.get('attendees') or []:
             reply['total'] += 1
             ticket['event_id'] = targetEventID
-            try:
-                event_handler.handle_post_tickets(targetEventID, None, ticket, _skipTriggers=True)
-            except Exception as e:
-                self.logger.warn('failed to add a ticket: ' % e)
-            reply['new_in_event'] += 1
+            tickets.append(ticket)
             reply['valid'] += 1
+        try:
+            reply['new_in_event'], reply['overbooked'] = yield event_handler.import_tickets(targetEventID, tickets)
+        except InputException as e:
+            return self.build_error('Unable to add the tickets: %s' % e)
         self.write(reply)
 
 
+@tornado.web.stream_request_body
 class EbCSVImportPersonsHandler(BaseHandler):
-    """Importer for CSV files exported from Eventbrite."""
+    """Importer for CSV files exported from Eventbrite.
+
+    The multipart body is parsed in a separate thread while it's received, and the
+    tickets are written in batches; the WebSocket clients of the event are notified
+    of the progress."""
     csvRemap = {
         'Nome evento': 'event_title',
         'ID evento': 'event_id',
@@ -1079,54 +2172,156 @@ class EbCSVImportPersonsHandler(BaseHandler):
         'Barcode #': 'ebqrcode',
         'Company': 'company'
     }
+    # number of tickets written at once
+    batch_size = 500
 
     @gen.coroutine
-    @authenticated
-    def post(self, **kwargs):
-        # import a CSV list of persons
-        event_handler = EventsHandler(self.application, self.request)
-        event_handler.db = self.db
-        event_handler.logger = self.logger
-        event_id = None
-        deduplicate = False
-        try:
-            event_id = self.get_body_argument('targetEvent')
-        except:
-            pass
-        try:
-            deduplicate = self.tobool(self.get_body_argument('deduplicate'))
-        except:
-            pass
-        if event_id is None:
-            return self.build_error('invalid event')
-        reply = dict(total=0, valid=0, merged=0, new_in_event=0)
-        event_details = event_handler.db.query('events', {'_id': event_id})
+    def prepare(self):
+        self._parser = None
+        yield self.load_user_info()
+        # Without authentication, the body is discarded and post will take care of the request.
+        if self.authentication and not self.current_user:
+            return
+        match = re_boundary.search(self.request.headers.get('Content-Type', ''))
+        if not match:
+            return
+        self._parser = utils.MultipartStreamParser(match.group('boundary'))
+        self._event_handler = self.sub_handler(EventsHandler)
+        self._part = (None, None)
+        self._value = b''
+        self._csv = None
+        self._fields = {}
+        self._event_id = None
+        self._all_persons = None
+        self._tickets = []
+        self._error = None
+        self._received = 0
+        self._reply = dict(total=0, valid=0, merged=0, new_in_event=0, overbooked=0)
+
+    def _parse(self, chunk):
+        """Parse a piece of the body; executed in a separate thread.
+
+        :returns: list of ('field', name, value), ('file', name, filename),
+                  ('rows', filename, rows) and ('stats', filename, stats) tuples
+        :rtype: list"""
+        results = []
+        for event, data, filename in self._parser.feed(chunk):
+            if event == 'part':
+                self._part = (data, filename)
+                self._value = b''
+                if filename is not None:
+                    self._csv = utils.CSVStreamParser(remap=self.csvRemap)
+                    results.append(('file', data, filename))
+            elif event == 'data':
+                if self._csv is not None:
+                    results.append(('rows', self._part[1], self._csv.feed(data)))
+                else:
+                    self._value += data
+            elif event == 'end':
+                if self._csv is not None:
+                    results.append(('rows', self._part[1], self._csv.close()))
+                    results.append(('stats', self._part[1], self._csv.stats))
+                    self._csv = None
+                else:
+                    results.append(('field', self._part[0], self._value.decode('utf-8', 'replace')))
+        return results
+
+    @gen.coroutine
+    def _load_event(self):
+        """Load the target event, once its _id was received."""
+        if self._event_id is not None or self._error or 'targetEvent' not in self._fields:
+            return
+        event_id = self._fields['targetEvent']
+        event_details = yield self.adb.query('events', {'_id': event_id}, fields={'tickets': 0})
         if not event_details:
-            return self.build_error('invalid event')
-        all_persons = set()
-        for ticket in (event_details[0].get('tickets') or []):
-            all_persons.add('%s_%s_%s' % (ticket.get('name'), ticket.get('surname'), ticket.get('email')))
-        for fieldname, contents in self.request.files.items():
-            for content in contents:
-                filename = content['filename']
-                parseStats, persons = utils.csvParse(content['body'], remap=self.csvRemap)
-                reply['total'] += parseStats['total']
-                for person in persons:
+            self._error = 'invalid event'
+            return
+        self._event_id = event_id
+        if self.tobool(self._fields.get('deduplicate')) is True:
+            self._all_persons = set()
+            for ticket in (yield self._event_handler._event_tickets(event_id)):
+                self._all_persons.add(self._person_key(ticket))
+
+    @staticmethod
+    def _person_key(person):
+        """Return the key used to find the duplicated tickets."""
+        return '%s_%s_%s_%s' % (person.get('name'), person.get('surname'), person.get('email'), person.get('order_nr'))
+
+    @gen.coroutine
+    def _flush(self):
+        """Write the parsed tickets, once the target event is known."""
+        if self._event_id is None or self._error:
+            return
+        tickets = []
+        for person in self._tickets:
+            if self._all_persons is not None:
+                duplicate_check = self._person_key(person)
+                if duplicate_check in self._all_persons:
+                    continue
+                self._all_persons.add(duplicate_check)
+            tickets.append(person)
+        self._tickets = []
+        try:
+            added, overbooked = yield self._event_handler.import_tickets(self._event_id, tickets,
+                                                                         batch_size=self.batch_size)
+            self._reply['new_in_event'] += added
+            self._reply['overbooked'] += overbooked
+        except InputException as e:
+            self._error = 'Unable to add the tickets: %s' % e
+            return
+        self._send_progress()
+
+    def _send_progress(self, done=False):
+        progress = dict(self._reply, action='import', done=done, received=self._received,
+                        expected=int(self.request.headers.get('Content-Length') or 0),
+                        uuid=self.arguments.get('uuid'))
+        self._event_handler.send_ws_message('event/%s/tickets/updates' % self._event_id, serializer.dumps(progress))
+
+    @gen.coroutine
+    def _handle(self, results):
+        for kind, name, value in results:
+            if kind == 'field':
+                self._fields[name] = value
+            elif kind == 'file':
+                yield self._load_event()
+            elif kind == 'rows':
+                for person in value:
                     if not person:
                         continue
-                    reply['valid'] += 1
+                    self._reply['valid'] += 1
                     person['attended'] = False
-                    person['from_file'] = filename
+                    person['from_file'] = name
                     self.add_access_info(person)
-                    if deduplicate:
-                        duplicate_check = '%s_%s_%s_%s' % (person.get('name'), person.get('surname'),
-                                                           person.get('email'), person.get('order_nr'))
-                        if duplicate_check in all_persons:
-                            continue
-                        all_persons.add(duplicate_check)
-                    event_handler.handle_post_tickets(event_id, None, person, _skipTriggers=True)
-                    reply['new_in_event'] += 1
-        self.write(reply)
+                    self._tickets.append(person)
+            elif kind == 'stats':
+                self._reply['total'] += value['total']
+        if len(self._tickets) >= self.batch_size:
+            yield self._flush()
+
+    @gen.coroutine
+    def data_received(self, chunk):
+        # the next chunk is read only after this one was parsed and its tickets were written.
+        if self._parser is None or self._error:
+            return
+        self._received += len(chunk)
+        results = yield _import_executor.submit(self._parse, chunk)
+        yield self._handle(results)
+
+    @gen.coroutine
+    @authenticated
+    def post(self, **kwargs):
+        # import a CSV list of persons
+        if self._parser is None:
+            return self.build_error('invalid request: a multipart/form-data body is required')
+        # the fields could come after the files.
+        yield self._load_event()
+        if self._event_id is None and not self._error:
+            self._error = 'invalid event'
+        yield self._flush()
+        if self._error:
+            return self.build_error(self._error)
+        self._send_progress(done=True)
+        self.write(self._reply)
 
 
 class SettingsHandler(BaseHandler):
@@ -1135,10 +2330,27 @@ class SettingsHandler(BaseHandler):
     @authenticated
     def get(self, **kwargs):
         query = self.arguments_tobool()
-        settings = self.db.query('settings', query)
+        settings = yield self.adb.query('settings', query)
         self.write({'settings': settings})
 
 
+class TriggersHandler(BaseHandler):
+    """Handle requests for the list of registered triggers."""
+    @gen.coroutine
+    @authenticated
+    def get(self, **kwargs):
+        if not self.has_permission('triggers|read'):
+            return self.build_error(status=401, message='insufficient permissions: triggers|read')
+        if self.tobool(self.arguments.get('refresh')) is True:
+            self.triggers.registry.refresh(force=True)
+        queued = self.triggers.stats()
+        output = []
+        for action, scripts in sorted(self.triggers.registry.all().items()):
+            output.append({'action': action, 'queued': queued.get(action, 0),
+                           'scripts': [{'script': script, 'mode': mode} for script, mode in scripts]})
+        self.write({'triggers': output})
+
+
 class InfoHandler(BaseHandler):
     """Handle requests for information about the logged in user."""
     @gen.coroutine
@@ -1152,51 +2364,86 @@ class InfoHandler(BaseHandler):
 
 
 class WebSocketEventUpdatesHandler(tornado.websocket.WebSocketHandler):
-    """Manage WebSockets."""
-    def _clean_url(self, url):
-        url = re_slashes.sub('/', url)
-        ridx = url.rfind('?')
-        if ridx != -1:
-            url = url[:ridx]
-        return url
+    """Manage WebSockets.
+
+    Dead connections are detected by the pings sent by Tornado (see the websocket_ping_interval
+    and websocket_ping_timeout settings of the application)."""
+    # sent to a client that is not receiving the messages fast enough: some were dropped,
+    # and it must load again the changes to the tickets.
+    resync_message = '{"action": "resync"}'
+
+    def initialize(self, pubsub=None, max_queue=100, **kwargs):
+        """Initialize the handler.
+
+        :param pubsub: used to relay the messages received from the client
+        :type pubsub: :class:`~pubsub.PubSub`
+        :param max_queue: maximum number of frames waiting to be written to the client
+        :type max_queue: int
+        """
+        self.pubsub = pubsub
+        self.max_queue = max_queue
+        self.event_id = None
+        self.uuid = None
+        self._queued = 0
+        self._resync = False
 
     def open(self, event_id, *args, **kwargs):
         try:
             self.uuid = self.get_argument('uuid')
         except:
             self.uuid = None
-        url = self._clean_url(self.request.uri)
-        logging.debug('WebSocketEventUpdatesHandler.on_open event_id:%s url:%s' % (event_id, url))
-        _ws_clients.setdefault(url, {})
-        if self.uuid and self.uuid not in _ws_clients[url]:
-            _ws_clients[url][self.uuid] = self
-        logging.debug('WebSocketEventUpdatesHandler.on_open %s clients connected' % len(_ws_clients[url]))
+        self.event_id = event_id
+        logging.debug('WebSocketEventUpdatesHandler.on_open event_id:%s uuid:%s' % (event_id, self.uuid))
+        if self.uuid:
+            # a client that reconnects replaces its previous connection.
+            _ws_clients.setdefault(event_id, {})[self.uuid] = self
+        logging.debug('WebSocketEventUpdatesHandler.on_open %s clients connected' %
+                      len(_ws_clients.get(event_id) or {}))
+
+    def on_close(self):
+        clients = _ws_clients.get(self.event_id)
+        if clients is not None and clients.get(self.uuid) is self:
+            del clients[self.uuid]
+            if not clients:
+                del _ws_clients[self.event_id]
+        logging.debug('WebSocketEventUpdatesHandler.on_close event_id:%s uuid:%s' % (self.event_id, self.uuid))
+
+    def send(self, message):
+        """Send a message to the client.  If too many messages are still waiting to be written,
+        it's dropped, and the client will receive the resync message once the others are written.
+
+        :param message: the message
+        :type message: str
+
+        :returns: False if the connection is closed
+        :rtype: bool
+        """
+        if self.ws_connection is None or self.ws_connection.is_closing():
+            return False
+        if self._queued >= self.max_queue:
+            self._resync = True
+            return True
+        self._write(message)
+        return True
+
+    def _write(self, message):
+        self._queued += 1
+        self.write_message(message).add_done_callback(self._written)
+
+    def _written(self, future):
+        self._queued -= 1
+        if future.exception() is not None:
+            return
+        if self._resync and not self._queued:
+            self._resync = False
+            self._write(self.resync_message)
 
     def on_message(self, message):
-        url = self._clean_url(self.request.uri)
+        # Relay the message to the other clients connected to the same channel.
+        url = ws_clean_url(self.request.uri)
         logging.debug('WebSocketEventUpdatesHandler.on_message url:%s' % url)
-        count = 0
-        _to_delete = set()
-        current_uuid = None
-        try:
-            current_uuid = self.get_argument('uuid')
-        except:
-            pass
-        for uuid, client in _ws_clients.get(url, {}).items():
-            if uuid and uuid == current_uuid:
-               continue
-            try:
-                client.write_message(message)
-            except:
-                _to_delete.add(uuid)
-                continue
-            count += 1
-        for uuid in _to_delete:
-            try:
-                del _ws_clients[url][uuid]
-            except KeyError:
-                pass
-        logging.debug('WebSocketEventUpdatesHandler.on_message sent message to %d clients' % count)
+        if self.pubsub is not None:
+            self.pubsub.publish(url, message, uuid=self.uuid)
 
 
 class LoginHandler(RootHandler):
@@ -1224,7 +2471,7 @@ class LoginHandler(RootHandler):
             self.set_status(401)
             self.write({'error': True, 'message': 'missing username or password'})
             return
-        authorized, user = self.user_authorized(username, password)
+        authorized, user = yield self.user_authorized(username, password)
         if authorized and 'username' in user and '_id' in user:
             id_ = str(user['_id'])
             username = user['username']
@@ -1263,6 +2510,52 @@ def run():
             help="URL to MongoDB server", type=str)
     define("db_name", default='eventman',
             help="Name of the MongoDB database to use", type=str)
+    define("separate_tickets", default=False,
+            help="store tickets in their own collection instead of embedding them into the events (see tools/migrate_tickets.py)")
+    define("lookup_fields", default=','.join(lookup.LOOKUP_FIELDS),
+            help="comma-separated list of fields used to search the tickets at check-in (e.g.: by a QR code reader); they are indexed", type=str)
+    define("ids_block_size", default=100,
+            help="number of unique IDs reserved at once by every process", type=int)
+    define("seq_block_size", default=0,
+            help="number of sequence numbers of the tickets reserved at once by every process; with more than one, the tickets created by different processes are not numbered in order (default: 20 with a single worker, otherwise 1)", type=int)
+    define("users_cache_size", default=1024,
+            help="maximum number of users whose information is kept in memory by every process", type=int)
+    define("users_cache_ttl", default=300,
+            help="seconds after which the information about a user is read again from the database", type=int)
+    define("assets_path", default='',
+            help="directory of the webapp files built by tools/build_assets.py; if set, they are served with long-term caching", type=str)
+    define("serializer", default='',
+            help="JSON serializer: 'orjson' or 'json' (default: the fastest available)", type=str)
+    define("documents_cache_size", default=256,
+            help="maximum number of events whose serialized output is kept in memory by every process", type=int)
+    define("documents_cache_ttl", default=60,
+            help="seconds after which the cached output of an event is computed again", type=int)
+    define("ws_batch_delay", default=0.03,
+            help="seconds to wait for more messages for the WebSocket clients, to send them together (0 to disable)", type=float)
+    define("ws_batch_size", default=50,
+            help="maximum number of messages sent together to a WebSocket client", type=int)
+    define("ws_queue_size", default=100,
+            help="maximum number of frames waiting to be written to a WebSocket client; it will then have to resync", type=int)
+    define("ws_ping_interval", default=30,
+            help="seconds between the pings sent to the WebSocket clients", type=int)
+    define("ws_ping_timeout", default=90,
+            help="seconds after which a WebSocket client that doesn't answer the pings is disconnected", type=int)
+    define("db_workers", default=10,
+            help="number of threads used to run queries without blocking the web server", type=int)
+    define("pubsub", default='local',
+            help="how WebSocket messages are shared: 'local' (single process) or 'mongodb' (among processes)", type=str)
+    define("workers", default=1,
+            help="number of processes serving the requests; with more than one, --pubsub=mongodb is implied", type=int)
+    define("triggers_workers", default=4,
+            help="maximum number of trigger scripts running at the same time", type=int)
+    define("triggers_limits", default='',
+            help="maximum number of running scripts for some actions, like: attends=1,create_ticket_in_event=2", type=str)
+    define("triggers_batch_size", default=20,
+            help="maximum number of events sent at once to the trigger scripts in batch mode", type=int)
+    define("triggers_batch_delay", default=1.0,
+            help="seconds to wait for more events before running a trigger script in batch mode", type=float)
+    define("triggers_timeout", default=triggers.PROCESS_TIMEOUT,
+            help="seconds after which a trigger script is killed (or restarted, in persistent mode)", type=int)
     define("authentication", default=False, help="if set to true, authentication is required")
     define("debug", default=False, help="run in debug mode")
     define("config", help="read configuration file",
@@ -1274,14 +2567,34 @@ def run():
     if options.debug:
         logger.setLevel(logging.DEBUG)
 
+    logger.info('JSON serializer: %s', serializer.set_engine(options.serializer))
+
     ssl_options = {}
     if os.path.isfile(options.ssl_key) and os.path.isfile(options.ssl_cert):
         ssl_options = dict(certfile=options.ssl_cert, keyfile=options.ssl_key)
 
     # database backend connector
     db_connector = monco.Monco(url=options.mongo_url, dbName=options.db_name)
-    init_params = dict(db=db_connector, data_dir=options.data_dir, listen_port=options.port,
-            authentication=options.authentication, logger=logger, ssl_options=ssl_options)
+
+    lookup_fields = [f.strip() for f in options.lookup_fields.split(',') if f.strip()]
+    if options.separate_tickets:
+        db_connector.ensureIndexes(CollectionHandler.tickets_collection,
+                [('event_id', '_id'), 'created_by'] + [('event_id', f) for f in lookup_fields])
+    else:
+        db_connector.ensureIndexes('events', ['tickets.created_by'] + ['tickets.%s' % f for f in lookup_fields])
+    db_connector.ensureIndexes(EventsHandler.changes_collection, [('event_id', 'seq')])
+    db_connector.ensureIndexes('events', ['group_id'])
+    try:
+        sequences.ensure_indexes(db_connector, CollectionHandler.counters_collection)
+    except Exception as e:
+        logger.error('unable to create the unique index of the %s collection: %s',
+                     CollectionHandler.counters_collection, e)
+
+    # Compute the counters of the tickets of the events stored by older versions.
+    reconciled = utils.reconcileCounters(db_connector, {'tickets_sold': {'$exists': False}},
+            tickets_collection=CollectionHandler.tickets_collection if options.separate_tickets else None)
+    if reconciled:
+        logger.info('tickets counters computed for %d events', reconciled)
 
     # If not present, we store a user 'admin' with password 'eventman' into the database.
     if not db_connector.query('users', {'username': 'admin'}):
@@ -1299,7 +2612,59 @@ def run():
         db_connector.add('settings',
                 {'setting': 'server_cookie_secret', 'cookie_secret': cookie_secret})
 
-    _ws_handler = (r"/ws/+event/+(?P<event_id>[\w\d_-]+)/+tickets/+updates/?", WebSocketEventUpdatesHandler)
+    # Trigger jobs left by a previous run can be resumed by any process.
+    triggers.TriggerDispatcher.release_jobs(db_connector)
+
+    # Bind the sockets before forking: every process will accept connections from them.
+    sockets = tornado.netutil.bind_sockets(options.port, options.address)
+    if options.workers > 1:
+        # a connection to MongoDB can't be shared among processes: every process will connect again.
+        db_connector.close()
+        process.fork_processes(options.workers)
+        # messages for the WebSocket clients must reach every process.
+        options.pubsub = 'mongodb'
+
+    # the same connector, whose methods return Futures to be yielded in coroutines
+    async_db_connector = monco.AsyncMonco(db_connector, workers=options.db_workers)
+    # messages for the WebSocket clients and other notifications shared among processes
+    if options.pubsub == 'mongodb':
+        ws_pubsub = pubsub.MongoPubSub(db_connector.connect())
+    else:
+        ws_pubsub = pubsub.LocalPubSub()
+    ws_batcher.delay = options.ws_batch_delay
+    ws_batcher.max_size = max(options.ws_batch_size, 1)
+    ws_pubsub.subscribe(ws_deliver)
+    BaseHandler._users_cache = utils.TTLCache(options.users_cache_size, options.users_cache_ttl)
+    ws_pubsub.subscribe(users_cache_deliver)
+    tickets_lookup = lookup.TicketsLookup(lookup_fields)
+    # values of the sequences are reserved in blocks, to save a query for every new ticket.
+    seq_block_size = options.seq_block_size or (20 if options.workers <= 1 else 1)
+    seq_allocator = sequences.SequenceAllocator(async_db_connector, CollectionHandler.counters_collection,
+            block_size=seq_block_size, block_sizes={'ids': options.ids_block_size})
+    ws_pubsub.subscribe(tickets_lookup.deliver)
+    documents_cache = cache.DocumentsCache(options.documents_cache_size, options.documents_cache_ttl)
+    ws_pubsub.subscribe(documents_cache.deliver)
+    triggers_limits = {}
+    for limit in options.triggers_limits.split(','):
+        if '=' in limit:
+            action, value = limit.split('=', 1)
+            triggers_limits[action.strip()] = int(value)
+    trigger_dispatcher = triggers.TriggerDispatcher(options.data_dir, db=async_db_connector,
+            workers=options.triggers_workers, limits=triggers_limits, batch_size=options.triggers_batch_size,
+            batch_delay=options.triggers_batch_delay, timeout=options.triggers_timeout)
+    init_params = dict(db=db_connector, adb=async_db_connector, pubsub=ws_pubsub, triggers=trigger_dispatcher,
+            data_dir=options.data_dir, listen_port=options.port, authentication=options.authentication,
+            logger=logger, ssl_options=ssl_options, separate_tickets=options.separate_tickets,
+            tickets_lookup=tickets_lookup, seq_allocator=seq_allocator, documents_cache=documents_cache)
+
+    _ws_handler = (r"/ws/+event/+(?P<event_id>[\w\d_-]+)/+tickets/+updates/?", WebSocketEventUpdatesHandler,
+                   dict(pubsub=ws_pubsub, max_queue=options.ws_queue_size))
+    # fingerprinted and precompressed files of the webapp (see tools/build_assets.py)
+    _assets_handlers = []
+    if options.assets_path:
+        RootHandler.assets_path = options.assets_path
+        _assets_handlers.append((r'%s(.*)' % assets.ASSETS_URL, AssetsHandler,
+                                 {"path": os.path.join(options.assets_path, 'assets')}))
     _events_path = r"/events/?(?P<id_>[\w\d_-]+)?/?(?P<resource>[\w\d_-]+)?/?(?P<resource_id>[\w\d_-]+)?"
     _users_path = r"/users/?(?P<id_>[\w\d_-]+)?/?(?P<resource>[\w\d_-]+)?/?(?P<resource_id>[\w\d_-]+)?"
     application = tornado.web.Application([
@@ -1314,32 +2679,38 @@ def run():
             (r"/v%s/ebapi" % API_VERSION, EbAPIImportHandler, init_params),
             (r"/settings", SettingsHandler, init_params),
             (r"/v%s/settings" % API_VERSION, SettingsHandler, init_params),
+            (r"/triggers", TriggersHandler, init_params),
+            (r"/v%s/triggers" % API_VERSION, TriggersHandler, init_params),
             (r"/info", InfoHandler, init_params),
             (r"/v%s/info" % API_VERSION, InfoHandler, init_params),
             _ws_handler,
             (r'/login', LoginHandler, init_params),
             (r'/v%s/login' % API_VERSION, LoginHandler, init_params),
-            (r'/logout', LogoutHandler),
-            (r'/v%s/logout' % API_VERSION, LogoutHandler),
+            (r'/logout', LogoutHandler, init_params),
+            (r'/v%s/logout' % API_VERSION, LogoutHandler, init_params),
+            *_assets_handlers,
             (r'/(.*)', tornado.web.StaticFileHandler, {"path": "angular_app"})
         ],
         template_path=os.path.join(os.path.dirname(__file__), "templates"),
         static_path=os.path.join(os.path.dirname(__file__), "static"),
         cookie_secret=cookie_secret,
         login_url='/login',
-        debug=options.debug)
+        websocket_ping_interval=options.ws_ping_interval,
+        websocket_ping_timeout=options.ws_ping_timeout,
+        debug=options.debug,
+        # autoreload is not compatible with multiple processes
+        autoreload=options.debug and options.workers == 1)
     http_server = tornado.httpserver.HTTPServer(application, ssl_options=ssl_options or None)
-    logger.info('Start serving on %s://%s:%d', 'https' if ssl_options else 'http',
+    logger.info('Start serving on %s://%s:%d (pid %d)', 'https' if ssl_options else 'http',
                                                  options.address if options.address else '127.0.0.1',
-                                                 options.port)
-    http_server.listen(options.port, options.address)
-
-    # Also listen on options.port+1 for our local ws connection.
-    ws_application = tornado.web.Application([_ws_handler], debug=options.debug)
-    ws_http_server = tornado.httpserver.HTTPServer(ws_application)
-    ws_http_server.listen(options.port+1, address='127.0.0.1')
-    logger.debug('Starting WebSocket on ws://127.0.0.1:%d', options.port+1)
-    tornado.ioloop.IOLoop.instance().start()
+                                                 options.port, os.getpid())
+    http_server.add_sockets(sockets)
+    ws_pubsub.start()
+    trigger_dispatcher.start()
+    try:
+        tornado.ioloop.IOLoop.instance().start()
+    finally:
+        trigger_dispatcher.stop()
 
 
 if __name__ == '__main__':
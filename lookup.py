@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""EventMan(ager) lookup
+
+In-memory indexes used to quickly find the tickets of an event by some of
+their fields (e.g.: the code read by a QR code scanner at check-in).
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import uuid
+import collections
+
+LOOKUP_FIELDS = ('seq_hex', 'order_nr', 'ebqrcode', 'email')
+
+# channel used to notify the other processes that the indexes of an event are outdated
+LOOKUP_CHANNEL = 'tickets-lookup'
+
+
+def _key(value):
+    """Return the key used to index a value, or None if it can't be indexed."""
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        return None
+    return str(value)
+
+
+class TicketsLookup(object):
+    """Indexes of the tickets of the most recently used events, mapping the values
+    of the lookup fields to the _id of the tickets.
+
+    The indexes of an event are built the first time they are needed, kept up to date
+    by the changes made by this process and dropped when another process modifies
+    the lookup fields of a ticket.  Results must always be verified: the indexes are
+    a hint, not the source of truth."""
+    def __init__(self, fields=LOOKUP_FIELDS, max_events=16):
+        """Initialize the instance.
+
+        :param fields: the indexed fields of the tickets
+        :type fields: list
+        :param max_events: maximum number of events kept in memory
+        :type max_events: int
+        """
+        self.fields = tuple(fields)
+        self.max_events = max_events
+        self.origin = '%s-%s' % (os.getpid(), uuid.uuid4().hex)
+        self._events = collections.OrderedDict()
+
+    def can_lookup(self, query):
+        """Return True if the indexes can be used to answer a query.
+
+        :param query: the query, like {'seq_hex': '00002A'}
+        :type query: dict
+
+        :rtype: bool
+        """
+        if not query or len(query) != 1:
+            return False
+        key, value = list(query.items())[0]
+        return key in self.fields and _key(value) is not None
+
+    def is_indexed(self, event_id):
+        """Return True if the tickets of an event are indexed."""
+        return str(event_id) in self._events
+
+    def _values(self, ticket):
+        """Return the indexed values of a ticket."""
+        values = {}
+        for field in self.fields:
+            key = _key((ticket or {}).get(field))
+            if key is not None:
+                values[field] = key
+        return values
+
+    def _add(self, index, ticket):
+        ticket_id = ticket.get('_id')
+        if ticket_id is None:
+            return
+        ticket_id = str(ticket_id)
+        values = self._values(ticket)
+        index['tickets'][ticket_id] = values
+        for field, key in values.items():
+            index['values'][field].setdefault(key, set()).add(ticket_id)
+
+    def _remove(self, index, ticket_id):
+        values = index['tickets'].pop(str(ticket_id), None) or {}
+        for field, key in values.items():
+            ids = index['values'][field].get(key)
+            if ids is None:
+                continue
+            ids.discard(str(ticket_id))
+            if not ids:
+                del index['values'][field][key]
+
+    def build(self, event_id, tickets):
+        """Index the tickets of an event.
+
+        :param event_id: the _id of the event
+        :type event_id: str
+        :param tickets: every ticket of the event (at least the _id and the lookup fields)
+        :type tickets: list
+        """
+        index = {'values': dict((field, {}) for field in self.fields), 'tickets': {}}
+        for ticket in tickets:
+            self._add(index, ticket)
+        event_id = str(event_id)
+        self._events.pop(event_id, None)
+        self._events[event_id] = index
+        while len(self._events) > self.max_events:
+            self._events.popitem(last=False)
+
+    def find(self, event_id, query):
+        """Return the _id of the tickets of an event matching a query.
+
+        :param event_id: the _id of the event
+        :type event_id: str
+        :param query: the query, with a single lookup field
+        :type query: dict
+
+        :returns: list of _id of the tickets, or None if the event is not indexed
+        :rtype: list
+        """
+        event_id = str(event_id)
+        index = self._events.get(event_id)
+        if index is None or not self.can_lookup(query):
+            return None
+        self._events.move_to_end(event_id)
+        field, value = list(query.items())[0]
+        return sorted(index['values'][field].get(_key(value)) or [])
+
+    def update(self, event_id, old_ticket=None, new_ticket=None):
+        """Update the indexes of an event, when a ticket is added, modified or removed;
+        with no ticket at all, every ticket of the event was removed.
+
+        :param event_id: the _id of the event
+        :type event_id: str
+        :param old_ticket: the ticket before the change (None if it was just added)
+        :type old_ticket: dict
+        :param new_ticket: the ticket after the change (None if it was removed)
+        :type new_ticket: dict
+
+        :returns: True if the indexed values were changed
+        :rtype: bool
+        """
+        if old_ticket is None and new_ticket is None:
+            self.invalidate(event_id)
+            return True
+        changed = (old_ticket is None or new_ticket is None or
+                   self._values(old_ticket) != self._values(new_ticket))
+        index = self._events.get(str(event_id))
+        if index is not None and changed:
+            if old_ticket is not None:
+                self._remove(index, old_ticket.get('_id'))
+            if new_ticket is not None:
+                self._add(index, new_ticket)
+        return changed
+
+    def invalidate(self, event_id):
+        """Drop the indexes of an event."""
+        self._events.pop(str(event_id), None)
+
+    def deliver(self, channel, message, uuid=None):
+        """Drop the indexes of an event modified by another process; to be subscribed to a PubSub."""
+        if channel == LOOKUP_CHANNEL and uuid != self.origin:
+            self.invalidate(message)
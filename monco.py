@@ -19,58 +19,186 @@ limitations under the License.
 
 import re
 import pymongo
+import concurrent.futures
 from bson.objectid import ObjectId
 
-re_objectid = re.compile(r'[0-9a-f]{24}')
+re_objectid = re.compile(r'[0-9a-f]{24}$')
 
-_force_conversion = {
+# field incremented every time a document is updated
+VERSION_FIELD = '_version'
+
+# fields of a ticket (stored in the tickets collection, or in the tickets list of an event)
+# that must be converted.
+TICKET_SCHEMA = {
     '_id': ObjectId,
-    'seq_hex': str,
-    'tickets.seq_hex': str
+    'event_id': ObjectId,
+    'created_by': ObjectId,
+    'updated_by': ObjectId,
+    'seq_hex': str
 }
 
+# Fields whose values are converted before being stored or used in a query, by collection;
+# the fields of the documents in a list (or in a sub-document) are separated by a dot, like
+# tickets._id.  ObjectId means that a string that looks like an ObjectId is converted to an
+# ObjectId, str that the value is stored as a string.  The fields of the None key are
+# converted in every collection; the values of the other fields are never modified.
+SCHEMAS = {
+    None: {'_id': ObjectId},
+    'events': dict([('tickets.%s' % key, type_) for key, type_ in TICKET_SCHEMA.items()] +
+                   [('created_by', ObjectId), ('updated_by', ObjectId)]),
+    'tickets': TICKET_SCHEMA,
+    'changes': dict([('ticket.%s' % key, type_) for key, type_ in TICKET_SCHEMA.items()] +
+                    [('event_id', ObjectId)]),
+    'users': {'created_by': ObjectId, 'updated_by': ObjectId}
+}
 
-def convert_obj(obj):
-    """Convert an object in a format suitable to be stored in MongoDB.
 
-    :param obj: object to convert
+def _to_objectid(value):
+    if isinstance(value, str) and len(value) == 24 and re_objectid.match(value):
+        return ObjectId(value)
+    return value
+
+
+def _to_str(value):
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
+
+
+_converters = {ObjectId: _to_objectid, str: _to_str}
+
+# collection: {path: {key: (converter or None, path of the key)}}, where path is like '' or
+# 'tickets.' and the converter is None for the keys leading to a converted field; built at first use.
+_compiled_schemas = {}
+
+
+def _schema(collection):
+    """Return the converters of the fields of a collection, grouped by the path of the
+    documents they belong to."""
+    levels = _compiled_schemas.get(collection)
+    if levels is None:
+        levels = {'': {}}
+        for key, type_ in list(SCHEMAS[None].items()) + list(SCHEMAS.get(collection, {}).items()):
+            parts = key.split('.')
+            for idx, part in enumerate(parts):
+                path = ''.join('%s.' % p for p in parts[:idx])
+                child = path + part + '.'
+                level = levels.setdefault(path, {})
+                if idx == len(parts) - 1:
+                    level[part] = (_converters[type_], child)
+                else:
+                    level.setdefault(part, (None, child))
+                    levels.setdefault(child, {})
+        _compiled_schemas[collection] = levels
+    return levels
+
+
+def _apply(value, converter):
+    """Convert the value of a field, descending lists and operators (like $in)."""
+    if isinstance(value, dict):
+        new = None
+        for key, item in value.items():
+            if key[:1] != '$':
+                continue
+            converted = _apply(item, converter)
+            if converted is not item:
+                if new is None:
+                    new = dict(value)
+                new[key] = converted
+        return value if new is None else new
+    if isinstance(value, (list, tuple)):
+        new = None
+        for idx, item in enumerate(value):
+            converted = _apply(item, converter)
+            if converted is not item:
+                if new is None:
+                    new = list(value)
+                new[idx] = converted
+        return value if new is None else new
+    return converter(value)
+
+
+def _convert(value, levels, path=''):
+    """Convert the fields of a document, a query or a list of them, found at the given
+    path (like '' or 'tickets.')"""
+    if isinstance(value, dict):
+        level = levels.get(path)
+        if not level:
+            return value
+        keys = ''.join(value)
+        if '.' in keys or '$' in keys:
+            return _convert_query(value, levels, path, level)
+        # a plain document: only look for the fields of the schema.
+        new = None
+        for key in (value if len(value) < len(level) else level):
+            if key not in level or key not in value:
+                continue
+            item = value[key]
+            converter, child = level[key]
+            if converter is not None:
+                converted = _apply(item, converter)
+            else:
+                converted = _convert(item, levels, child)
+            if converted is not item:
+                if new is None:
+                    new = dict(value)
+                new[key] = converted
+        return value if new is None else new
+    if isinstance(value, (list, tuple)):
+        new = None
+        for idx, item in enumerate(value):
+            converted = _convert(item, levels, path)
+            if converted is not item:
+                if new is None:
+                    new = list(value)
+                new[idx] = converted
+        return value if new is None else new
+    return value
+
+
+def _convert_query(value, levels, path, level):
+    """Convert a dictionary with operators or paths as keys."""
+    new = None
+    for key, item in value.items():
+        if key[:1] == '$':
+            # operators (like $or, $elemMatch or $each) and aggregation stages.
+            converted = _convert(item, levels, path)
+        else:
+            entry = level.get(key)
+            if entry is None and '.' in key:
+                # a path, possibly with positional operators and indexes, like tickets.$.created_by
+                parts = [part for part in key.split('.') if not (part[:1] == '$' or part.isdigit())]
+                entry = levels.get(path + ''.join('%s.' % p for p in parts[:-1]), {}).get(parts[-1])
+            if entry is None:
+                continue
+            if entry[0] is not None:
+                converted = _apply(item, entry[0])
+            else:
+                converted = _convert(item, levels, entry[1])
+        if converted is not item:
+            if new is None:
+                new = dict(value)
+            new[key] = converted
+    return value if new is None else new
 
-    :returns: object that can be stored in MongoDB.
-    """
-    if obj is None:
-        return None
-    if isinstance(obj, bool):
-        return obj
-    try:
-        if re_objectid.match(obj):
-            return ObjectId(obj)
-    except:
-        pass
-    return obj
 
+def convert(seq, collection=None, prefix=''):
+    """Convert a document or a query to a format suitable to be stored in MongoDB, following
+    the schema of the collection (see SCHEMAS).
 
-def convert(seq):
-    """Convert an object to a format suitable to be stored in MongoDB,
-    descending lists, tuples and dictionaries (a copy is returned).
+    Only the fields of the schema are inspected: the object is returned as is when nothing needs
+    to be converted, otherwise only the dictionaries and lists containing a converted value are copied.
 
-    :param seq: sequence or object to convert
+    :param seq: document, query, list of documents or aggregation pipeline to convert
+    :type seq: dict or list
+    :param collection: name of the collection
+    :type collection: str
+    :param prefix: path of the object in the documents of the collection, like 'tickets.' for a ticket of an event
+    :type prefix: str
 
     :returns: object that can be stored in MongoDB.
     """
-    if isinstance(seq, dict):
-        d = {}
-        for key, item in seq.items():
-            if key in _force_conversion:
-                try:
-                    d[key] = _force_conversion[key](item)
-                except:
-                    d[key] = item
-            else:
-                d[key] = convert(item)
-        return d
-    if isinstance(seq, (list, tuple)):
-        return [convert(x) for x in seq]
-    return convert_obj(seq)
+    return _convert(seq, _schema(collection), prefix)
 
 
 class MoncoError(Exception):
@@ -94,7 +222,8 @@ class Monco(object):
         'append': '$push',
         'appendUnique': '$addToSet',
         'delete': '$pull',
-        'increment': '$inc'
+        'increment': '$inc',
+        'unset': '$unset'
     }
 
     def __init__(self, dbName, url=None):
@@ -132,6 +261,14 @@ class Monco(object):
         self.db = self.connection[self._dbName]
         return self.db
 
+    def close(self):
+        """Close the connection to the database; the next operation will connect again
+        (e.g.: in a forked process)."""
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+        self.db = None
+
     def getOne(self, collection, query=None):
         """Get a single document with the specified `query`.
 
@@ -143,7 +280,7 @@ class Monco(object):
         :returns: the first document matching the query
         :rtype: dict
         """
-        results = self.query(collection, convert(query))
+        results = self.query(collection, query)
         return results and results[0] or {}
 
     def get(self, collection, _id):
@@ -159,22 +296,33 @@ class Monco(object):
         """
         return self.getOne(collection, {'_id': _id})
 
-    def query(self, collection, query=None, condition='or'):
+    def query(self, collection, query=None, condition='or', fields=None, sort=None, skip=0, limit=0):
         """Get multiple documents matching a query.
 
         :param collection: search for documents in this collection
         :type collection: str
         :param query: search for documents with those attributes
         :type query: dict, list or None
+        :param fields: return only these fields (a list), or a MongoDB projection (a dict)
+        :type fields: list, dict or None
+        :param sort: list of (key, direction) tuples; direction is 1 (ascending) or -1 (descending)
+        :type sort: list or None
+        :param skip: number of documents to skip
+        :type skip: int
+        :param limit: maximum number of documents to return (0 means no limit)
+        :type limit: int
 
         :returns: list of matching documents
         :rtype: list
         """
         db = self.connect()
-        query = convert(query or {})
+        query = convert(query or {}, collection)
         if isinstance(query, (list, tuple)):
             query = {'$%s' % condition: query}
-        return list(db[collection].find(query))
+        cursor = db[collection].find(query, projection=fields or None, skip=skip or 0, limit=limit or 0)
+        if sort:
+            cursor = cursor.sort(sort)
+        return list(cursor)
 
     def add(self, collection, data, _id=None):
         """Insert a new document.
@@ -190,12 +338,81 @@ class Monco(object):
         :rtype: dict
         """
         db = self.connect()
-        data = convert(data)
+        # the driver adds the _id to the document.
+        data = dict(convert(data, collection))
         if _id is not None:
             data['_id'] = _id
         _id = db[collection].insert(data)
         return self.get(collection, _id)
 
+    def addMany(self, collection, data):
+        """Insert multiple new documents.
+
+        :param collection: insert the documents in this collection
+        :type collection: str
+        :param data: the documents to store
+        :type data: list
+
+        :returns: the list of _id of the inserted documents
+        :rtype: list
+        """
+        if not data:
+            return []
+        db = self.connect()
+        data = [dict(doc) for doc in convert(data, collection)]
+        return db[collection].insert_many(data, ordered=False).inserted_ids
+
+    def count(self, collection, query=None):
+        """Count the documents matching a query.
+
+        :param collection: search for documents in this collection
+        :type collection: str
+        :param query: search for documents with those attributes
+        :type query: dict or None
+
+        :returns: number of matching documents
+        :rtype: int
+        """
+        db = self.connect()
+        query = convert(query or {}, collection)
+        return db[collection].count(query)
+
+    def aggregate(self, collection, pipeline):
+        """Run an aggregation pipeline.
+
+        :param collection: run the pipeline on this collection
+        :type collection: str
+        :param pipeline: list of stages, like [{'$match': {...}}, {'$group': {...}}]
+        :type pipeline: list
+
+        :returns: list of the resulting documents
+        :rtype: list
+        """
+        db = self.connect()
+        pipeline = convert(pipeline, collection)
+        return list(db[collection].aggregate(pipeline, allowDiskUse=True))
+
+    def ensureIndexes(self, collection, indexes, unique=False):
+        """Create (if missing) a set of ascending indexes.
+
+        :param collection: create the indexes on this collection
+        :type collection: str
+        :param indexes: each item is a list of keys that are part of the same (compound) index
+        :type indexes: list
+        :param unique: if True, the indexes reject documents with duplicate values
+        :type unique: bool
+
+        :returns: the names of the indexes
+        :rtype: list
+        """
+        db = self.connect()
+        names = []
+        for keys in indexes:
+            if isinstance(keys, str):
+                keys = [keys]
+            names.append(db[collection].create_index([(key, pymongo.ASCENDING) for key in keys], unique=unique))
+        return names
+
     def insertOne(self, collection, data):
         """Insert a document, avoiding duplicates.
 
@@ -208,7 +425,7 @@ class Monco(object):
         :rtype: bool
         """
         db = self.connect()
-        data = convert(data)
+        data = convert(data, collection)
         ret = db[collection].update(data, {'$set': data}, upsert=True)
         return ret['updatedExisting']
 
@@ -223,7 +440,7 @@ class Monco(object):
         return _or
 
     def update(self, collection, _id_or_query, data, operation='update',
-            updateList=None, create=True):
+            updateList=None, create=True, increment=None, fields=None):
         """Update an existing document or create it, if requested.
         _id_or_query can be an ID, a dict representing a query or a list of tuples.
         In the latter case, the tuples are put in OR; a tuple match if all of its
@@ -235,33 +452,48 @@ class Monco(object):
         :type _id_or_query: str or :class:`~bson.objectid.ObjectId` or iterable
         :param data: the updated information to store
         :type data: dict
-        :param operation: operation used to update the document or a portion of it, like a list (update, append, appendUnique, delete, increment)
+        :param operation: operation used to update the document or a portion of it, like a list (update, append, appendUnique, delete, increment, unset)
         :type operation: str
         :param updateList: if set, it's considered the name of a list (the first matching element will be updated)
         :type updateList: str
         :param create: if True, the document is created if no document matches
         :type create: bool
+        :param increment: fields of the document to increment (in the same atomic operation) by the given values
+        :type increment: dict
+        :param fields: return only these fields of the updated document (a list), or a MongoDB projection (a dict)
+        :type fields: list, dict or None
+
+        The version of the document (see VERSION_FIELD) is incremented, too.
 
         :returns: a boolean (True if an existing document was updated) and the document after the update
         :rtype: tuple of (bool, dict)
         """
         db = self.connect()
-        data = convert(data or {})
-        _id_or_query = convert(_id_or_query)
+        data = dict(convert(data or {}, collection, prefix='%s.' % updateList if updateList else ''))
         if isinstance(_id_or_query, (list, tuple)):
             _id_or_query = {'$or': self._buildSearchPattern(data, _id_or_query)}
         elif not isinstance(_id_or_query, dict):
             _id_or_query = {'_id': _id_or_query}
+        _id_or_query = convert(_id_or_query, collection)
         if '_id' in data:
             del data['_id']
+        data.pop(VERSION_FIELD, None)
         operator = self._operations.get(operation)
         if updateList:
             newData = {}
             for key, value in data.items():
                 newData['%s.$.%s' % (updateList, key)] = value
             data = newData
-        res = db[collection].find_and_modify(query=_id_or_query,
-                update={operator: data}, full_response=True, new=True, upsert=create)
+        update = {}
+        if data:
+            update[operator] = data
+        update.setdefault('$inc', {})[VERSION_FIELD] = 1
+        if increment:
+            update['$inc'].update(increment)
+        if isinstance(fields, dict):
+            fields = convert(fields, collection)
+        res = db[collection].find_and_modify(query=_id_or_query, update=update,
+                fields=fields or None, full_response=True, new=True, upsert=create)
         lastErrorObject = res.get('lastErrorObject') or {}
         return lastErrorObject.get('updatedExisting', False), res.get('value') or {}
 
@@ -281,13 +513,14 @@ class Monco(object):
         :rtype: dict
         """
         db = self.connect()
-        data = convert(data or {})
-        query = convert(query)
+        data = dict(convert(data or {}, collection))
         if not isinstance(query, dict):
             query = {'_id': query}
+        query = convert(query, collection)
         if '_id' in data:
             del data['_id']
-        return db[collection].update(query, {'$set': data}, multi=True)
+        data.pop(VERSION_FIELD, None)
+        return db[collection].update(query, {'$set': data, '$inc': {VERSION_FIELD: 1}}, multi=True)
 
     def delete(self, collection, _id_or_query=None, force=False):
         """Remove one or more documents from a collection.
@@ -307,5 +540,34 @@ class Monco(object):
         db = self.connect()
         if not isinstance(_id_or_query, dict):
             _id_or_query = {'_id': _id_or_query}
-        _id_or_query = convert(_id_or_query)
+        _id_or_query = convert(_id_or_query, collection)
         return db[collection].remove(_id_or_query)
+
+
+class AsyncMonco(object):
+    """Non-blocking interface to a Monco instance.
+
+    Every method of the wrapped connector is executed in a pool of threads,
+    and a :class:`~concurrent.futures.Future` is returned instead of the result:
+    it can be yielded in a Tornado coroutine."""
+    def __init__(self, monco, workers=10):
+        """Initialize the instance.
+
+        :param monco: the synchronous connector
+        :type monco: :class:`Monco`
+        :param workers: maximum number of threads used to run the queries
+        :type workers: int
+        """
+        self.monco = monco
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def __getattr__(self, name):
+        method = getattr(self.monco, name)
+        if not callable(method):
+            return method
+
+        def run_in_executor(*args, **kwargs):
+            return self.executor.submit(method, *args, **kwargs)
+        run_in_executor.__name__ = name
+        run_in_executor.__doc__ = method.__doc__
+        return run_in_executor
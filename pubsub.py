@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""EventMan(ager) pubsub
+
+Publish/subscribe backends used to deliver messages (e.g.: updates of the tickets)
+to the WebSocket clients connected to one or more server processes.
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import time
+import uuid
+import logging
+import threading
+import concurrent.futures
+
+import pymongo
+import pymongo.errors
+import tornado.ioloop
+
+
+class PubSub(object):
+    """Base class for publish/subscribe backends: published messages are delivered
+    to the functions registered by the subscribers of this process."""
+    def __init__(self):
+        self._subscribers = []
+        self.ioloop = None
+
+    def subscribe(self, callback):
+        """Register a function that will receive every published message.
+
+        :param callback: called with the channel, the message and the uuid of the sender
+        :type callback: callable
+        """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Remove a function registered with subscribe."""
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def start(self):
+        """Start the backend; must be called from the IOLoop thread."""
+        self.ioloop = tornado.ioloop.IOLoop.current()
+
+    def stop(self):
+        """Stop the backend."""
+        pass
+
+    def deliver(self, channel, message, uuid=None):
+        """Deliver a message to the subscribers of this process."""
+        for callback in list(self._subscribers):
+            try:
+                callback(channel, message, uuid)
+            except Exception as e:
+                logging.error('error delivering a message on channel %s: %s' % (channel, e))
+
+    def publish(self, channel, message, uuid=None):
+        """Publish a message.
+
+        :param channel: name of the channel, e.g. the path of the WebSocket
+        :type channel: str
+        :param message: the message to send
+        :type message: str
+        :param uuid: identifier of the sender, whose clients will not receive the message
+        :type uuid: str
+        """
+        self.deliver(channel, message, uuid)
+
+
+class LocalPubSub(PubSub):
+    """Deliver the messages only inside this process; useful also for tests."""
+    pass
+
+
+class MongoPubSub(PubSub):
+    """Share messages among processes using a capped collection of a MongoDB database.
+
+    Messages are delivered immediately to the subscribers of the publishing process;
+    a thread follows the collection with a tailable cursor to receive the messages
+    published by the other processes."""
+    def __init__(self, db, collection='pubsub', size=16 * 1024 * 1024):
+        """Initialize the instance.
+
+        :param db: the database
+        :type db: :class:`~pymongo.database.Database`
+        :param collection: name of the capped collection
+        :type collection: str
+        :param size: maximum size in bytes of the capped collection
+        :type size: int
+        """
+        super(MongoPubSub, self).__init__()
+        self.db = db
+        self.collection_name = collection
+        self.size = size
+        self.origin = '%s-%s' % (os.getpid(), uuid.uuid4().hex)
+        self._running = False
+        self._thread = None
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def _capped_collection(self):
+        """Return the capped collection, creating it if needed."""
+        try:
+            self.db.create_collection(self.collection_name, capped=True, size=self.size)
+        except pymongo.errors.CollectionInvalid:
+            pass
+        return self.db[self.collection_name]
+
+    def start(self):
+        super(MongoPubSub, self).start()
+        # the origin changes after a fork.
+        self.origin = '%s-%s' % (os.getpid(), uuid.uuid4().hex)
+        collection = self._capped_collection()
+        # Mark our starting point; also, a tailable cursor on an empty capped collection is immediately closed.
+        marker_id = collection.insert_one({'origin': self.origin, 'channel': None}).inserted_id
+        self._running = True
+        self._thread = threading.Thread(target=self._follow, args=(collection, marker_id), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+
+    def _follow(self, collection, last_id):
+        """Read, from a thread, the messages published by other processes.
+
+        ObjectIds generated by different processes are not strictly ordered, so the
+        collection is read in natural (insertion) order, skipping every document up to
+        the last one we've seen."""
+        while self._running:
+            try:
+                seen = collection.find_one({'_id': last_id}) is None
+                cursor = collection.find(cursor_type=pymongo.CursorType.TAILABLE_AWAIT)
+                while self._running and cursor.alive:
+                    for doc in cursor:
+                        if not seen:
+                            seen = doc['_id'] == last_id
+                            continue
+                        last_id = doc['_id']
+                        if doc.get('origin') == self.origin or doc.get('channel') is None:
+                            continue
+                        self.ioloop.add_callback(self.deliver, doc['channel'], doc.get('message'), doc.get('uuid'))
+            except pymongo.errors.PyMongoError as e:
+                logging.error('error reading the pubsub collection: %s' % e)
+            time.sleep(0.1)
+
+    def _store(self, channel, message, uuid):
+        try:
+            self.db[self.collection_name].insert_one({'origin': self.origin, 'channel': channel,
+                                                      'message': message, 'uuid': uuid})
+        except pymongo.errors.PyMongoError as e:
+            logging.error('error publishing on channel %s: %s' % (channel, e))
+
+    def publish(self, channel, message, uuid=None):
+        self.deliver(channel, message, uuid)
+        self._writer.submit(self._store, channel, message, uuid)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""EventMan(ager) search
+
+Compile the filters used to search the tickets into MongoDB queries.
+
+A filter is a list of terms separated by spaces, that must all match:
+
+- word: the word is contained in the name, surname, email, company or job title (case-insensitive)
+- field:value - the field is equal to the value; true and false are booleans (false matches
+  a missing field, too), and the values of the numeric fields are converted to numbers
+- field:value1,value2,... - the field is equal to one of the values
+- field:min..max - the field is in the range (a bound can be omitted: seq:100..)
+- field:prefix* - the field begins with the prefix (case-insensitive)
+- !field:... - negate one of the previous terms
+
+Fields whose names contain spaces are written with underscores (job_title).
+For example: "john attended:false seq:1..100 company:ACME*"
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import re
+
+# fields searched by the terms without a field name
+TEXT_FIELDS = ('name', 'surname', 'email', 'company', 'job title')
+# fields whose values are booleans
+BOOLEAN_FIELDS = ('attended', 'cancelled')
+# fields whose values are numbers
+NUMERIC_FIELDS = ('seq',)
+# names used in the filters (and to sort) for the fields that contain spaces
+FIELD_ALIASES = {'job_title': 'job title'}
+# maximum number of terms of a filter, and length of a term
+MAX_TERMS = 20
+MAX_TERM_LENGTH = 256
+
+re_field = re.compile(r'^[a-zA-Z][\w-]*$')
+
+
+def check_field(field):
+    """Raise ValueError if a field can't be used in a query (e.g.: it's an operator or a path).
+
+    :param field: name of the field, or one of FIELD_ALIASES
+    :type field: str
+
+    :returns: the name of the stored field
+    :rtype: str
+    """
+    if not re_field.match(field or ''):
+        raise ValueError('invalid field name: %s' % field)
+    return FIELD_ALIASES.get(field, field)
+
+
+def _value(field, value):
+    """Convert a value to the type of a field."""
+    if field in BOOLEAN_FIELDS:
+        if value.lower() not in ('true', 'false'):
+            raise ValueError('%s must be true or false' % field)
+        return value.lower() == 'true'
+    if field in NUMERIC_FIELDS:
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError('%s must be a number' % field)
+    return value
+
+
+def _condition(field, value):
+    """Return the condition on a field for the value of a term."""
+    if value.endswith('*') and field not in BOOLEAN_FIELDS and field not in NUMERIC_FIELDS:
+        return {'$regex': re.compile('^' + re.escape(value[:-1]), re.I)}
+    if '..' in value:
+        low, high = value.split('..', 1)
+        condition = {}
+        if low:
+            condition['$gte'] = _value(field, low)
+        if high:
+            condition['$lte'] = _value(field, high)
+        if not condition:
+            raise ValueError('empty range for %s' % field)
+        return condition
+    if ',' in value:
+        return {'$in': [_value(field, v) for v in value.split(',') if v]}
+    value = _value(field, value)
+    if value is False:
+        # tickets without the flag.
+        return {'$ne': True}
+    return value
+
+
+def _negate(condition):
+    if isinstance(condition, dict):
+        if '$in' in condition:
+            return {'$nin': condition['$in']}
+        if '$ne' in condition:
+            return condition['$ne']
+        return {'$not': condition.get('$regex') or condition}
+    return {'$ne': condition}
+
+
+def parse(text):
+    """Compile a filter into a MongoDB query.
+
+    :param text: the filter
+    :type text: str
+
+    :returns: the query
+    :rtype: dict
+    """
+    terms = (text or '').split()
+    if len(terms) > MAX_TERMS:
+        raise ValueError('too many terms (max %d)' % MAX_TERMS)
+    conditions = []
+    for term in terms:
+        if len(term) > MAX_TERM_LENGTH:
+            raise ValueError('term too long: %s...' % term[:20])
+        negate = False
+        if term.startswith('!'):
+            negate = True
+            term = term[1:]
+        if ':' not in term:
+            regex = re.compile(re.escape(term), re.I)
+            condition = {'$or': [{field: {'$regex': regex}} for field in TEXT_FIELDS]}
+            if negate:
+                condition = {'$nor': condition['$or']}
+            conditions.append(condition)
+            continue
+        field, value = term.split(':', 1)
+        field = check_field(field)
+        condition = _condition(field, value)
+        if negate:
+            condition = _negate(condition)
+        conditions.append({field: condition})
+    if not conditions:
+        return {}
+    if len(conditions) == 1:
+        return conditions[0]
+    return {'$and': conditions}
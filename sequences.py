@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""EventMan(ager) sequences
+
+Ever-incrementing counters stored in the database, whose values are reserved
+in blocks and then handed out from memory (hi/lo allocation).
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from tornado import gen, locks
+from pymongo.errors import DuplicateKeyError
+
+COUNTERS_COLLECTION = 'counters'
+
+
+@gen.coroutine
+def reserve(db, seq, count=1, collection=COUNTERS_COLLECTION):
+    """Atomically reserve some values of a sequence, creating it if needed.
+
+    The seq_name field of the collection must have a unique index (see ensure_indexes).
+
+    :param db: the database connector
+    :type db: :class:`~monco.AsyncMonco`
+    :param seq: unique name of the sequence
+    :type seq: str
+    :param count: number of values to reserve
+    :type count: int
+    :param collection: collection storing the sequences
+    :type collection: str
+
+    :returns: the last reserved value
+    :rtype: int
+    """
+    try:
+        merged, doc = yield db.update(collection, {'seq_name': seq}, {'seq': count}, operation='increment')
+    except DuplicateKeyError:
+        # another process created the sequence at the same time: now it exists.
+        merged, doc = yield db.update(collection, {'seq_name': seq}, {'seq': count}, operation='increment')
+    return doc.get('seq', 0)
+
+
+def ensure_indexes(db, collection=COUNTERS_COLLECTION):
+    """Create the unique index on the names of the sequences.
+
+    :param db: the database connector
+    :type db: :class:`~monco.Monco`
+    :param collection: collection storing the sequences
+    :type collection: str
+
+    :returns: the names of the indexes
+    :rtype: list
+    """
+    return db.ensureIndexes(collection, ['seq_name'], unique=True)
+
+
+class SequenceAllocator(object):
+    """Hand out the values of the sequences from blocks reserved in the database.
+
+    Every process reserves its own blocks with a single atomic increment, so that the
+    values are unique among processes, and increasing in the same process; the values
+    of a block left unused when the process exits are lost.  Two processes can
+    hand out the values of their blocks in any order: sequences that must be strictly
+    increasing among processes need a block size of 1.
+
+    Must be used from the IOLoop thread: a block is reserved without blocking it, and
+    the other requests for the same sequence wait for it."""
+    def __init__(self, db, collection=COUNTERS_COLLECTION, block_size=1, block_sizes=None):
+        """Initialize the instance.
+
+        :param db: the database connector
+        :type db: :class:`~monco.AsyncMonco`
+        :param collection: collection storing the sequences
+        :type collection: str
+        :param block_size: number of values reserved at once
+        :type block_size: int
+        :param block_sizes: block sizes of some sequences, by name
+        :type block_sizes: dict
+        """
+        self.db = db
+        self.collection = collection
+        self.block_size = max(block_size, 1)
+        self.block_sizes = block_sizes or {}
+        # name of the sequence: [next value to hand out, last reserved value]
+        self._blocks = {}
+        # name of the sequence: lock held while a block is reserved
+        self._locks = {}
+
+    def _take(self, seq, count):
+        """Hand out values from the current block of a sequence, or return None if they are not enough."""
+        block = self._blocks.get(seq)
+        if block is None or block[1] - block[0] + 1 < count:
+            return None
+        block[0] += count
+        value = block[0] - 1
+        if block[0] > block[1]:
+            del self._blocks[seq]
+        return value
+
+    @gen.coroutine
+    def next(self, seq, count=1):
+        """Return the next values of a sequence.
+
+        :param seq: unique name of the sequence
+        :type seq: str
+        :param count: number of contiguous values
+        :type count: int
+
+        :returns: the last of the values
+        :rtype: int
+        """
+        value = self._take(seq, count)
+        if value is not None:
+            return value
+        lock = self._locks.setdefault(seq, locks.Lock())
+        with (yield lock.acquire()):
+            # a new block may have been reserved while waiting for the lock.
+            value = self._take(seq, count)
+            if value is not None:
+                return value
+            # The rest of the current block is dropped: the values must be contiguous.
+            size = max(self.block_sizes.get(seq, self.block_size), count, 1)
+            last = yield reserve(self.db, seq, size, self.collection)
+            self._blocks[seq] = [last - size + 1, last]
+            return self._take(seq, count)
+
+    def discard(self, seq):
+        """Forget the values reserved for a sequence, e.g. when it's no longer used."""
+        self._blocks.pop(seq, None)
+        self._locks.pop(seq, None)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""EventMan(ager) serializer
+
+Serialize the documents in JSON, for the replies of the handlers, the WebSocket
+messages and the data sent to the triggers.  If available, the orjson module
+(implemented in Rust) is used, otherwise the json module of the standard library.
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import datetime
+from bson.objectid import ObjectId
+
+has_orjson = False
+try:
+    import orjson
+    has_orjson = True
+except ImportError:
+    pass
+
+
+def _default(o):
+    """Serialize the types not supported by the JSON encoders; the output is the same
+    of utils.ImprovedEncoder."""
+    if isinstance(o, (datetime.datetime, datetime.date, datetime.time, datetime.timedelta, ObjectId)):
+        return str(o)
+    if isinstance(o, bytes):
+        return o.decode('utf-8')
+    if isinstance(o, (set, frozenset)):
+        return list(o)
+    raise TypeError('Object of type %s is not JSON serializable' % o.__class__.__name__)
+
+
+def _json_dumpb(obj):
+    return json.dumps(obj, default=_default).encode('utf-8')
+
+
+def _orjson_dumpb(obj):
+    try:
+        # datetimes are passed to _default, to keep the format used by the json module.
+        return orjson.dumps(obj, default=_default,
+                            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        # e.g.: integers that don't fit in 64 bits.
+        return _json_dumpb(obj)
+
+
+# functions serializing an object to UTF-8 encoded JSON, by name.
+ENGINES = {'json': _json_dumpb}
+if has_orjson:
+    ENGINES['orjson'] = _orjson_dumpb
+
+engine = 'orjson' if has_orjson else 'json'
+_dumpb = ENGINES[engine]
+
+
+def register_engine(name, dumpb):
+    """Add an engine, that can then be selected with set_engine.
+
+    :param name: name of the engine
+    :type name: str
+    :param dumpb: function serializing an object to UTF-8 encoded JSON
+    :type dumpb: callable
+    """
+    ENGINES[name] = dumpb
+
+
+def set_engine(name=None):
+    """Select the engine used to serialize the objects.
+
+    :param name: name of the engine; if empty, the fastest available one
+    :type name: str
+
+    :returns: the name of the selected engine
+    :rtype: str
+    """
+    global engine, _dumpb
+    if not name:
+        name = 'orjson' if has_orjson else 'json'
+    if name not in ENGINES:
+        raise ValueError('unknown serializer: %s (available: %s)' % (name, ', '.join(sorted(ENGINES))))
+    engine = name
+    _dumpb = ENGINES[name]
+    return engine
+
+
+def dumpb(obj):
+    """Serialize an object to UTF-8 encoded JSON.
+
+    :param obj: the object to serialize
+    :type obj: dict
+
+    :rtype: bytes
+    """
+    return _dumpb(obj)
+
+
+def dumps(obj):
+    """Serialize an object to a JSON string.
+
+    :param obj: the object to serialize
+    :type obj: dict
+
+    :rtype: str
+    """
+    return _dumpb(obj).decode('utf-8')
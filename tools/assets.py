@@ -0,0 +1 @@
+../assets.py
\ No newline at end of file
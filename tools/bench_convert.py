@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""bench_convert
+
+Measure the time needed to convert documents and queries before they are sent
+to MongoDB, comparing the schema-aware monco.convert with the previous
+implementation, that descended and copied every object.
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import re
+import timeit
+import argparse
+from bson.objectid import ObjectId
+
+import monco
+from bench_serializer import build_event
+
+re_objectid = re.compile(r'[0-9a-f]{24}')
+
+_force_conversion = {
+    '_id': ObjectId,
+    'seq_hex': str,
+    'tickets.seq_hex': str
+}
+
+
+def legacy_convert_obj(obj):
+    if obj is None:
+        return None
+    if isinstance(obj, bool):
+        return obj
+    try:
+        if re_objectid.match(obj):
+            return ObjectId(obj)
+    except:
+        pass
+    return obj
+
+
+def legacy_convert(seq):
+    """The monco.convert function of the previous versions."""
+    if isinstance(seq, dict):
+        d = {}
+        for key, item in seq.items():
+            if key in _force_conversion:
+                try:
+                    d[key] = _force_conversion[key](item)
+                except:
+                    d[key] = item
+            else:
+                d[key] = legacy_convert(item)
+        return d
+    if isinstance(seq, (list, tuple)):
+        return [legacy_convert(x) for x in seq]
+    return legacy_convert_obj(seq)
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Measure the time needed to convert documents for MongoDB.')
+    parser.add_argument('--tickets', type=int, default=10000, help='number of tickets of the event')
+    parser.add_argument('--repeat', type=int, default=10, help='number of runs of each case')
+    args = parser.parse_args()
+    event = build_event(args.tickets)
+    event_id = str(event['_id'])
+    ticket = dict(event['tickets'][0])
+    ticket['event_id'] = event_id
+    cases = [
+        ('event with %d tickets' % args.tickets, 'events', '', event, 1),
+        ('ticket update', 'events', 'tickets.', ticket, 10000),
+        ('ticket query', 'tickets', '', {'event_id': event_id, 'seq_hex': '00002A', 'cancelled': {'$ne': True}}, 10000),
+        ('events query', 'events', '', {'$or': [{'_id': event_id}, {'group_id': {'$in': ['a', 'b']}}]}, 10000)
+    ]
+    print('best of %d runs' % args.repeat)
+    for label, collection, prefix, obj, number in cases:
+        legacy = min(timeit.repeat(lambda: legacy_convert(obj), number=number, repeat=args.repeat)) / number
+        current = min(timeit.repeat(lambda: monco.convert(obj, collection, prefix=prefix),
+                                    number=number, repeat=args.repeat)) / number
+        print('%-25s legacy %10.2f us   schema %10.2f us   %6.1fx' % (label, legacy * 1e6, current * 1e6,
+                                                                       legacy / current if current else 0))
+
+
+if __name__ == '__main__':
+    run()
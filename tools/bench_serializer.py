@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""bench_serializer
+
+Measure the time needed to serialize in JSON an event with many tickets, using
+the available serializers.
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import timeit
+import argparse
+import datetime
+from bson.objectid import ObjectId
+
+import utils
+import serializer
+
+
+def build_event(tickets):
+    """Return an event like the ones stored by the server, with the given number of tickets."""
+    now = datetime.datetime.utcnow()
+    event = {'_id': ObjectId(), 'title': 'Benchmark', 'number_of_tickets': tickets,
+             'begin_date': now, 'end_date': now, 'created_at': now, 'updated_at': now,
+             'created_by': None, 'updated_by': None, 'tickets': []}
+    for seq in range(1, tickets + 1):
+        event['tickets'].append({
+            '_id': '%s-%d-%s' % (str(now.timestamp()).replace('.', '_'), seq, 'x' * 32),
+            'event_id': event['_id'], 'seq': seq, 'seq_hex': '%06X' % seq,
+            'name': 'Name %d' % seq, 'surname': 'Surname %d' % seq, 'email': 'attendee%d@example.com' % seq,
+            'company': 'Company', 'job title': 'Developer', 'attended': bool(seq % 2), 'cancelled': False,
+            'created_at': now, 'updated_at': now, 'created_by': None, 'updated_by': None})
+    return event
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Measure the time needed to serialize an event in JSON.')
+    parser.add_argument('--tickets', type=int, default=10000, help='number of tickets of the event')
+    parser.add_argument('--repeat', type=int, default=10, help='number of serializations of each engine')
+    args = parser.parse_args()
+    event = {'event': build_event(args.tickets)}
+    # json.dumps with utils.ImprovedEncoder is what Tornado used to do for a dictionary.
+    candidates = [('json.dumps (ImprovedEncoder)', lambda: json.dumps(event, cls=utils.ImprovedEncoder))]
+    for name in sorted(serializer.ENGINES):
+        candidates.append(('serializer %s' % name, lambda name=name: serializer.ENGINES[name](event)))
+    print('event with %d tickets, best of %d runs' % (args.tickets, args.repeat))
+    for label, func in candidates:
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print('%-30s %8.2f ms %10d bytes' % (label, best * 1000, len(func())))
+
+
+if __name__ == '__main__':
+    run()
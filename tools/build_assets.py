@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""build_assets
+
+Build the fingerprinted and precompressed files of the webapp, to be served
+by the server started with --assets_path.
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import shutil
+import argparse
+import assets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Build the fingerprinted and precompressed files of the webapp.')
+    parser.add_argument('--root', default=ROOT, help='directory of the server (default: %(default)s)')
+    parser.add_argument('--output', default=os.path.join(ROOT, 'assets-build'),
+                        help='directory where the files are written; its content is replaced (default: %(default)s)')
+    parser.add_argument('--no-compress', dest='compress', action='store_false', default=True,
+                        help="don't write the compressed variants of the files")
+    args = parser.parse_args()
+    if os.path.isdir(args.output):
+        shutil.rmtree(args.output)
+    manifest = assets.build(args.root, args.output, compress=args.compress)
+    print('%d files fingerprinted in %s%s' % (len(manifest), args.output,
+                                              '' if assets.has_brotli else ' (brotli not available: gzip only)'))
+    print('start the server with --assets_path=%s' % args.output)
+
+
+if __name__ == '__main__':
+    run()
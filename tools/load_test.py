@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""load_test
+
+Simulate the check-in rush at the opening of an event: start the server (and, unless
+another MongoDB is specified, a throwaway mongod), seed an event with many tickets, then
+let some check-in desks mark the tickets as attended (like qrcode_reader.py does) while
+some browsers receive the updates on the WebSocket; throughput and latency percentiles
+of every endpoint are printed as JSON.
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import shutil
+import signal
+import socket
+import logging
+import argparse
+import datetime
+import tempfile
+import subprocess
+import collections
+import urllib.parse
+
+from tornado import gen, ioloop, httpclient, websocket
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SERVER = os.path.join(ROOT, 'eventman_server.py')
+
+# names of the measured endpoints, in the report
+CHECKIN = 'PUT /v1.0/events/:event_id/tickets/?seq_hex='
+GET_EVENT = 'GET /v1.0/events/:event_id'
+WS_UPDATE = 'WebSocket update (from the PUT to the browser)'
+
+logger = logging.getLogger('load_test')
+
+
+def percentile(values, pct):
+    """Return a percentile of a sorted list of values (nearest-rank method).
+
+    :param values: the sorted values
+    :type values: list
+    :param pct: the percentile, from 0 to 100
+    :type pct: float
+
+    :returns: the value, or None if the list is empty
+    """
+    if not values:
+        return None
+    rank = max(int(math.ceil(pct / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+class Stats(object):
+    """Latencies and errors of the requests to an endpoint."""
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.begin = None
+        self.end = None
+
+    def add(self, begin, end, error=False):
+        """Record a request, with the times it was sent and answered."""
+        if self.begin is None or begin < self.begin:
+            self.begin = begin
+        if self.end is None or end > self.end:
+            self.end = end
+        self.latencies.append(end - begin)
+        if error:
+            self.errors += 1
+
+    def report(self):
+        """Return a summary of the requests: throughput per second and latencies in milliseconds.
+
+        :rtype: dict
+        """
+        latencies = sorted(self.latencies)
+        seconds = (self.end - self.begin) if latencies else 0
+
+        def _ms(value):
+            return round(value * 1000, 2) if value is not None else None
+        return {
+            'requests': len(latencies),
+            'errors': self.errors,
+            'seconds': round(seconds, 3),
+            'throughput': round(len(latencies) / seconds, 1) if seconds else None,
+            'mean_ms': _ms(sum(latencies) / len(latencies)) if latencies else None,
+            'p50_ms': _ms(percentile(latencies, 50)),
+            'p95_ms': _ms(percentile(latencies, 95)),
+            'p99_ms': _ms(percentile(latencies, 99)),
+            'max_ms': _ms(latencies[-1]) if latencies else None
+        }
+
+
+class Client(object):
+    """A check-in desk or a browser, with its own session."""
+    def __init__(self, url, stats):
+        self.url = url
+        self.stats = stats
+        self.uuid = uuid.uuid4().hex
+        self.cookie = ''
+        self.http = httpclient.AsyncHTTPClient()
+
+    @gen.coroutine
+    def fetch(self, method, path, data=None, endpoint=None, **kwargs):
+        """Send a request; if endpoint is given, its latency is recorded under that name.
+
+        :returns: the response
+        :rtype: :class:`~tornado.httpclient.HTTPResponse`
+        """
+        headers = kwargs.pop('headers', {})
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        body = kwargs.pop('body', None)
+        if data is not None:
+            body = json.dumps(data)
+            headers['Content-Type'] = 'application/json'
+        kwargs.setdefault('request_timeout', 60)
+        begin = time.time()
+        response = yield self.http.fetch(urllib.parse.urljoin(self.url, path), method=method, headers=headers,
+                                         body=body, raise_error=False, validate_cert=False, **kwargs)
+        if endpoint:
+            self.stats[endpoint].add(begin, time.time(), error=response.code >= 400 or response.code == 599)
+        return response
+
+    @gen.coroutine
+    def login(self, username, password):
+        response = yield self.fetch('POST', '/v1.0/login', {'username': username, 'password': password})
+        if response.code != 200:
+            raise RuntimeError('login failed for user %s: %s' % (username, response.code))
+        self.cookie = '; '.join(c.split(';', 1)[0] for c in response.headers.get_list('Set-Cookie'))
+
+
+def _json(response):
+    if response.code >= 400 or response.code == 599:
+        raise RuntimeError('%s %s: %s %s' % (response.request.method, response.request.url, response.code,
+                                             (response.body or b'')[:200]))
+    return json.loads(response.body.decode('utf-8'))
+
+
+@gen.coroutine
+def seed(client, tickets):
+    """Create an event and import its tickets, with a CSV file like the ones exported from Eventbrite.
+
+    :returns: the _id of the event and the seq_hex of its tickets
+    :rtype: tuple"""
+    event = _json((yield client.fetch('POST', '/v1.0/events', {
+        'title': 'Load test %s' % datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'begin_date': datetime.datetime.now().isoformat(), 'end_date': datetime.datetime.now().isoformat()})))
+    event_id = event['_id']
+    rows = ['First Name,Last Name,Email,Company']
+    for nr in range(1, tickets + 1):
+        rows.append('Name%d,Surname%d,attendee%d@example.com,Company %d' % (nr, nr, nr, nr % 100))
+    boundary = uuid.uuid4().hex
+    body = ('--%s\r\nContent-Disposition: form-data; name="targetEvent"\r\n\r\n%s\r\n'
+            '--%s\r\nContent-Disposition: form-data; name="file"; filename="load_test.csv"\r\n'
+            'Content-Type: text/csv\r\n\r\n%s\r\n--%s--\r\n') % (boundary, event_id, boundary,
+                                                               '\r\n'.join(rows), boundary)
+    _json((yield client.fetch('POST', '/v1.0/ebcsvpersons', body=body.encode('utf-8'), request_timeout=600,
+                              headers={'Content-Type': 'multipart/form-data; boundary=%s' % boundary})))
+    result = _json((yield client.fetch('GET', '/v1.0/events/%s/tickets' % event_id, request_timeout=600)))
+    return event_id, [t['seq_hex'] for t in result['tickets']]
+
+
+@gen.coroutine
+def desk(client, event_id, codes, sent, username, think_time):
+    """Check in the tickets taken from codes, one at a time."""
+    path = '/v1.0/events/%s/tickets/?' % event_id
+    while codes:
+        code = codes.popleft()
+        params = {'seq_hex': code, '_errorMessage': 'code: %s' % code, '_searchFor': 'seq_hex:%s' % code,
+                  'uuid': client.uuid}
+        data = {'attended': True, 'checked_in_by': username, 'checkin_datetime': datetime.datetime.now().isoformat()}
+        sent[code] = time.time()
+        yield client.fetch('PUT', path + urllib.parse.urlencode(params), data, endpoint=CHECKIN)
+        if think_time:
+            yield gen.sleep(think_time)
+
+
+@gen.coroutine
+def browser(client, event_id, sent, received):
+    """Load the event, then connect to its WebSocket; returns the connection."""
+    yield client.fetch('GET', '/v1.0/events/%s' % event_id, endpoint=GET_EVENT, request_timeout=600)
+    url = urllib.parse.urljoin(client.url.replace('http', 'ws', 1),
+                               '/ws/event/%s/tickets/updates?uuid=%s' % (event_id, client.uuid))
+    request = httpclient.HTTPRequest(url, headers={'Cookie': client.cookie}, validate_cert=False)
+    conn = yield websocket.websocket_connect(request, on_message_callback=lambda message:
+                                             _ws_message(client, message, sent, received))
+    return conn
+
+
+def _ws_message(client, message, sent, received):
+    if message is None:
+        return
+    now = time.time()
+    message = json.loads(message)
+    for item in message.get('batch') or [message]:
+        code = (item.get('ticket') or {}).get('seq_hex')
+        if item.get('action') == 'update' and code in sent:
+            client.stats[WS_UPDATE].add(sent[code], now)
+            received[0] += 1
+
+
+@gen.coroutine
+def load_test(args, url):
+    stats = collections.defaultdict(Stats)
+    admin = Client(url, stats)
+    yield admin.login(args.username, args.password)
+    logger.info('seeding an event with %d tickets', args.tickets)
+    begin = time.time()
+    event_id, codes = yield seed(admin, args.tickets)
+    seed_seconds = time.time() - begin
+    random.shuffle(codes)
+    codes = collections.deque(codes[:args.checkins or len(codes)])
+    checkins = len(codes)
+    sent = {}
+    received = [0]
+
+    logger.info('connecting %d browsers', args.browsers)
+    browsers = [Client(url, stats) for _ in range(args.browsers)]
+    yield [b.login(args.username, args.password) for b in browsers]
+    connections = yield [browser(b, event_id, sent, received) for b in browsers]
+
+    logger.info('checking in %d tickets from %d desks', checkins, args.desks)
+    desks = [Client(url, stats) for _ in range(args.desks)]
+    yield [d.login(args.username, args.password) for d in desks]
+    begin = time.time()
+    yield [desk(d, event_id, codes, sent, args.username, args.think_time) for d in desks]
+    duration = time.time() - begin
+    expected = (len(stats[CHECKIN].latencies) - stats[CHECKIN].errors) * args.browsers
+    deadline = time.time() + args.ws_wait
+    while received[0] < expected and time.time() < deadline:
+        yield gen.sleep(0.05)
+    for conn in connections:
+        conn.close()
+
+    endpoints = dict((name, s.report()) for name, s in stats.items() if s.latencies)
+    if WS_UPDATE in endpoints or args.browsers:
+        endpoints.setdefault(WS_UPDATE, Stats().report())
+        endpoints[WS_UPDATE]['expected'] = expected
+    return {
+        'config': {'tickets': args.tickets, 'checkins': checkins, 'desks': args.desks, 'browsers': args.browsers,
+                   'think_time': args.think_time, 'separate_tickets': args.separate_tickets,
+                   'workers': args.workers, 'database': None if args.url else (args.mongo_url or 'temporary mongod'),
+                   'url': args.url or None, 'server_args': args.server_args},
+        'seed_seconds': round(seed_seconds, 3),
+        'checkin_seconds': round(duration, 3),
+        'checkins_per_second': round(checkins / duration, 1) if duration else None,
+        'endpoints': endpoints
+    }
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _drop_database(args):
+    import pymongo
+    client = pymongo.MongoClient(args.mongo_url)
+    client.drop_database(args.db_name)
+    client.close()
+
+
+def _wait_port(proc, port, name):
+    """Wait until a process accepts connections on a port."""
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('%s exited with status %s (see --server-log)' % (name, proc.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    stop(proc)
+    raise RuntimeError('%s is not answering on port %d' % (name, port))
+
+
+def start_mongod(args, db_path, log):
+    """Start a throwaway mongod on a free port; returns the process and its URL."""
+    port = _free_port()
+    cmd = [args.mongod, '--dbpath', db_path, '--port', str(port), '--bind_ip', '127.0.0.1', '--nounixsocket']
+    logger.info('starting %s', ' '.join(cmd))
+    try:
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    except FileNotFoundError:
+        raise RuntimeError('%s not found: install MongoDB, or use --mongo-url' % args.mongod)
+    _wait_port(proc, port, 'mongod')
+    return proc, 'mongodb://127.0.0.1:%d/' % port
+
+
+def start_server(args, mongo_url, data_dir, log):
+    """Start the server on a free port; returns the process and its URL."""
+    port = _free_port()
+    cmd = [sys.executable, SERVER, '--port=%d' % port, '--address=127.0.0.1', '--data_dir=%s' % data_dir,
+           '--mongo_url=%s' % mongo_url, '--db_name=%s' % args.db_name, '--authentication=true',
+           '--ssl_cert=', '--ssl_key=', '--workers=%d' % args.workers,
+           '--separate_tickets=%s' % ('true' if args.separate_tickets else 'false')] + args.server_args
+    logger.info('starting %s', ' '.join(cmd))
+    # a new session, to stop the forked workers too.
+    proc = subprocess.Popen(cmd, cwd=ROOT, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    _wait_port(proc, port, 'the server')
+    return proc, 'http://127.0.0.1:%d/' % port
+
+
+def stop(proc):
+    """Stop a process started by this tool."""
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+    except ProcessLookupError:
+        pass
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Simulate the check-in rush of an event, and print throughput '
+                                     'and latency percentiles of every endpoint as JSON.')
+    parser.add_argument('--tickets', type=int, default=2000, help='number of tickets of the event')
+    parser.add_argument('--checkins', type=int, default=0,
+                        help='number of tickets checked in, in random order (default: all of them)')
+    parser.add_argument('--desks', type=int, default=10, help='number of concurrent check-in desks')
+    parser.add_argument('--browsers', type=int, default=20, help='number of browsers receiving the updates')
+    parser.add_argument('--think-time', type=float, default=0,
+                        help='seconds waited by every desk between two check-ins')
+    parser.add_argument('--ws-wait', type=float, default=10,
+                        help='maximum seconds waited for the last WebSocket updates, after the check-ins')
+    parser.add_argument('--mongod', default='mongod',
+                        help='mongod executable, started with a temporary database (default: %(default)s)')
+    parser.add_argument('--mongo-url',
+                        help='use this MongoDB (e.g.: mongodb://localhost:27017/) instead of a throwaway mongod')
+    parser.add_argument('--db-name', default='eventman_load_test',
+                        help='database used by the server; with --mongo-url, it is DROPPED before and after the test')
+    parser.add_argument('--keep-db', action='store_true', help="with --mongo-url, don't drop the database after the test")
+    parser.add_argument('--separate-tickets', action='store_true', help='run the server with --separate_tickets')
+    parser.add_argument('--workers', type=int, default=1, help='run the server with --workers')
+    parser.add_argument('--server-log', default=os.devnull,
+                        help='file where the output of the server (and of mongod) is written')
+    parser.add_argument('--url', help="test an already running server (e.g.: http://localhost:5242/), "
+                        "creating a new event, instead of starting one")
+    parser.add_argument('--username', default='admin', help='user of the desks and browsers')
+    parser.add_argument('--password', default='eventman', help='password of the user')
+    parser.add_argument('--output', help='also write the report to this file')
+    parser.add_argument('server_args', nargs='*', help='more arguments for the server, after --')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    if args.checkins > args.tickets:
+        parser.error('--checkins can not be greater than --tickets')
+    # enough connections for all the clients: requests must not wait in the queue of the client.
+    httpclient.AsyncHTTPClient.configure(None, max_clients=args.desks + args.browsers + 10)
+
+    proc = mongod = data_dir = db_path = log = None
+    url = args.url
+    try:
+        if not url:
+            # an empty data directory: no trigger is run.
+            data_dir = tempfile.mkdtemp(prefix='eventman-load-test-')
+            log = open(args.server_log, 'a')
+            mongo_url = args.mongo_url
+            if mongo_url:
+                _drop_database(args)
+            else:
+                # in memory, if possible.
+                db_path = tempfile.mkdtemp(prefix='eventman-load-test-mongod-',
+                                           dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+                mongod, mongo_url = start_mongod(args, db_path, log)
+            proc, url = start_server(args, mongo_url, data_dir, log)
+        report = ioloop.IOLoop.current().run_sync(lambda: load_test(args, url))
+    except RuntimeError as e:
+        logger.error('%s', e)
+        sys.exit(1)
+    finally:
+        if proc is not None:
+            stop(proc)
+            if args.mongo_url and not args.keep_db:
+                _drop_database(args)
+        if mongod is not None:
+            stop(mongod)
+        if db_path is not None:
+            shutil.rmtree(db_path, ignore_errors=True)
+        if log is not None:
+            log.close()
+        if data_dir is not None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(output + '\n')
+
+
+if __name__ == '__main__':
+    run()
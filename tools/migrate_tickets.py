@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""migrate_tickets
+
+Move the tickets embedded into the events to a dedicated collection (or back).
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import monco
+
+TICKETS_COLLECTION = 'tickets'
+TICKETS_INDEXES = [('event_id', '_id'), ('event_id', 'seq_hex'), ('event_id', 'email'), 'created_by']
+
+
+def to_collection(db, tickets_collection=TICKETS_COLLECTION):
+    """Move the tickets from the events documents to tickets_collection."""
+    db.ensureIndexes(tickets_collection, TICKETS_INDEXES)
+    for event in db.query('events', {'tickets': {'$exists': True}}):
+        tickets = event.get('tickets') or []
+        for ticket in tickets:
+            ticket['event_id'] = event['_id']
+        # start from scratch, in case a previous run was interrupted.
+        db.delete(tickets_collection, {'event_id': event['_id']})
+        db.addMany(tickets_collection, tickets)
+        db.update('events', {'_id': event['_id']}, {'tickets': ''}, operation='unset', create=False)
+        print('%s: %d tickets moved' % (event.get('title'), len(tickets)))
+
+
+def to_events(db, tickets_collection=TICKETS_COLLECTION):
+    """Move the tickets from tickets_collection back into their events."""
+    for event in db.query('events'):
+        tickets = db.query(tickets_collection, {'event_id': event['_id']})
+        for ticket in tickets:
+            del ticket['event_id']
+        db.update('events', {'_id': event['_id']}, {'tickets': tickets}, create=False)
+        db.delete(tickets_collection, {'event_id': event['_id']})
+        print('%s: %d tickets moved' % (event.get('title'), len(tickets)))
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Move tickets between the events and a dedicated collection.')
+    parser.add_argument('--mongo-url', dest='mongo_url', default=None, help='URL to MongoDB server')
+    parser.add_argument('--db-name', dest='db_name', default='eventman', help='name of the MongoDB database to use')
+    parser.add_argument('--reverse', action='store_true', default=False,
+                        help='move the tickets back into the events documents')
+    args = parser.parse_args()
+    db = monco.Monco(url=args.mongo_url, dbName=args.db_name)
+    if args.reverse:
+        to_events(db)
+    else:
+        to_collection(db)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""reconcile_counters
+
+Compute again the counters of the tickets (tickets_sold and total_attendees) of the events.
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import monco
+import utils
+
+TICKETS_COLLECTION = 'tickets'
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Compute again the counters of the tickets of the events.')
+    parser.add_argument('--mongo-url', dest='mongo_url', default=None, help='URL to MongoDB server')
+    parser.add_argument('--db-name', dest='db_name', default='eventman', help='name of the MongoDB database to use')
+    parser.add_argument('--separate-tickets', dest='separate_tickets', action='store_true', default=False,
+                        help='tickets are stored in the dedicated tickets collection')
+    parser.add_argument('--event-id', dest='event_id', default=None, help='only reconcile this event')
+    args = parser.parse_args()
+    db = monco.Monco(url=args.mongo_url, dbName=args.db_name)
+    query = {'_id': args.event_id} if args.event_id else None
+    updated = utils.reconcileCounters(db, query,
+            tickets_collection=TICKETS_COLLECTION if args.separate_tickets else None)
+    print('%d events updated' % updated)
+
+
+if __name__ == '__main__':
+    run()
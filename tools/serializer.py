@@ -0,0 +1 @@
+../serializer.py
\ No newline at end of file
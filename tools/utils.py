@@ -0,0 +1 @@
+../utils.py
\ No newline at end of file
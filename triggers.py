@@ -0,0 +1,520 @@
+# -*- coding: utf-8 -*-
+"""EventMan(ager) triggers
+
+Execution of the scripts associated to an action (see the "Triggers" section of docs/DEVELOPMENT.md).
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import re
+import glob
+import logging
+import datetime
+
+import tornado.ioloop
+import tornado.iostream
+from tornado import gen, locks, process, queues
+from bson.objectid import ObjectId
+
+import serializer
+
+has_pyinotify = False
+try:
+    import pyinotify
+    has_pyinotify = True
+except ImportError:
+    pass
+
+ENCODING = 'utf-8'
+PROCESS_TIMEOUT = 60
+
+# The execution mode of a script can be declared in its first lines, like:
+#   # eventman-trigger: batch
+TRIGGER_MODES = ('single', 'batch', 'persistent')
+re_trigger_mode = re.compile(r'^#\s*eventman-trigger:\s*(?P<mode>[\w-]+)', re.M)
+
+
+def script_mode(script):
+    """Return the execution mode declared by a script ('single' if not specified).
+
+    :param script: path of the script
+    :type script: str
+
+    :returns: one of TRIGGER_MODES
+    :rtype: str
+    """
+    try:
+        with open(script, 'rb') as fd:
+            head = fd.read(1024).decode(ENCODING, 'ignore')
+    except IOError:
+        return 'single'
+    match = re_trigger_mode.search(head)
+    if match and match.group('mode') in TRIGGER_MODES:
+        return match.group('mode')
+    return 'single'
+
+
+def find_scripts(data_dir, action):
+    """Return the executable scripts for an action.
+
+    :param data_dir: the data directory; scripts are in triggers/{action}.d
+    :type data_dir: str
+    :param action: name of the action
+    :type action: str
+
+    :returns: list of (script, mode) tuples
+    :rtype: list
+    """
+    scripts = []
+    for script in sorted(glob.glob(os.path.join(data_dir, 'triggers', '%s.d' % action, '*'))):
+        if not (os.path.isfile(script) and os.access(script, os.X_OK)):
+            continue
+        scripts.append((script, script_mode(script)))
+    return scripts
+
+
+class TriggerRegistry(object):
+    """Index of the scripts in the triggers/{action}.d directories.
+
+    Directories are scanned once; they are scanned again when they change, as
+    notified by inotify (if the pyinotify module is available) or checking their
+    modification times every `check_interval` seconds."""
+    def __init__(self, data_dir, check_interval=2.0):
+        """Initialize the instance.
+
+        :param data_dir: the data directory; scripts are in triggers/{action}.d
+        :type data_dir: str
+        :param check_interval: seconds between checks for modified directories, without inotify
+        :type check_interval: float
+        """
+        self.data_dir = data_dir
+        self.triggers_dir = os.path.join(data_dir, 'triggers')
+        self.check_interval = check_interval
+        self._scripts = {}
+        self._signatures = {}
+        self._notifier = None
+        self._periodic = None
+        # incremented every time a script is added, removed or modified.
+        self.generation = 0
+        self.refresh()
+
+    def _signature(self, directory):
+        """Return something that changes when the scripts of a directory are modified."""
+        try:
+            entries = []
+            for entry in os.scandir(directory):
+                stat = entry.stat()
+                entries.append((entry.name, stat.st_mtime, stat.st_mode))
+            return os.stat(directory).st_mtime, tuple(sorted(entries))
+        except OSError:
+            return None
+
+    def refresh(self, force=False):
+        """Scan again the directories that were modified.
+
+        :param force: scan every directory
+        :type force: bool
+
+        :returns: True if something was changed
+        :rtype: bool
+        """
+        changed = False
+        actions = set()
+        for directory in glob.glob(os.path.join(self.triggers_dir, '*.d')):
+            if not os.path.isdir(directory):
+                continue
+            action = os.path.basename(directory)[:-2]
+            actions.add(action)
+            signature = self._signature(directory)
+            if not force and action in self._signatures and self._signatures[action] == signature:
+                continue
+            self._signatures[action] = signature
+            scripts = find_scripts(self.data_dir, action)
+            if scripts != self._scripts.get(action):
+                logging.debug('triggers for action %s: %s' % (action, scripts))
+                changed = True
+            self._scripts[action] = scripts
+        for action in set(self._scripts) - actions:
+            del self._scripts[action]
+            del self._signatures[action]
+            changed = True
+        if changed:
+            self.generation += 1
+        return changed
+
+    def scripts(self, action):
+        """Return the scripts of an action.
+
+        :param action: name of the action
+        :type action: str
+
+        :returns: list of (script, mode) tuples
+        :rtype: list
+        """
+        return self._scripts.get(action) or []
+
+    def all(self):
+        """Return every registered script.
+
+        :returns: dictionary of action: list of (script, mode) tuples
+        :rtype: dict
+        """
+        return dict((action, scripts) for action, scripts in self._scripts.items() if scripts)
+
+    def start(self):
+        """Watch for changes of the directories; must be called from the IOLoop thread."""
+        ioloop = tornado.ioloop.IOLoop.current()
+        if has_pyinotify and os.path.isdir(self.triggers_dir):
+            try:
+                wm = pyinotify.WatchManager()
+                mask = (pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MODIFY | pyinotify.IN_ATTRIB |
+                        pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO)
+                wm.add_watch(self.triggers_dir, mask, rec=True, auto_add=True)
+                self._notifier = pyinotify.TornadoAsyncNotifier(wm, ioloop,
+                        callback=lambda notifier: self.refresh(), default_proc_fun=lambda event: None)
+                return
+            except Exception as e:
+                logging.warn('unable to use inotify to watch %s: %s' % (self.triggers_dir, e))
+        self._periodic = tornado.ioloop.PeriodicCallback(self.refresh, self.check_interval * 1000)
+        self._periodic.start()
+
+
+@gen.coroutine
+def run_subprocess(cmd, stdin_data=None, env=None, timeout=PROCESS_TIMEOUT):
+    """Execute the given command, killing it if it takes too long.
+
+    :param cmd: the command to be run with its command line arguments
+    :type cmd: list
+    :param stdin_data: data to be sent over stdin
+    :type stdin_data: str
+    :param env: environment of the process
+    :type env: dict
+    :param timeout: seconds after which the process is killed
+    :type timeout: int
+
+    :returns: the stdout and stderr of the process
+    :rtype: tuple
+    """
+    ioloop = tornado.ioloop.IOLoop.current()
+    p = process.Subprocess(cmd, close_fds=True, stdin=process.Subprocess.STREAM,
+            stdout=process.Subprocess.STREAM, stderr=process.Subprocess.STREAM, env=env)
+
+    def on_timeout():
+        logging.debug('the trigger %s is taking too long: killing it' % ' '.join(cmd))
+        try:
+            p.proc.kill()
+        except:
+            pass
+    timeout_handle = ioloop.add_timeout(datetime.timedelta(seconds=timeout), on_timeout)
+    try:
+        try:
+            yield p.stdin.write((stdin_data or '').encode(ENCODING))
+        except tornado.iostream.StreamClosedError:
+            pass
+        p.stdin.close()
+        out, err = yield [p.stdout.read_until_close(), p.stderr.read_until_close()]
+        returncode = yield p.wait_for_exit(raise_error=False)
+    finally:
+        ioloop.remove_timeout(timeout_handle)
+    logging.debug('trigger: %s returncode: %d' % (' '.join(cmd), returncode))
+    if out:
+        logging.debug('trigger stdout: %s' % out.decode(ENCODING))
+    if err:
+        logging.debug('trigger strerr: %s' % err.decode(ENCODING))
+    raise gen.Return((out, err))
+
+
+class PersistentTrigger(object):
+    """A script declaring the 'persistent' mode, started once and kept running.
+
+    Every event is sent over stdin as a line of JSON, like {"env": {...}, "data": {...}};
+    the script must answer with a line on stdout once the event was handled.
+    The script is started again if it exits or doesn't answer in time."""
+    def __init__(self, script, timeout=PROCESS_TIMEOUT, generation=0):
+        """Initialize the instance.
+
+        :param script: path of the script
+        :type script: str
+        :param timeout: seconds to wait for the answer to an event
+        :type timeout: int
+        :param generation: generation of the TriggerRegistry when the script was found
+        :type generation: int
+        """
+        self.script = script
+        self.timeout = timeout
+        self.generation = generation
+        self.process = None
+        self._lock = locks.Lock()
+
+    def is_running(self):
+        return self.process is not None and self.process.proc.poll() is None
+
+    def start(self):
+        """Start the script; must be called from the IOLoop thread."""
+        logging.debug('starting persistent trigger %s' % self.script)
+        self.process = process.Subprocess([self.script], close_fds=True, stdin=process.Subprocess.STREAM,
+                stdout=process.Subprocess.STREAM, stderr=process.Subprocess.STREAM,
+                env={'EVENTMAN_TRIGGER_MODE': 'persistent'})
+        tornado.ioloop.IOLoop.current().spawn_callback(self._log_stderr, self.process)
+
+    def stop(self):
+        """Stop the script."""
+        if self.process is None:
+            return
+        logging.debug('stopping persistent trigger %s' % self.script)
+        try:
+            self.process.stdin.close()
+            self.process.proc.kill()
+            self.process.proc.wait()
+        except:
+            pass
+        self.process = None
+
+    @gen.coroutine
+    def _log_stderr(self, p):
+        while True:
+            try:
+                line = yield p.stderr.read_until(b'\n')
+            except tornado.iostream.StreamClosedError:
+                break
+            logging.debug('trigger %s strerr: %s' % (self.script, line.decode(ENCODING).rstrip()))
+
+    @gen.coroutine
+    def send(self, stdin_data='{}', env=None):
+        """Send an event to the script, starting it if needed.
+
+        :param stdin_data: JSON data of the event
+        :type stdin_data: str
+        :param env: environment of the event
+        :type env: dict
+
+        :returns: the answer of the script, or None in case of errors
+        :rtype: str
+        """
+        with (yield self._lock.acquire()):
+            if not self.is_running():
+                self.stop()
+                self.start()
+            p = self.process
+            line = '{"env": %s, "data": %s}\n' % (serializer.dumps(env or {}), (stdin_data or '{}').replace('\n', ' '))
+            try:
+                yield p.stdin.write(line.encode(ENCODING))
+                out = yield gen.with_timeout(datetime.timedelta(seconds=self.timeout), p.stdout.read_until(b'\n'))
+            except (tornado.iostream.StreamClosedError, gen.TimeoutError) as e:
+                logging.error('persistent trigger %s failed: %s' % (self.script, e or 'timeout'))
+                self.stop()
+                raise gen.Return(None)
+            out = out.decode(ENCODING).rstrip()
+            logging.debug('trigger %s stdout: %s' % (self.script, out))
+            raise gen.Return(out)
+
+
+class TriggerDispatcher(object):
+    """Queue and execute the triggers, limiting the number of processes.
+
+    At most `workers` scripts are running at the same time, and no more than
+    `limits[action]` for each action.  Scripts declaring the 'batch' mode receive,
+    in a single execution, up to `batch_size` events (waiting at most `batch_delay`
+    seconds for more events to come).  Scripts declaring the 'persistent' mode are
+    started once and receive the events over stdin (see PersistentTrigger).  If a
+    database is given, queued executions are stored in it, to be resumed if the
+    server is restarted."""
+    queue_collection = 'triggers_queue'
+
+    def __init__(self, data_dir, db=None, workers=4, limits=None, batch_size=20, batch_delay=1.0,
+                 timeout=PROCESS_TIMEOUT):
+        """Initialize the instance.
+
+        :param data_dir: the data directory; scripts are in triggers/{action}.d
+        :type data_dir: str
+        :param db: connector used to store the queue
+        :type db: :class:`~monco.AsyncMonco`
+        :param workers: maximum number of scripts running at the same time
+        :type workers: int
+        :param limits: maximum number of scripts running at the same time, for some actions
+        :type limits: dict
+        :param batch_size: maximum number of events sent to a 'batch' script
+        :type batch_size: int
+        :param batch_delay: seconds to wait for more events before running a 'batch' script
+        :type batch_delay: float
+        :param timeout: seconds after which a script is killed
+        :type timeout: int
+        """
+        self.data_dir = data_dir
+        self.db = db
+        self.workers = workers
+        self.limits = limits or {}
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.timeout = timeout
+        self.registry = TriggerRegistry(data_dir)
+        self._slots = locks.Semaphore(workers)
+        self._queues = {}
+        self._batches = {}
+        self._batch_timeouts = {}
+        self._persistent = {}
+
+    @staticmethod
+    def release_jobs(db):
+        """Mark every stored job as not assigned to a process; call it before the
+        processes are started.
+
+        :param db: connector used to store the queue
+        :type db: :class:`~monco.Monco`
+        """
+        db.updateMany(TriggerDispatcher.queue_collection, {}, {'claimed': False})
+
+    def start(self):
+        """Watch the trigger directories and recover the stored jobs; must be called
+        from the IOLoop thread."""
+        self.registry.start()
+        tornado.ioloop.IOLoop.current().spawn_callback(self.recover)
+
+    def stop(self):
+        """Stop the persistent scripts."""
+        for trigger in self._persistent.values():
+            trigger.stop()
+        self._persistent.clear()
+
+    def stats(self):
+        """Return information about the queued jobs.
+
+        :returns: dictionary of action: number of queued (or waiting for a batch) jobs
+        :rtype: dict
+        """
+        stats = dict((action, queue.qsize()) for action, queue in self._queues.items())
+        for jobs in self._batches.values():
+            action = jobs[0]['action']
+            stats[action] = stats.get(action, 0) + len(jobs)
+        return stats
+
+    @gen.coroutine
+    def recover(self):
+        """Queue again the jobs stored by a previous run of the server."""
+        if self.db is None:
+            return
+        jobs = yield self.db.query(self.queue_collection, {'claimed': False})
+        for job in jobs:
+            # Assign the job to this process, unless another process was faster.
+            claimed, job = yield self.db.update(self.queue_collection,
+                    {'_id': job['_id'], 'claimed': False}, {'claimed': True}, create=False)
+            if claimed:
+                job['env'] = dict((k, str(v)) for k, v in (job.get('env') or {}).items())
+                self._enqueue(job)
+        if jobs:
+            logging.info('%d trigger jobs recovered from the queue' % len(jobs))
+
+    @gen.coroutine
+    def submit(self, action, stdin_data='{}', env=None):
+        """Queue the execution of the scripts of an action; the jobs are queued once they
+        are stored in the database.
+
+        :param action: action name; scripts in directory {data_dir}/triggers/{action}.d will be run
+        :type action: str
+        :param stdin_data: JSON data sent to the scripts over stdin
+        :type stdin_data: str
+        :param env: environment of the processes
+        :type env: dict
+        """
+        for script, mode in self.registry.scripts(action):
+            job = {'_id': ObjectId(), 'action': action, 'script': script, 'mode': mode,
+                   'stdin': stdin_data, 'env': env or {}}
+            if self.db is not None:
+                try:
+                    yield self.db.add(self.queue_collection, dict(job, claimed=True))
+                except Exception as e:
+                    logging.error('unable to store the trigger job %s: %s' % (script, e))
+            self._enqueue(job)
+
+    def _enqueue(self, job):
+        if job.get('mode') == 'batch':
+            self._add_to_batch(job)
+        else:
+            self._queue(job['action']).put_nowait([job])
+
+    def _queue(self, action):
+        """Return the queue of an action, starting its consumers if needed."""
+        if action not in self._queues:
+            self._queues[action] = queues.Queue()
+            for i in range(self.limits.get(action) or self.workers):
+                tornado.ioloop.IOLoop.current().spawn_callback(self._consume, action)
+        return self._queues[action]
+
+    def _add_to_batch(self, job):
+        script = job['script']
+        self._batches.setdefault(script, []).append(job)
+        if len(self._batches[script]) >= self.batch_size:
+            self._flush_batch(script)
+        elif script not in self._batch_timeouts:
+            self._batch_timeouts[script] = tornado.ioloop.IOLoop.current().add_timeout(
+                    datetime.timedelta(seconds=self.batch_delay), lambda: self._flush_batch(script))
+
+    def _flush_batch(self, script):
+        timeout_handle = self._batch_timeouts.pop(script, None)
+        if timeout_handle is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(timeout_handle)
+        jobs = self._batches.pop(script, None)
+        if jobs:
+            self._queue(jobs[0]['action']).put_nowait(jobs)
+
+    @gen.coroutine
+    def _consume(self, action):
+        """Run, one at a time, the jobs of an action."""
+        queue = self._queues[action]
+        while True:
+            jobs = yield queue.get()
+            yield self._slots.acquire()
+            try:
+                yield self._run(jobs)
+            except Exception as e:
+                logging.error('error running trigger %s: %s' % (jobs[0]['script'], e))
+            finally:
+                self._slots.release()
+                queue.task_done()
+            if self.db is not None:
+                try:
+                    yield self.db.delete(self.queue_collection, {'_id': {'$in': [job['_id'] for job in jobs]}})
+                except Exception as e:
+                    logging.error('unable to remove the trigger jobs of %s: %s' % (jobs[0]['script'], e))
+
+    def _persistent_trigger(self, script):
+        """Return the PersistentTrigger of a script, replacing it if the scripts were modified."""
+        trigger = self._persistent.get(script)
+        if trigger is not None and trigger.generation != self.registry.generation:
+            trigger.stop()
+            trigger = None
+        if trigger is None:
+            trigger = PersistentTrigger(script, timeout=self.timeout, generation=self.registry.generation)
+            self._persistent[script] = trigger
+        return trigger
+
+    @gen.coroutine
+    def _run(self, jobs):
+        script = jobs[0]['script']
+        if jobs[0].get('mode') == 'persistent':
+            trigger = self._persistent_trigger(script)
+            for job in jobs:
+                yield trigger.send(job['stdin'], job['env'])
+            return
+        if jobs[0].get('mode') == 'batch':
+            stdin_data = '[%s]' % ', '.join(['{"env": %s, "data": %s}' % (serializer.dumps(job['env']), job['stdin'])
+                                            for job in jobs])
+            env = {'EVENTMAN_TRIGGER_BATCH_SIZE': str(len(jobs))}
+        else:
+            stdin_data = jobs[0]['stdin']
+            env = dict(jobs[0]['env'])
+        env['EVENTMAN_TRIGGER_MODE'] = jobs[0].get('mode') or 'single'
+        logging.debug('running trigger %s for %d events' % (script, len(jobs)))
+        yield run_subprocess([script], stdin_data, env, timeout=self.timeout)
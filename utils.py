@@ -17,14 +17,18 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import re
 import csv
 import copy
+import codecs
 import json
 import string
 import random
 import hashlib
 import datetime
 import io
+import time
+import collections
 from bson.objectid import ObjectId
 
 
@@ -79,6 +83,221 @@ def csvParse(csvStr, remap=None, merge=None):
     return reply, results
 
 
+class CSVStreamParser(object):
+    """Parse a CSV file incrementally, as its content is received; like csvParse,
+    the columns can be renamed and other information merged into each line."""
+    def __init__(self, remap=None, merge=None, encoding='utf-8'):
+        """Initialize the instance.
+
+        :param remap: a dictionary used to rename the columns
+        :type remap: dict
+        :param merge: merge these information into each line
+        :type merge: dict
+        :param encoding: encoding of the file
+        :type encoding: str
+        """
+        self.remap = remap or {}
+        self.merge = merge or {}
+        self.headers = None
+        self.stats = dict(total=0, valid=0)
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self._pending = ''
+
+    def _rows(self, text):
+        results = []
+        try:
+            for row in csv.reader(io.StringIO(text)):
+                if not row and self.headers is None:
+                    continue
+                if self.headers is None:
+                    self.headers = [self.remap.get(h, h.lower().replace(' ', '_').replace('.', '_')) for h in row]
+                    continue
+                self.stats['total'] += 1
+                if len(row) != len(self.headers):
+                    continue
+                values = dict(zip(self.headers, row))
+                values.update(self.merge)
+                results.append(values)
+                self.stats['valid'] += 1
+        except csv.Error:
+            pass
+        return results
+
+    def feed(self, data):
+        """Parse a piece of the file.
+
+        :param data: the next piece of the file
+        :type data: bytes
+
+        :returns: the lines completed by this piece, as dictionaries
+        :rtype: list
+        """
+        text = self._pending + self._decoder.decode(data)
+        # A line is complete when it ends outside a quoted value, i.e. after an even number of quotes.
+        cut = 0
+        quotes = 0
+        start = 0
+        while True:
+            end = text.find('\n', start)
+            if end == -1:
+                break
+            quotes += text.count('"', start, end)
+            start = end + 1
+            if quotes % 2 == 0:
+                cut = start
+        self._pending = text[cut:]
+        return self._rows(text[:cut])
+
+    def close(self):
+        """Parse what is left of the file.
+
+        :returns: the last lines, as dictionaries
+        :rtype: list
+        """
+        text = self._pending + self._decoder.decode(b'', final=True)
+        self._pending = ''
+        return self._rows(text)
+
+
+class MultipartStreamParser(object):
+    """Parse a multipart/form-data body incrementally, as it is received."""
+    re_disposition_param = re.compile(r';\s*(?P<key>name|filename)="(?P<value>[^"]*)"', re.I)
+
+    def __init__(self, boundary):
+        """Initialize the instance.
+
+        :param boundary: the boundary, from the Content-Type header
+        :type boundary: str or bytes
+        """
+        if isinstance(boundary, str):
+            boundary = boundary.encode('latin-1')
+        self._delimiter = b'\r\n--' + boundary
+        # the first delimiter is not preceded by a new line.
+        self._buffer = b'\r\n'
+        self._state = 'preamble'
+
+    def _parse_headers(self, data):
+        info = {}
+        for line in data.decode('utf-8', 'replace').split('\r\n'):
+            if line.lower().startswith('content-disposition:'):
+                for match in self.re_disposition_param.finditer(line):
+                    info[match.group('key').lower()] = match.group('value')
+        return info.get('name'), info.get('filename')
+
+    def feed(self, data):
+        """Parse a piece of the body.
+
+        :param data: the next piece of the body
+        :type data: bytes
+
+        :returns: list of events: ('part', name, filename) at the beginning of every part,
+                  ('data', bytes, None) for its content and ('end', None, None) at the end of the part
+        :rtype: list
+        """
+        self._buffer += data
+        events = []
+        while True:
+            if self._state == 'preamble':
+                idx = self._buffer.find(self._delimiter)
+                if idx == -1:
+                    self._buffer = self._buffer[-len(self._delimiter):]
+                    break
+                self._buffer = self._buffer[idx + len(self._delimiter):]
+                self._state = 'delimiter'
+            elif self._state == 'delimiter':
+                if len(self._buffer) < 2:
+                    break
+                if self._buffer.startswith(b'--'):
+                    self._state = 'epilogue'
+                    continue
+                self._buffer = self._buffer[2:]
+                self._state = 'headers'
+            elif self._state == 'headers':
+                idx = self._buffer.find(b'\r\n\r\n')
+                if idx == -1:
+                    break
+                name, filename = self._parse_headers(self._buffer[:idx])
+                self._buffer = self._buffer[idx + 4:]
+                events.append(('part', name, filename))
+                self._state = 'body'
+            elif self._state == 'body':
+                idx = self._buffer.find(self._delimiter)
+                if idx == -1:
+                    # keep what could be the beginning of a delimiter.
+                    keep = len(self._delimiter) - 1
+                    if len(self._buffer) > keep:
+                        events.append(('data', self._buffer[:-keep], None))
+                        self._buffer = self._buffer[-keep:]
+                    break
+                if idx:
+                    events.append(('data', self._buffer[:idx], None))
+                events.append(('end', None, None))
+                self._buffer = self._buffer[idx + len(self._delimiter):]
+                self._state = 'delimiter'
+            else:
+                self._buffer = b''
+                break
+        return events
+
+
+# placeholder for missing values, when None is a valid value
+_missing = object()
+
+
+class TTLCache(object):
+    """A dictionary-like cache with a maximum number of items, where the least recently
+    used items are removed first and every item expires after some seconds."""
+    def __init__(self, max_size=1024, ttl=300):
+        """Initialize the instance.
+
+        :param max_size: maximum number of items
+        :type max_size: int
+        :param ttl: seconds after which an item expires (0 means never)
+        :type ttl: float
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def get(self, key, default=None):
+        """Return the value of a key, or default if it's missing or expired."""
+        item = self._items.get(key)
+        if item is None:
+            return default
+        if self.ttl and item[1] < time.monotonic():
+            del self._items[key]
+            return default
+        self._items.move_to_end(key)
+        return item[0]
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = (value, time.monotonic() + (self.ttl or 0))
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove a key, returning its value."""
+        item = self._items.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        """Remove every item."""
+        self._items.clear()
+
+
 def hash_password(password, salt=None):
     """Hash a password.
 
@@ -229,6 +448,83 @@ def ebAPIFetch(oauthToken, eventID):
     return info
 
 
+def ticketCounters(tickets):
+    """Count the valid (not cancelled) tickets and the attendees in a list of tickets.
+
+    :param tickets: list of tickets
+    :type tickets: list
+
+    :returns: dictionary with the tickets_sold and total_attendees keys
+    :rtype: dict
+    """
+    valid_tickets = [t for t in tickets if t is not None and not t.get('cancelled')]
+    return {'tickets_sold': len(valid_tickets),
+            'total_attendees': len([t for t in valid_tickets if t.get('attended')])}
+
+
+def ticketCountersDelta(old=None, new=None):
+    """Return how the counters of an event change, when a ticket is modified.
+
+    :param old: the ticket before the change (None if it was just added)
+    :type old: dict
+    :param new: the ticket after the change (None if it was deleted)
+    :type new: dict
+
+    :returns: dictionary of counter: increment; counters that don't change are not included
+    :rtype: dict
+    """
+    old_counters = ticketCounters([old])
+    new_counters = ticketCounters([new])
+    return dict((key, value - old_counters[key]) for key, value in new_counters.items()
+                if value != old_counters[key])
+
+
+# values of the flags of a ticket (like attended and cancelled) that count as false.
+FALSE_VALUES = [False, None, 0, '']
+
+
+def ticketCountersQuery(ticket):
+    """Return the conditions that match a ticket only if the fields used to compute the
+    counters of its event (see ticketCounters) still have the values they have in `ticket`.
+
+    :param ticket: the ticket
+    :type ticket: dict
+
+    :returns: dictionary of field: condition
+    :rtype: dict
+    """
+    return dict((flag, {'$nin' if ticket.get(flag) else '$in': FALSE_VALUES})
+                for flag in ('attended', 'cancelled'))
+
+
+def reconcileCounters(db, query=None, tickets_collection=None):
+    """Compute again, and store, the tickets_sold and total_attendees counters of the events.
+
+    :param db: the database connector
+    :type db: :class:`~monco.Monco`
+    :param query: only update the events matching this query
+    :type query: dict
+    :param tickets_collection: collection of the tickets, if they are not embedded into the events
+    :type tickets_collection: str
+
+    :returns: the number of updated events
+    :rtype: int
+    """
+    fields = ['_id'] if tickets_collection else ['tickets.cancelled', 'tickets.attended']
+    updated = 0
+    for event in db.query('events', query, fields=fields):
+        if tickets_collection:
+            valid_query = {'event_id': event['_id'], 'cancelled': {'$ne': True}}
+            counters = {'tickets_sold': db.count(tickets_collection, valid_query)}
+            valid_query['attended'] = True
+            counters['total_attendees'] = db.count(tickets_collection, valid_query)
+        else:
+            counters = ticketCounters(event.get('tickets') or [])
+        db.update('events', {'_id': event['_id']}, counters, create=False)
+        updated += 1
+    return updated
+
+
 class ImprovedEncoder(json.JSONEncoder):
     """Enhance the default JSON encoder to serialize datetime and ObjectId instances."""
     def default(self, o):